@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012 Instituto Nacional de Pesquisas Espaciais (INPE)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Purpose:
+# Columnar store for the answers of applications whose answers are one
+# of a few values (e.g. Yes/No or the day of the best tile). Each answer
+# takes 20 bytes: task ID and task run ID as int64 and the answer as an
+# int32 code into the list of categories.
+
+import os
+import numpy
+
+class AnswerStore(object):
+    """
+    Answers kept in typed arrays, which can be spilled to memory-mapped
+    files, with group-bys by task done in NumPy
+    """
+
+    def __init__(self, capacity = 1024):
+        """
+        :arg int capacity: Initial number of answers allocated
+        """
+        self.size = 0
+        self.taskIds = numpy.empty(capacity, dtype=numpy.int64)
+        self.runIds = numpy.empty(capacity, dtype=numpy.int64)
+        self.codes = numpy.empty(capacity, dtype=numpy.int32)
+        self.categories = []
+        self.categoryCodes = {}
+
+    def __len__(self):
+        return self.size
+
+    def code(self, answer):
+        """
+        Code of an answer, adding it to the categories if it is new
+
+        :arg string answer: The answer
+        :returns: Code of the answer
+        :rtype: int
+        """
+        code = self.categoryCodes.get(answer)
+        if code is None:
+            code = len(self.categories)
+            self.categories.append(answer)
+            self.categoryCodes[answer] = code
+        return code
+
+    def grow(self, capacity):
+        """
+        Makes room for at least capacity answers
+
+        :arg int capacity: Number of answers needed
+        """
+        if capacity <= len(self.taskIds):
+            return
+        capacity = max(capacity, 2 * len(self.taskIds))
+        for name in ['taskIds', 'runIds', 'codes']:
+            old = getattr(self, name)
+            new = numpy.empty(capacity, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def append(self, taskId, runId, answer):
+        """
+        Adds one answer
+
+        :arg int taskId: ID of the task
+        :arg int runId: ID of the task run
+        :arg string answer: The answer
+        """
+        self.grow(self.size + 1)
+        self.taskIds[self.size] = taskId
+        self.runIds[self.size] = runId
+        self.codes[self.size] = self.code(answer)
+        self.size = self.size + 1
+
+    def extend(self, answers):
+        """
+        Adds a list of answers
+
+        :arg list answers: List of (taskId, runId, answer)
+        """
+        answers = list(answers)
+        self.grow(self.size + len(answers))
+        end = self.size + len(answers)
+        self.taskIds[self.size:end] = [answer[0] for answer in answers]
+        self.runIds[self.size:end] = [answer[1] for answer in answers]
+        self.codes[self.size:end] = [self.code(answer[2]) for answer in answers]
+        self.size = end
+
+    def spill(self, directory):
+        """
+        Moves the arrays to memory-mapped files, so the answers don't need
+        to fit in memory. The store can't grow after this.
+
+        :arg string directory: Directory for the files
+        """
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        for name in ['taskIds', 'runIds', 'codes']:
+            old = getattr(self, name)
+            new = numpy.memmap(os.path.join(directory, name+'.bin'), \
+                dtype=old.dtype, mode='w+', shape=(max(self.size, 1),))
+            new[:self.size] = old[:self.size]
+            new.flush()
+            setattr(self, name, new)
+
+    def counts(self, tasksId, categories = None):
+        """
+        Number of answers of each category for each task
+
+        :arg list tasksId: IDs of the tasks (rows of the result)
+        :arg list categories: Answers to be counted (columns of the result);
+            all the categories if None. Other answers are ignored.
+        :returns: Matrix (tasks x categories) with the answers count
+        :rtype: numpy.ndarray
+        """
+        if categories is None:
+            categories = self.categories
+        numberTasks = len(tasksId)
+        numberCategories = len(categories)
+        count = numpy.zeros(numberTasks * numberCategories, dtype=numpy.int64)
+        if numberTasks > 0 and numberCategories > 0 and self.size > 0:
+            #Row of each answer, found by a search in the sorted task IDs
+            tasksId = numpy.asarray(tasksId, dtype=numpy.int64)
+            order = numpy.argsort(tasksId, kind='mergesort')
+            sortedIds = tasksId[order]
+            taskIds = self.taskIds[:self.size]
+            position = numpy.searchsorted(sortedIds, taskIds)
+            position = numpy.minimum(position, numberTasks - 1)
+            rows = order[position]
+            valid = sortedIds[position] == taskIds
+            #Column of each answer, mapping the codes to the categories
+            columnOfCode = -numpy.ones(len(self.categories), dtype=numpy.int64)
+            for item in range(numberCategories):
+                code = self.categoryCodes.get(categories[item])
+                if code is not None:
+                    columnOfCode[code] = item
+            columns = columnOfCode[self.codes[:self.size]]
+            valid = valid & (columns >= 0)
+            cells = rows[valid] * numberCategories + columns[valid]
+            count += numpy.bincount(cells, minlength=len(count))
+        return count.reshape(numberTasks, numberCategories)
+
+    def runIdsByTask(self):
+        """
+        IDs of the task runs of each task
+
+        :returns: Sorted task run IDs, by task ID
+        :rtype: dictionary
+        """
+        runs = {}
+        if self.size == 0:
+            return runs
+        taskIds = numpy.asarray(self.taskIds[:self.size])
+        runIds = numpy.asarray(self.runIds[:self.size])
+        order = numpy.lexsort((runIds, taskIds))
+        taskIds = taskIds[order]
+        runIds = runIds[order]
+        #Position where each task starts in the sorted answers
+        starts = numpy.flatnonzero(numpy.r_[True, taskIds[1:] != taskIds[:-1]])
+        ends = numpy.r_[starts[1:], self.size]
+        for item in range(len(starts)):
+            runs[int(taskIds[starts[item]])] = \
+                [int(runId) for runId in runIds[starts[item]:ends[item]]]
+        return runs
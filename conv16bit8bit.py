@@ -18,101 +18,514 @@
 
 #Example: http://gis.stackexchange.com/questions/7377/rescale-raster-band-with-gdal-python-bindings
 
+import os
+import sys
+import glob
 import gdal
-from gdalconst import *
+import time
 import numpy
+import hashlib
+import rasterTools
+import multiprocessing
+from gdalconst import *
+from optparse import OptionParser
+
+#Number of bins of the histogram of a 16 bit band
+HISTOGRAM_BINS = 65536
+
+#Lower and upper percentiles of the default stretch
+STRETCH_PERCENTILES = (2.0, 98.0)
+
+def bandScale(band):
+    """
+    Limits and scale of the linear stretch of a band to 0-255. Negative
+    values are taken as 0.
+
+    :arg gdal.Band band: The band
+    :returns: Lower and upper limits and the scale (255 / (upper - lower))
+    :rtype: list
+    """
+    #Exact minimum and maximum, read by GDAL block by block
+    (minimum, maximum) = band.ComputeRasterMinMax(0)
+    low = max(float(minimum), 0.0)
+    high = max(float(maximum), 0.0)
+    if high > low:
+        scale = 255.0 / (high - low)
+    else:
+        scale = 0.0
+    return low, high, scale
+
+def convertBand(band, destBand, low, high, scale):
+    """
+    Stretches a band to 8 bits block by block. Only one block of the
+    band and two buffers of the same size are in memory at a time.
+
+    :arg gdal.Band band: The 16 bit band
+    :arg gdal.Band destBand: The 8 bit band to be written
+    :arg float low: Value mapped to 0
+    :arg float high: Value mapped to 255
+    :arg float scale: 255 / (high - low); 0 maps every value to 0
+    """
+    work = None
+    for xOff, yOff, xSize, ySize in rasterTools.blockWindows(band):
+        #The first window is the largest one
+        if work is None:
+            work = numpy.empty((ySize, xSize), dtype=numpy.float64)
+            output = numpy.empty((ySize, xSize), dtype=numpy.uint8)
+        block = work[:ySize, :xSize]
+        block[...] = band.ReadAsArray(xOff, yOff, xSize, ySize)
+        numpy.clip(block, low, high, out=block)
+        block -= low
+        #Same operations, in the same order, as the old full-array
+        #stretch 255 * ((x - low) / (high - low)), so values round alike
+        if scale > 0:
+            block /= (high - low)
+            block *= 255.0
+        outBlock = output[:ySize, :xSize]
+        outBlock[...] = block
+        destBand.WriteArray(outBlock, xOff, yOff)
+
+def histogramOffset(band):
+    """
+    Offset added to the values of a band to index its 65536 bins
+    histogram (32768 for signed 16 bit bands, 0 otherwise)
+
+    :arg gdal.Band band: The band
+    :returns: The offset
+    :rtype: int
+    """
+    if band.DataType == GDT_Int16:
+        return 32768
+    return 0
+
+def histogramIndexes(block, offset):
+    """
+    Histogram bin of each value of a block, without a copy to a larger type
+
+    :arg numpy.ndarray block: Values of the block
+    :arg int offset: Offset of the band (see histogramOffset)
+    :returns: Bin of each value
+    :rtype: numpy.ndarray
+    """
+    if offset != 0:
+        #Same as value + 32768 for int16
+        return block.view(numpy.uint16) ^ numpy.uint16(0x8000)
+    return block
+
+def bandHistogram(band, useCache = 1):
+    """
+    Exact histogram (65536 bins) of an 8 or 16 bit band, counted block by
+    block. It is kept as the default histogram of the band, which GDAL
+    saves in the .aux.xml of the image, and read from there next time.
+    The nodata value of the band (e.g. -28672, the fill value of the
+    MODIS sur_refl bands) is left out of the returned histogram.
+
+    :arg gdal.Band band: The band
+    :arg int useCache: If a histogram saved in the .aux.xml can be used
+    :returns: Number of pixels of each value (value + offset)
+    :rtype: numpy.ndarray
+    """
+    offset = histogramOffset(band)
+    if useCache == 1:
+        cached = band.GetDefaultHistogram(force=0)
+        #Only a histogram with the same bins as the one written below
+        if cached is not None and cached[2] == HISTOGRAM_BINS and \
+            abs(cached[0] - (-offset - 0.5)) < 1e-6 and \
+            abs(cached[1] - (HISTOGRAM_BINS - offset - 0.5)) < 1e-6:
+            return withoutNoData(band, numpy.array(cached[3], dtype=numpy.int64))
+    histogram = numpy.zeros(HISTOGRAM_BINS, dtype=numpy.int64)
+    for xOff, yOff, xSize, ySize in rasterTools.blockWindows(band):
+        block = band.ReadAsArray(xOff, yOff, xSize, ySize)
+        histogram += numpy.bincount(histogramIndexes(block, offset).ravel(), \
+            minlength=HISTOGRAM_BINS)
+    band.SetDefaultHistogram(-offset - 0.5, HISTOGRAM_BINS - offset - 0.5, \
+        [int(count) for count in histogram])
+    return withoutNoData(band, histogram)
+
+def noDataIndex(band):
+    """
+    Histogram bin of the nodata value of a band
+
+    :arg gdal.Band band: The band
+    :returns: The bin, or None if the band has no nodata value in range
+    :rtype: int
+    """
+    noData = band.GetNoDataValue()
+    if noData is None or noData != int(noData):
+        return None
+    index = int(noData) + histogramOffset(band)
+    if index < 0 or index >= HISTOGRAM_BINS:
+        return None
+    return index
+
+def withoutNoData(band, histogram):
+    """
+    Empties the bin of the nodata value of a band, so fill pixels don't
+    move the percentiles or the equalization
+
+    :arg gdal.Band band: The band
+    :arg numpy.ndarray histogram: Histogram of the band
+    :returns: The same histogram
+    :rtype: numpy.ndarray
+    """
+    index = noDataIndex(band)
+    if index is not None:
+        histogram[index] = 0
+    return histogram
+
+def linearLut(low, high, offset):
+    """
+    Table mapping every 16 bit value to 8 bits linearly between two limits
+
+    :arg float low: Value mapped to 0
+    :arg float high: Value mapped to 255
+    :arg int offset: Offset of the band (see histogramOffset)
+    :returns: 8 bit value of each value + offset
+    :rtype: numpy.ndarray
+    """
+    values = numpy.arange(HISTOGRAM_BINS, dtype=numpy.float64) - offset
+    if high <= low:
+        return numpy.zeros(HISTOGRAM_BINS, dtype=numpy.uint8)
+    values = 255.0 * ((numpy.clip(values, low, high) - low) / (high - low))
+    return values.astype(numpy.uint8)
+
+def stretchLut(histogram, offset, stretch = 'percentile', \
+    percentiles = STRETCH_PERCENTILES):
+    """
+    Table mapping every 16 bit value of a band to 8 bits
+
+    :arg numpy.ndarray histogram: Histogram of the band (see bandHistogram)
+    :arg int offset: Offset of the band (see histogramOffset)
+    :arg string stretch: linear (between the minimum, taken as 0 if
+        negative, and the maximum), percentile (between two percentiles)
+        or equalize (histogram equalization)
+    :arg list percentiles: Lower and upper percentiles of the percentile
+        stretch
+    :returns: 8 bit value of each value + offset
+    :rtype: numpy.ndarray
+    """
+    cumulative = numpy.cumsum(histogram)
+    total = cumulative[-1]
+    if total == 0:
+        return numpy.zeros(HISTOGRAM_BINS, dtype=numpy.uint8)
+    used = numpy.flatnonzero(histogram)
+    if stretch == 'linear':
+        low = max(used[0] - offset, 0)
+        high = max(used[-1] - offset, 0)
+    elif stretch == 'percentile':
+        low = numpy.searchsorted(cumulative, total * percentiles[0] / 100.0) - offset
+        high = numpy.searchsorted(cumulative, total * percentiles[1] / 100.0) - offset
+    elif stretch == 'equalize':
+        first = cumulative[used[0]]
+        if total == first:
+            return numpy.zeros(HISTOGRAM_BINS, dtype=numpy.uint8)
+        lut = numpy.round((cumulative - first) * (255.0 / (total - first)))
+        return numpy.clip(lut, 0, 255).astype(numpy.uint8)
+    else:
+        raise ValueError("Unknown stretch: "+stretch)
+    return linearLut(float(low), float(high), offset)
+
+def applyLut(band, destBand, lut):
+    """
+    Converts a band to 8 bits block by block with a table (one take per
+    block)
+
+    :arg gdal.Band band: The 8 or 16 bit band
+    :arg gdal.Band destBand: The 8 bit band to be written
+    :arg numpy.ndarray lut: 8 bit value of each value + offset
+    """
+    offset = histogramOffset(band)
+    for xOff, yOff, xSize, ySize in rasterTools.blockWindows(band):
+        block = band.ReadAsArray(xOff, yOff, xSize, ySize)
+        destBand.WriteArray(lut.take(histogramIndexes(block, offset)), xOff, yOff)
+
+def convert16bit8bit(fileName, destinyName, stretch = 'percentile', \
+    percentiles = STRETCH_PERCENTILES, bands = None, verbose = 1):
+    """
+    Converts the bands of an image to 8 bits. Integer bands of up to 16
+    bits are stretched with a table built from their histogram; other
+    bands linearly between their minimum and maximum. The image is
+    written with the GeoTIFF profile of rasterTools, under a temporary
+    name renamed when complete.
+
+    :arg string fileName: Image to be converted
+    :arg string destinyName: 8 bit image to be written
+    :arg string stretch: linear, percentile or equalize (see stretchLut)
+    :arg list percentiles: Lower and upper percentiles of the percentile
+        stretch
+    :arg list bands: Numbers of the bands to be converted (None for all)
+    :arg int verbose: If the information of the image is printed
+    :returns: 0 on success, 1 if the image can't be opened
+    :rtype: int
+    """
+    #Opening file
+    dataset = gdal.Open(fileName, GA_ReadOnly)
+    if dataset is None:
+        print 'Error opening file!', fileName
+        return 1
+    if bands is None:
+        bands = range(1, dataset.RasterCount + 1)
+    for item in bands:
+        if item < 1 or item > dataset.RasterCount:
+            print 'Band', item, 'not found in', fileName
+            return 1
+
+    #Getting dataset information
+    if verbose == 1:
+        print 'Driver: ', dataset.GetDriver().ShortName,'/', \
+              dataset.GetDriver().LongName
+        print 'Size is ', dataset.RasterXSize,'x',dataset.RasterYSize, \
+              'x',dataset.RasterCount
+        print 'Projection is ', dataset.GetProjection()
+
+        geotransform = dataset.GetGeoTransform()
+        if not geotransform is None:
+            print 'Origin = (', geotransform[0], ',', geotransform[3],')'
+            print 'Pixel Size = (', geotransform[1], ',', geotransform[5],')'
+
+        #Fetching the Raster Bands
+        print 'Number of bands = ', dataset.RasterCount
+
+    #Cria o arquivo destino
+    tempName = destinyName+'.tmp'
+    #A failed conversion doesn't leave the temporary image behind
+    try:
+        driver = gdal.GetDriverByName("GTiff")
+        dest = driver.Create(tempName, dataset.RasterXSize, \
+            dataset.RasterYSize, len(bands), gdal.GDT_Byte, \
+            rasterTools.creationOptions("GTiff", gdal.GDT_Byte))
+        dest.SetProjection(dataset.GetProjection())
+        dest.SetGeoTransform(dataset.GetGeoTransform())
+
+        for item in range(len(bands)):
+            band = dataset.GetRasterBand(bands[item])
+            destBand = dest.GetRasterBand(item+1)
+            if verbose == 1:
+                print 'Band Type = ', gdal.GetDataTypeName(band.DataType)
+                if band.GetOverviewCount() > 0:
+                    print 'Band has ', band.GetOverviewCount(), ' overviews.'
+                if not band.GetRasterColorTable() is None:
+                    print 'Band has a color table with ', \
+                          band.GetRasterColorTable().GetCount(), ' entries.'
+            if band.DataType in [GDT_Byte, GDT_UInt16, GDT_Int16]:
+                #Pass 1: histogram; pass 2: table applied block by block
+                histogram = bandHistogram(band)
+                lut = stretchLut(histogram, histogramOffset(band), stretch, percentiles)
+                #Fill pixels stay black, as negative values did before
+                if noDataIndex(band) is not None:
+                    lut[noDataIndex(band)] = 0
+                applyLut(band, destBand, lut)
+            else:
+                (low, high, scale) = bandScale(band)
+                if verbose == 1:
+                    print 'Min = %.3f, Max = %.3f' % (low, high)
+                convertBand(band, destBand, low, high, scale)
+
+        #Internal overviews, so the map server reads only the level it draws
+        rasterTools.buildOverviews(dest)
+
+        #Closing properly to write things down (bands keep their datasets open)
+        band = None
+        destBand = None
+        dataset = None
+        dest = None
+        os.rename(tempName, destinyName)
+    finally:
+        band = None
+        destBand = None
+        dest = None
+        if os.path.exists(tempName):
+            os.remove(tempName)
+    return 0
+
+def fileChecksum(fileName, blockSize = 1024 * 1024):
+    """
+    MD5 of a file, read in blocks
+
+    :arg string fileName: The file
+    :arg int blockSize: Number of bytes read at a time
+    :returns: Hexadecimal digest
+    :rtype: string
+    """
+    digest = hashlib.md5()
+    f = open(fileName, 'rb')
+    data = f.read(blockSize)
+    while data:
+        digest.update(data)
+        data = f.read(blockSize)
+    f.close()
+    return digest.hexdigest()
+
+def conversionKey(fileName, stretch, percentiles, bands):
+    """
+    Identifies a conversion by the checksum of the image and the options
+
+    :arg string fileName: Image to be converted
+    :arg string stretch: Stretch used
+    :arg list percentiles: Percentiles of the percentile stretch
+    :arg list bands: Bands converted (None for all)
+    :returns: The key, kept in destinyName + '.md5'
+    :rtype: string
+    """
+    return " ".join([fileChecksum(fileName), stretch, \
+        ",".join([str(value) for value in percentiles]), \
+        ",".join([str(value) for value in (bands or [])])])
+
+def isUpToDate(fileName, destinyName, skipMode, key = None):
+    """
+    If the 8 bit image of an image doesn't need to be converted again
+
+    :arg string fileName: Image to be converted
+    :arg string destinyName: 8 bit image
+    :arg string skipMode: mtime (newer than the image), checksum (same
+        key as the last conversion) or none (always convert)
+    :arg string key: Key of the conversion (see conversionKey)
+    :returns: True if the conversion can be skipped
+    :rtype: bool
+    """
+    if skipMode == 'none' or not os.path.isfile(destinyName):
+        return False
+    if skipMode == 'mtime':
+        return os.path.getmtime(destinyName) >= os.path.getmtime(fileName)
+    if not os.path.isfile(destinyName+'.md5'):
+        return False
+    f = open(destinyName+'.md5', 'r')
+    lastKey = f.read().strip()
+    f.close()
+    return lastKey == key
+
+def convertJob(job):
+    """
+    Converts one image of a batch, unless it is up to date, catching its
+    errors so one failing image doesn't stop the others
+
+    :arg list job: fileName, destinyName, stretch, percentiles, bands and
+        skipMode
+    :returns: Image, status (converted, skipped or failed), number of
+        bytes of the image, elapsed time and error message
+    :rtype: list
+    """
+    fileName, destinyName, stretch, percentiles, bands, skipMode = job
+    startTime = time.time()
+    try:
+        key = None
+        if skipMode == 'checksum':
+            key = conversionKey(fileName, stretch, percentiles, bands)
+        if isUpToDate(fileName, destinyName, skipMode, key):
+            return fileName, 'skipped', 0, time.time() - startTime, None
+        if convert16bit8bit(fileName, destinyName, stretch, percentiles, \
+            bands, 0) != 0:
+            return fileName, 'failed', 0, time.time() - startTime, 'conversion failed'
+        if key is not None:
+            f = open(destinyName+'.md5', 'w')
+            f.write(key+"\n")
+            f.close()
+        return fileName, 'converted', os.path.getsize(fileName), \
+            time.time() - startTime, None
+    except Exception, exception:
+        return fileName, 'failed', 0, time.time() - startTime, str(exception)
+
+#######################
+# Begin of the script #
+#######################
+
+if __name__ == "__main__":
+
+    # Arguments for the application
+    usage = "usage: %prog arg1 arg2 ..."
+    parser = OptionParser(usage)
+
+    parser.add_option("-i", "--input", dest="inputGlob", \
+        help="Images to be converted (glob, e.g. '/data/*.sur_refl_b0?.tif')", \
+        metavar="INPUT")
+    parser.add_option("-o", "--output-directory", dest="destDir", \
+        help="Directory for the 8 bit images", metavar="DESTDIR")
+    parser.add_option("-b", "--bands", dest="bands", \
+        help="Comma separated list of bands to be converted (default: all)", \
+        metavar="BANDS")
+    parser.add_option("-s", "--stretch", dest="stretch", type="choice", \
+        choices=['linear', 'percentile', 'equalize'], \
+        help="Stretch: linear, percentile or equalize", metavar="STRETCH")
+    parser.add_option("-u", "--up-to-date", dest="skipMode", type="choice", \
+        choices=['mtime', 'checksum', 'none'], \
+        help="Skip images already converted: mtime, checksum or none", \
+        metavar="SKIPMODE")
+    parser.add_option("-j", "--processes", type="int", dest="numberWorkers", \
+        help="Number of images converted at the same time", \
+        metavar="NUMBERWORKERS")
+
+    (options, args) = parser.parse_args()
+
+    if options.inputGlob:
+        inputGlob = options.inputGlob
+    else:
+        inputGlob = '/home/eduardo/Testes/NASA/img.sur_refl_b06.tif'
+    if options.destDir:
+        destDir = options.destDir
+    else:
+        destDir = None
+    if options.bands:
+        bands = [int(item) for item in options.bands.split(',')]
+    else:
+        bands = None
+    if options.stretch:
+        stretch = options.stretch
+    else:
+        stretch = 'percentile'
+    if options.skipMode:
+        skipMode = options.skipMode
+    else:
+        skipMode = 'mtime'
+    if options.numberWorkers:
+        numberWorkers = options.numberWorkers
+    else:
+        numberWorkers = multiprocessing.cpu_count()
+
+    #Each image is a job; the 8 bit image goes to the output directory
+    #(or next to the image) with the suffix _8bit, which is never converted
+    #again when the output goes next to the images
+    fileNames = sorted([fileName for fileName in glob.glob(inputGlob) \
+        if not fileName.endswith('_8bit.tif')])
+    if fileNames == []:
+        print "No images found: ", inputGlob
+        sys.exit(1)
+    if destDir is not None and not os.path.isdir(destDir):
+        os.makedirs(destDir)
+    jobs = []
+    for fileName in fileNames:
+        outputDir = destDir or os.path.dirname(fileName)
+        destinyName = os.path.join(outputDir, \
+            os.path.splitext(os.path.basename(fileName))[0]+'_8bit.tif')
+        jobs.append((fileName, destinyName, stretch, STRETCH_PERCENTILES, \
+            bands, skipMode))
 
-#Opening file
-fileName = '/home/eduardo/Testes/NASA/img.sur_refl_b06.tif'
-dataset = gdal.Open(fileName, GA_ReadOnly)
-if dataset is None:
-    print 'Error opening file!'
-    exit
-
-#Creating copy
-destinyName = '/home/eduardo/Testes/NASA/img.sur_refl_b06_8bit.tif'
-
-#Getting dataset information
-print 'Driver: ', dataset.GetDriver().ShortName,'/', \
-      dataset.GetDriver().LongName
-print 'Size is ', dataset.RasterXSize,'x',dataset.RasterYSize, \
-      'x',dataset.RasterCount
-print 'Projection is ', dataset.GetProjection()
-
-geotransform = dataset.GetGeoTransform()
-if not geotransform is None:
-    print 'Origin = (', geotransform[0], ',', geotransform[3],')'
-    print 'Pixel Size = (', geotransform[1], ',', geotransform[5],')'
-
-#Fetching the Raster Bands
-print 'Number of bands = ', dataset.RasterCount
-
-#Cria o arquivo destino
-driver = gdal.GetDriverByName("GTiff")
-dest = driver.Create(destinyName, dataset.RasterXSize, \
-    dataset.RasterYSize, dataset.RasterCount, gdal.GDT_Byte)
-
-for item in range(dataset.RasterCount):
-    band = dataset.GetRasterBand(item+1)
-    print 'Band Type = ', gdal.GetDataTypeName(band.DataType)
-    min = band.GetMinimum()
-    max = band.GetMaximum()
-    print 'data 1: ', min, max
-    if min is None or max is None:
-        (min,max) = band.ComputeRasterMinMax(1)
-    print 'Min = %.3f, Max = %.3f' % (min,max)
-    if band.GetOverviewCount() > 0:
-        print 'Band has ', band.GetOverviewCount(), ' overviews.'
-    if not band.GetRasterColorTable() is None:
-        print 'Band has a color table with ', \
-              band.GetRasterColorTable().GetCount(), ' entries.'
-    rasterData = dataset.ReadAsArray(0,0,dataset.RasterXSize, dataset.RasterYSize)
-    print rasterData
-    print ''
-    rasterData2 = numpy.clip(rasterData,0,rasterData.max())
-    print rasterData2
-    print ''
-    #~ rasterDataTest = rasterData
-    #~ rasterDataTest = rasterDataTest.astype(numpy.double)
-    #~ rasterDataTest = rasterDataTest/10000.0
-    #~ minTest = rasterDataTest.min()
-    #~ maxTest = rasterDataTest.max()
-    #~ rasterDataTest = ((255-0)*((rasterData-minTest)/(maxTest-minTest)))+0
-    #~ rasterDataTest = rasterDataTest.astype(numpy.uint8)
-    #~ print minTest, maxTest
-    #~ print rasterDataTest
-    #~ print rasterData
-    min2 = float(rasterData2.min())
-    max2 = float(rasterData2.max())
-    print 'data 2: ', min2, max2
-    rasterData2 = ((255-0)*((rasterData2-min2)/(max2-min2)))+0
-    rasterData2 = rasterData2.astype(numpy.uint8)
-    rasterData = ((255-0)*((rasterData-min)/(max-min)))+0
-    rasterData = rasterData.astype(numpy.uint8)
-    print rasterData2
-    dest.GetRasterBand(item+1).WriteArray(rasterData2)
-    #~ dest.GetRasterBand(item+1).ComputeStatistics(False)
-
-dest.SetProjection(dataset.GetProjection())
-dest.SetGeoTransform(dataset.GetGeoTransform())
-
-#Only blue
-#~ onlyBlue = 1
-#~ if onlyBlue:
-    #~ print "Let's play!"
-    #~ for itemX in range(dataset.RasterXSize):
-        #~ for itemY in range(dataset.RasterYSize):
-            #~ if values[0][itemX][itemY] != 73:
-                #~ values[0][itemX][itemY] = 0
-                #~ #print 'Value change!'
-
-#Printing some info
-#print values[0][0][0], values[1][0][0], values[2][0][0]
-
-#Set new values
-#~ dest.GetRasterBand(1).WriteArray(values)
-
-#Closing properly to write things down
-dataset = None
-dest = None
+    startTime = time.time()
+    pool = multiprocessing.Pool(min(numberWorkers, len(jobs)))
+    counts = {'converted':0, 'skipped':0, 'failed':0}
+    totalBytes = 0
+    numberDone = 0
+    for fileName, status, numberBytes, elapsedTime, error in \
+        pool.imap_unordered(convertJob, jobs):
+        numberDone = numberDone + 1
+        counts[status] = counts[status] + 1
+        totalBytes = totalBytes + numberBytes
+        message = "[%d/%d] %s: %s (%.1f s)" % (numberDone, len(jobs), \
+            os.path.basename(fileName), status, elapsedTime)
+        if error is not None:
+            message = message + " - " + error
+        print message
+    pool.close()
+    pool.join()
 
+    #Throughput of the images converted
+    elapsedTime = max(time.time() - startTime, 1e-6)
+    print ""
+    print "Converted: %d, skipped: %d, failed: %d" % (counts['converted'], \
+        counts['skipped'], counts['failed'])
+    print "Total time: %.1f s" % elapsedTime
+    print "Throughput: %.1f MB/s, %.1f scenes/min" % \
+        (totalBytes / elapsedTime / (1024 * 1024), \
+        counts['converted'] * 60.0 / elapsedTime)
+    if counts['failed'] > 0:
+        sys.exit(1)
+    sys.exit(0)
@@ -17,6 +17,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import rasterTools
 from osgeo import ogr, osr, gdal
 
 #Import easy to use xml parser called minidom (Ex.: http://www.travisglines.com/web-coding/python-xml-parser-tutorial):
@@ -57,6 +58,9 @@ imageDir = '/home/eduardo/Testes/fw_img/test/'
 #Get the name of every file in the directory
 dirList = os.listdir(imageDir)
 
+#Cuts are read in this process, opening each image only once
+cutter = rasterTools.WindowCutter()
+
 #For every file in directory
 for fname in dirList:
   
@@ -100,13 +104,13 @@ for fname in dirList:
                 idSquare = 'Img_'+str(itemX)+'_'+str(itemY)
                 outName = outputDir+idSquare+'_'+imageFile[0:-4]+outputExt
                 print idSquare+': ', pixelXini, pixelYini
-                cmd = 'gdal_translate -of '+outputType+' -srcwin '+str(pixelXini)+' '+str(pixelYini)+' '+str(sizeSquareX)+' '+str(sizeSquareY)+' '+imageDir+imageFile+' '+outName
-                print cmd
-                print ''
-                os.system(cmd)
+                cutter.cutWindow(imageDir+imageFile, pixelXini, pixelYini, sizeSquareX, sizeSquareY, outName, outputType)
                 pixelYini = pixelYini + sizeSquareY
                 [widthCut, heightCut, minXcut, maxXcut, minYcut, maxYcut] = getLatLon(outName)
                 print 'Upper Left: ', minXcut, maxYcut
                 print 'Lower Right: ', maxXcut, minYcut
                 print ''
             pixelXini = pixelXini + sizeSquareX
+
+        #Close the image before going to the next one
+        cutter.close()
@@ -16,8 +16,13 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import sys
 import ogr
+import time
+import vectorTools
+import multiprocessing
+from optparse import OptionParser
 
 #Desired states
 listStates = ['AC', 'AM', 'AP', 'MA', 'MT', 'PA', 'RO', 'RR', 'TO']
@@ -25,78 +30,199 @@ listStates = ['AC', 'AM', 'AP', 'MA', 'MT', 'PA', 'RO', 'RR', 'TO']
 #Desired classes
 listClasses = ['FLORESTA', 'HIDROGRAFIA']
 
-#Loop in list of desired states
-for desState in listStates:
-
-    #Loop in list of desired classes
+#Field with the class of each feature
+classField = 'mainclass'
+
+#Output format (shp, gpkg or fgb)
+outputFormat = 'shp'
+
+def stateFileName(inputRoot, state):
+    """
+    Name of the PRODES shapefile of a state
+
+    :arg string inputRoot: Directory with the directories of the states
+    :arg string state: State (e.g. PA)
+    :returns: Name of the shapefile
+    :rtype: string
+    """
+    return os.path.join(inputRoot, "PDigital2000_2011_"+state+"_shp", \
+        "PDigital2011_"+state+"_pol.shp")
+
+def classFileName(inputRoot, outputRoot, state, desClass):
+    """
+    Name (without extension) of the file with the features of a class
+    of a state. Without an output root it goes to the directory new of
+    the state.
+
+    :arg string inputRoot: Directory with the directories of the states
+    :arg string outputRoot: Directory for the results (None for new/)
+    :arg string state: State (e.g. PA)
+    :arg string desClass: Class (e.g. FLORESTA)
+    :returns: Name of the file
+    :rtype: string
+    """
+    if outputRoot is None:
+        outputDir = os.path.join(inputRoot, "PDigital2000_2011_"+state+"_shp", "new")
+    else:
+        outputDir = outputRoot
+    return os.path.join(outputDir, desClass+"_PDigital2011_"+state+"_pol")
+
+def extractState(inputRoot, outputRoot, state, listClasses, classField, \
+    outputFormat):
+    """
+    Writes the features of each class of a state to its own file, in one
+    read pass over the state shapefile filtered by class
+
+    :arg string inputRoot: Directory with the directories of the states
+    :arg string outputRoot: Directory for the results (None for new/)
+    :arg string state: State (e.g. PA)
+    :arg list listClasses: Desired classes
+    :arg string classField: Field with the class of each feature
+    :arg string outputFormat: Output format (shp, gpkg or fgb)
+    :returns: Number of features written for each class
+    :rtype: dictionary
+    """
+    #Opens the shapefile and test the openning procedure
+    fileName = stateFileName(inputRoot, state)
+    origFile = ogr.Open(fileName)
+    if origFile is None:
+        raise IOError("Open failed: "+fileName)
+
+    #Reads the layer and its definition
+    origLayer = origFile.GetLayer()
+    layer_def = origLayer.GetLayerDefn()
+    field_names = [layer_def.GetFieldDefn(i).GetName() for i in range (layer_def.GetFieldCount())]
+    if layer_def.GetFieldIndex(classField) < 0:
+        raise ValueError("Field not found: "+classField+" (fields available: "+ \
+            ", ".join(field_names)+")")
+
+    #Set the new files to be written (one per class), with the same fields
+    fields = [layer_def.GetFieldDefn(i) for i in range (layer_def.GetFieldCount())]
+    if outputRoot is not None and not os.path.isdir(outputRoot):
+        os.makedirs(outputRoot)
+    destFiles = {}
+    writers = {}
     for desClass in listClasses:
-
-        #Set the name to be openned
-        fileName = "/home/eduardo/ShapeFiles/PRODES/estados/PDigital2000_2011_"+desState+"_shp/PDigital2011_"+desState+"_pol.shp"
-
-        #Opens the shapefile and test the openning procedure
-        origFile = ogr.Open(fileName)
-        if origFile is None:
-            print "Open failed.\n"
-            print fileName
-            sys.exit(1)
-
-        #Set the new file to be written (initially a copy of the original)
-        destName = "/home/eduardo/ShapeFiles/PRODES/estados/PDigital2000_2011_"+desState+"_shp/new/"+desClass+"_PDigital2011_"+desState+"_pol.shp"
-        driveName = "ESRI Shapefile"
-        driver = ogr.GetDriverByName(driveName)
-        if driver is None:
-            print "Driver not available!\n"
-            sys.exit(1)
-        destFile = driver.CopyDataSource(origFile,destName)
-
-        #Close file
-        origFile = None
-
-        #Informs the user
-        print "File copied..."
-        print ""
-
-        #Reads the layer
-        layer = destFile.GetLayer()
-        print "Name of the layer: ", layer.GetName()
-        print ""
-
-        #Reads the layer definition
-        layer_def = layer.GetLayerDefn()
-
-        #Get the fields names
-        field_names = [layer_def.GetFieldDefn(i).GetName() for i in range (layer_def.GetFieldCount())]
-        print "Field names available: ", field_names
-        print ""
-
-        #Get the number of features
-        numberFeatures = layer.GetFeatureCount()
-        print "Number of features :", numberFeatures
-        print ""
-
-        #Let's count the number of desired features
-        counter = 0
-        for i in range(numberFeatures):
-            feature = layer.GetNextFeature()
-            classFeature = feature.GetFieldAsString(6)
-            if classFeature == desClass:
-                counter = counter + 1
-            else:
-                lfid = feature.GetFID()
-                errorCode = layer.DeleteFeature(lfid)
-                if errorCode != 0:
-                    print "Error deleting feature.\n"
-                    sys.exit(1)
-            feature.Destroy()
-        print "Number of new features: ", counter
-
-        #Repack SQL
-        destFile.ExecuteSQL("REPACK " + layer.GetName())
-
-        #Close file
-        destFile = None
-
-#Program ends correctly
-sys.exit(0)
-
+        destName = classFileName(inputRoot, outputRoot, state, desClass)
+        destFiles[desClass] = vectorTools.createLayer(destName, origLayer.GetName(), \
+            origLayer.GetSpatialRef(), origLayer.GetGeomType(), outputFormat, fields)
+        writers[desClass] = vectorTools.FeatureWriter(destFiles[desClass][1])
+
+    #One read pass: only the features of the desired classes are read,
+    #and each one is written to the layer of its class
+    origLayer.SetAttributeFilter(classField+" IN ('"+"', '".join(listClasses)+"')")
+    feature = origLayer.GetNextFeature()
+    while feature is not None:
+        classFeature = feature.GetFieldAsString(classField)
+        if classFeature in writers:
+            writers[classFeature].copy(feature)
+        feature.Destroy()
+        feature = origLayer.GetNextFeature()
+
+    #Close files
+    counts = {}
+    for desClass in listClasses:
+        writers[desClass].close()
+        counts[desClass] = writers[desClass].count
+        vectorTools.closeLayer(destFiles[desClass][0], destFiles[desClass][1])
+    origFile = None
+    return counts
+
+def extractJob(job):
+    """
+    Runs extractState for one state, catching its errors so one failing
+    state doesn't stop the others
+
+    :arg list job: Arguments of extractState
+    :returns: State, number of features of each class (None on failure),
+        elapsed time and error message (None on success)
+    :rtype: list
+    """
+    state = job[2]
+    startTime = time.time()
+    try:
+        counts = extractState(*job)
+        error = None
+    except Exception, exception:
+        counts = None
+        error = str(exception)
+    return state, counts, time.time() - startTime, error
+
+#######################
+# Begin of the script #
+#######################
+
+if __name__ == "__main__":
+
+    # Arguments for the application
+    usage = "usage: %prog arg1 arg2 ..."
+    parser = OptionParser(usage)
+
+    parser.add_option("-i", "--input-root", dest="inputRoot", \
+        help="Directory with the PRODES directories of the states", metavar="INPUTROOT")
+    parser.add_option("-o", "--output-root", dest="outputRoot", \
+        help="Directory for the results (default: new/ of each state)", \
+        metavar="OUTPUTROOT")
+    parser.add_option("-s", "--states", dest="states", \
+        help="Comma separated list of states", metavar="STATES")
+    parser.add_option("-c", "--classes", dest="classes", \
+        help="Comma separated list of classes", metavar="CLASSES")
+    parser.add_option("-f", "--class-field", dest="classField", \
+        help="Field with the class of each feature", metavar="CLASSFIELD")
+    parser.add_option("-t", "--output-format", dest="outputFormat", \
+        help="Format of the results: shp, gpkg or fgb", metavar="FORMAT")
+    parser.add_option("-j", "--processes", type="int", dest="numberWorkers", \
+        help="Number of states extracted at the same time", \
+        metavar="NUMBERWORKERS")
+
+    (options, args) = parser.parse_args()
+
+    if options.inputRoot:
+        inputRoot = options.inputRoot
+    else:
+        inputRoot = "/home/eduardo/ShapeFiles/PRODES/estados/"
+    if options.outputRoot:
+        outputRoot = options.outputRoot
+    else:
+        outputRoot = None
+    if options.states:
+        listStates = options.states.split(',')
+    if options.classes:
+        listClasses = options.classes.split(',')
+    if options.classField:
+        classField = options.classField
+    if options.outputFormat:
+        outputFormat = options.outputFormat
+    if options.numberWorkers:
+        numberWorkers = options.numberWorkers
+    else:
+        numberWorkers = min(multiprocessing.cpu_count(), len(listStates))
+
+    #Each state is a job; they are reported as they finish
+    jobs = [(inputRoot, outputRoot, state, listClasses, classField, outputFormat) \
+        for state in listStates]
+    startTime = time.time()
+    failures = []
+    pool = multiprocessing.Pool(numberWorkers)
+    numberDone = 0
+    for state, counts, elapsedTime, error in pool.imap_unordered(extractJob, jobs):
+        numberDone = numberDone + 1
+        if error is None:
+            print "[%d/%d] %s: %s (%.1f s)" % (numberDone, len(jobs), state, \
+                ", ".join([desClass+" = "+str(counts[desClass]) for desClass in listClasses]), \
+                elapsedTime)
+        else:
+            print "[%d/%d] %s: FAILED - %s (%.1f s)" % (numberDone, len(jobs), \
+                state, error, elapsedTime)
+            failures.append(state)
+    pool.close()
+    pool.join()
+
+    print ""
+    print "Total time: %.1f s" % (time.time() - startTime)
+    if failures != []:
+        print "Failed states: ", ", ".join(failures)
+        sys.exit(1)
+
+    #Program ends correctly
+    sys.exit(0)
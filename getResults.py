@@ -16,61 +16,54 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import json
-import urllib2
+import sys
+import time
+import numpy
+import resource
+import multiprocessing
+import answerStore
+import snapshot
+import pybossaClient
 from optparse import OptionParser
 
-def getAppId(server, appName):
+def normaliseAnswer(info):
     """
-    Get the application id given the short name
+    Answer of a task run as kept in the store. Answers that are not a
+    string (e.g. a dict in info) are counted as No, as genStats always
+    counted every answer other than Yes.
 
-    :arg string server: Address of the server
-    :arg string appName: Short name of the application
-    :returns: Numerical id of the application
-    :rtype: integer
-    """
-    JSONdata = urllib2.urlopen(server+"/api/app?short_name="+appName)
-    data = json.load(JSONdata)
-    appId = data[0]['id']
-    return appId
-
-def getTasks(server, appId):
+    :arg info: The info of the task run
+    :returns: The answer
+    :rtype: string
     """
-    Get the tasks of a particular application from the server.
+    if isinstance(info, basestring):
+        return info
+    return 'No'
 
-    :arg string server: Address of the server
-    :arg string appID: ID of the application to be analysed
-    :returns: Tasks for the applcation
-    :rtype: dictionary
-    """
-    JSONdata = urllib2.urlopen(server+"/api/task?app_id="+str(appId))
-    data = json.load(JSONdata)
-    numberTasks = len(data)
-    taskId = []
-    for item in range(numberTasks):
-        taskId.append(data[item]['id'])
-    return taskId
-
-def getResults(server, appID, tasksId):
+def getResults(server, appID, tasksId, bulk = None, spillDir = None):
     """
     Get the results of a particular application from the server.
 
     :arg string server: Address of the server
     :arg string appID: ID of the application to be analysed
     :arg list taskId: List of task ID
+    :arg int bulk: If the answers are downloaded for the whole app (None for auto)
+    :arg string spillDir: Directory to keep the answers memory-mapped (None for memory)
     :returns: Results for the application
-    :rtype: dictionary
+    :rtype: AnswerStore
     """
-    answersApp = {}
     numberTasks = len(tasksId)
-    idxData = 0
+    #Each task run is reduced to its answer as soon as it is parsed
+    convert = lambda taskRun: (taskRun['task_id'], taskRun['id'], \
+        normaliseAnswer(taskRun['info']))
+    dataTasks, fetcher = pybossaClient.getTaskRuns(server, appID, tasksId, \
+        bulk=bulk, convert=convert)
+    answersApp = answerStore.AnswerStore()
     for item in range(numberTasks):
-        JSONdata = urllib2.urlopen(server+"/api/taskrun?app_id="+str(appID)+"&task_id="+str(tasksId[item]))
-        data = json.load(JSONdata)
-        lenData = len(data)
-        for ans in range(lenData):
-            answersApp[idxData] = {'taskId':data[ans]['task_id'], 'id':data[ans]['id'], 'answer':data[ans]['info']}
-            idxData = idxData + 1
+        answersApp.extend(dataTasks[item])
+        dataTasks[item] = None
+    if spillDir is not None:
+        answersApp.spill(spillDir)
     return answersApp
 
 def genStats(taskId, data, printStats = 0):
@@ -78,32 +71,118 @@ def genStats(taskId, data, printStats = 0):
     Calculate statistics about the results
 
     :art list taskId: List of unique tasks
-    :arg dict data: Dictionary with all the results.
+    :arg AnswerStore data: Store with all the results.
 
-    :returns: Some basic statistics about the results
-    :rtype: Nothing so far
+    :returns: Number of Yes and No votes for each task
+    :rtype: dictionary
     """
     numberTasks = len(taskId)
-    numberResults = len(data)
-    #This structure for search is not efficient. Must replace!!!
+    #Every answer other than Yes is a No
+    voteYes = data.counts(taskId, ['Yes'])[:, 0]
+    voteAll = data.counts(taskId).sum(axis=1)
+    stats = {}
     for task in range(numberTasks):
-        voteYes = 0
-        voteNo = 0
-        for result in range(numberResults):
-            if data[result]['taskId'] == taskId[task]:
-                if data[result]['answer'] == 'Yes':
-                    voteYes = voteYes + 1
-                else:
-                    voteNo = voteNo + 1
-        #Print info for debugging
-        if printStats == 1:
+        stats[taskId[task]] = {'Yes':int(voteYes[task]), \
+            'No':int(voteAll[task] - voteYes[task])}
+    #Print info for debugging
+    if printStats == 1:
+        for task in range(numberTasks):
             print "Stats for task " + str(taskId[task])
-            print "Yes = " + str(voteYes)
-            print "No = " + str(voteNo)
+            print "Yes = " + str(stats[taskId[task]]['Yes'])
+            print "No = " + str(stats[taskId[task]]['No'])
             print ""
-    stats = 'Done.'    
     return stats
 
+def benchmarkStats(numbersAnswers = [1000, 10000, 100000, 1000000], \
+    answersPerTask = 30):
+    """
+    Times genStats on synthetic Yes/No answers
+
+    :arg list numbersAnswers: Numbers of answers to be tallied
+    :arg int answersPerTask: Number of answers of each task
+    :returns: Seconds taken by genStats for each number of answers
+    :rtype: list
+    """
+    random = numpy.random.RandomState(0)
+    times = []
+    for numberAnswers in numbersAnswers:
+        numberTasks = max(1, numberAnswers / answersPerTask)
+        tasksId = range(1, numberTasks + 1)
+        answers = answerStore.AnswerStore(numberAnswers)
+        taskIds = random.randint(1, numberTasks + 1, numberAnswers)
+        votes = random.randint(0, 2, numberAnswers)
+        answers.extend([(taskIds[item], item + 1, ['No', 'Yes'][votes[item]]) \
+            for item in range(numberAnswers)])
+        start = time.time()
+        stats = genStats(tasksId, answers)
+        times.append(time.time() - start)
+        if sum([stats[task]['Yes'] for task in stats]) != votes.sum():
+            raise ValueError("Wrong number of Yes votes")
+        print "%d answers, %d tasks: %.1f ms" % (numberAnswers, numberTasks, \
+            times[-1] * 1000)
+    return times
+
+def measureAnswers(structure, numberAnswers, answersPerTask, queue):
+    """
+    Keeps synthetic Yes/No answers in a list of dicts (as getResults
+    used to) or in an AnswerStore, and puts the peak RSS (MB) of this
+    process at start and at the end in the queue. It is run in a process
+    of its own, so the peak is that of one structure only. The answers
+    are made task by task, so only the structure kept is measured.
+
+    :arg string structure: dicts or store
+    :arg int numberAnswers: Number of answers
+    :arg int answersPerTask: Number of answers of each task
+    :arg multiprocessing.Queue queue: Queue for the measures
+    """
+    startRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    random = numpy.random.RandomState(0)
+    votes = random.randint(0, 2, numberAnswers)
+    if structure == 'dicts':
+        answersApp = {}
+    else:
+        answersApp = answerStore.AnswerStore()
+    for start in range(0, numberAnswers, answersPerTask):
+        taskId = start / answersPerTask + 1
+        #A new string for each answer, as the JSON parser gives them
+        answers = [(taskId, item + 1, u'%s' % ['No', 'Yes'][votes[item]]) \
+            for item in range(start, min(start + answersPerTask, numberAnswers))]
+        if structure == 'dicts':
+            for answer in answers:
+                answersApp[len(answersApp)] = {'taskId':answer[0], \
+                    'id':answer[1], 'answer':answer[2]}
+        else:
+            answersApp.extend(answers)
+    peakRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    queue.put((len(answersApp), startRss, peakRss))
+
+def benchmarkAnswers(numberAnswers = 2000000, answersPerTask = 30):
+    """
+    Measures the memory taken by the same synthetic answers in a list of
+    dicts and in an AnswerStore
+
+    :arg int numberAnswers: Number of answers
+    :arg int answersPerTask: Number of answers of each task
+    :returns: Peak RSS growth (MB) of the list of dicts and of the store
+    :rtype: list
+    """
+    footprints = []
+    for structure in ['dicts', 'store']:
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=measureAnswers, \
+            args=(structure, numberAnswers, answersPerTask, queue))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            raise ValueError("Measuring the "+structure+" failed")
+        size, startRss, peakRss = queue.get()
+        footprints.append(peakRss - startRss)
+        print "%s: %d answers, peak RSS %.1f MB (%.1f MB at start)" % \
+            (structure, size, peakRss, startRss)
+    print "AnswerStore: %.1fx less memory than the list of dicts" % \
+        (footprints[0] / max(footprints[1], 0.1))
+    return footprints
+
 #######################
 # Begin of the script #
 #######################
@@ -116,6 +195,10 @@ if __name__ == "__main__":
 
     parser.add_option("-s", "--server", dest="server", help="Address to the server", metavar="SERVER")
     parser.add_option("-n", "--app-name", dest="appName", help="Short name of the application", metavar="APPNAME")
+    parser.add_option("-k", "--cache-directory", dest="cacheDir", help="Directory for the cache of server responses", metavar="CACHEDIR")
+    parser.add_option("-p", "--snapshot", dest="snapshotFile", help="Snapshot to be used instead of the server", metavar="SNAPSHOT")
+    parser.add_option("-b", "--benchmark", action="store_true", dest="benchmark", help="Times genStats on 1k to 1M synthetic answers")
+    parser.add_option("-m", "--memory-benchmark", action="store_true", dest="memoryBenchmark", help="Measures the memory of 2M synthetic answers in dicts and in the store")
 
     (options, args) = parser.parse_args()
 
@@ -130,9 +213,24 @@ if __name__ == "__main__":
         appName = "filtering"
         #appName = "flickrperson"
 
+    #Only the benchmark, without the server
+    if options.benchmark:
+        benchmarkStats()
+        sys.exit(0)
+    if options.memoryBenchmark:
+        benchmarkAnswers()
+        sys.exit(0)
+
+    #Keeping the server responses between runs
+    if options.cacheDir:
+        pybossaClient.enableCache(options.cacheDir)
+    #Reading the data from a local snapshot
+    if options.snapshotFile:
+        pybossaClient.useSnapshot(snapshot.Snapshot(options.snapshotFile))
+
     #Get the data
-    appId = getAppId(server, appName)
-    tasksId = getTasks(server, appId)
+    appId = pybossaClient.getAppId(server, appName)
+    tasksId = [task['id'] for task in pybossaClient.getTasks(server, appId)]
     numberTasks = len(tasksId)
     print "Number of tasks:", numberTasks
     results = getResults(server, appId, tasksId)
@@ -20,362 +20,633 @@ import os
 import re
 import sys
 import gdal
+import numpy
 import json
 import time
 import shutil
-import urllib2
 import datetime
+import rasterTools
+import answerStore
+import snapshot
+import pybossaClient
 from gdalconst import *
 from optparse import OptionParser
 
-def getAppId(server, appName):
+#Colour ramp of the heat map by level of agreement: from red (no
+#agreement) to blue (full agreement)
+HEAT_RAMP = rasterTools.ColourRamp( \
+    [numpy.nextafter(0, 1), 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0], \
+    [[255, 0, 0], [229, 0, 0], [204, 0, 0], [178, 0, 0], [153, 0, 0], \
+    [127, 0, 0], [0, 0, 127], [0, 0, 153], [0, 0, 178], [0, 0, 204], \
+    [0, 0, 229], [0, 0, 255]])
+
+def convertTaskRun(taskRun):
     """
-    Get the application id given the short name
+    Reduces a task run to its answer as soon as it is parsed
 
-    :arg string server: Address of the server
-    :arg string appName: Short name of the application
-    :returns: Numerical id of the application
-    :rtype: integer
+    :arg dict taskRun: Task run, as given by the API
+    :returns: Task ID, task run ID and chosen day
+    :rtype: tuple
     """
-    JSONdata = urllib2.urlopen(url=server+"/api/app?short_name="+ \
-        appName).read()
-    data = json.loads(JSONdata)
-    appId = data[0]['id']
-    return appId
+    return taskRun['task_id'], taskRun['id'], taskRun['info']['besttile']
 
-def getTasks(server, appId, maxNumberTasks, completedOnly):
+def getNewResults(server, appId, tasksInfo, oldState, maxNumberAnswers, \
+    numberWorkers = 8):
     """
-    Get the tasks of a particular application from the server.
+    Gets only the answers given since the last run: the task runs after
+    the last one seen (paging with last_id, see snapshot.getNewItems),
+    plus every task run of the tasks the last run didn't have (e.g. tasks
+    completed since then)
 
     :arg string server: Address of the server
-    :arg string appId: ID of the application to be analysed
-    :arg integer maxNumberTasks: Maximum number of tasks to be downloaded
-    :arg int completedOnly: If we'll get only completed tasks
-    :returns: Tasks info for the application
-    :rtype: dictionary
+    :arg int appId: ID of the application to be analysed
+    :arg list tasksInfo: List of tasks
+    :arg dict oldState: State saved by the last run
+    :arg integer maxNumberAnswers: Maximum number of answers per task
+    :arg int numberWorkers: Number of simultaneous requests to the server
+    :returns: New answers of the tasks of tasksInfo and ID of the last
+        task run seen
+    :rtype: AnswerStore, int
     """
-    if completedOnly == 1:
-        JSONdata = urllib2.urlopen(url=server+"/api/task?app_id="+ \
-            str(appId)+"&state=completed&limit="+ \
-            str(maxNumberTasks)).read()
+    oldTasks = oldState['tasks']
+    newTasks = [task for task in tasksInfo if str(task['taskId']) not in oldTasks]
+    answers = answerStore.AnswerStore()
+    if newTasks != []:
+        print "Number of new tasks: ", len(newTasks)
+        answers = getResults(server, appId, newTasks, maxNumberAnswers, \
+            numberWorkers, 0, 0)
+    #Task runs after the last one seen, of the tasks already known
+    lastId = oldState['lastTaskRunId']
+    if pybossaClient.snapshotSource is not None:
+        taskRuns = pybossaClient.snapshotSource.getTaskRunsAfter(lastId)
     else:
-        JSONdata = urllib2.urlopen(url=server+"/api/task?app_id="+ \
-            str(appId)+"&limit="+str(maxNumberTasks)).read()
-    data = json.loads(JSONdata)
-    numberTasks = len(data)
-    tasksInfo = []
-    for item in range(numberTasks):
-        tasksInfo.append({'taskId':data[item]['id'], \
-            'area':data[item]['info']['tile']['restrictedExtent']})
-    return tasksInfo
+        taskRuns = snapshot.getNewItems(server, 'taskrun', appId, lastId)
+    numberNew = 0
+    for taskRun in taskRuns:
+        numberNew = numberNew + 1
+        lastId = max(lastId, taskRun['id'])
+        if str(taskRun['task_id']) in oldTasks:
+            answers.append(*convertTaskRun(taskRun))
+    print "Number of new task runs: ", numberNew
+    return answers, lastId
+
+def mergeResults(oldState, tasksInfo, answers, days, maxNumberAnswers):
+    """
+    Adds new answers to the task runs and vote vectors of the last run.
+    As in a full download, only the first maxNumberAnswers task runs of
+    a task are counted.
 
-def getResults(server, tasksInfo, maxNumberAnswers):
+    :arg dict oldState: State saved by the last run
+    :arg list tasksInfo: List of tasks
+    :arg AnswerStore answers: New answers, from getNewResults
+    :arg list days: Candidate days (the same of the last run)
+    :arg integer maxNumberAnswers: Maximum number of answers per task
+    :returns: Task run IDs of every task and matrix (tasks x days) with
+        the answers count, as runIdsByTask and genStats give them
+    :rtype: dictionary, numpy.ndarray
+    """
+    dayIndex = dict([(days[day], day) for day in range(len(days))])
+    newAnswers = {}
+    for item in range(len(answers)):
+        newAnswers.setdefault(int(answers.taskIds[item]), []).append( \
+            (int(answers.runIds[item]), \
+            answers.categories[answers.codes[item]]))
+    runs = {}
+    tileCount = numpy.zeros((len(tasksInfo), len(days)), dtype=numpy.int64)
+    for task in range(len(tasksInfo)):
+        taskId = tasksInfo[task]['taskId']
+        old = oldState['tasks'].get(str(taskId))
+        if old is not None:
+            runs[taskId] = list(old['runs'])
+            tileCount[task] = old['votes']
+        else:
+            runs[taskId] = []
+        seen = set(runs[taskId])
+        for runId, day in sorted(newAnswers.get(taskId, [])):
+            if runId in seen:
+                continue
+            if maxNumberAnswers is not None and \
+                len(runs[taskId]) >= maxNumberAnswers:
+                break
+            runs[taskId].append(runId)
+            seen.add(runId)
+            if day in dayIndex:
+                tileCount[task][dayIndex[day]] += 1
+    return runs, tileCount
+
+def getResults(server, appId, tasksInfo, maxNumberAnswers, \
+    numberWorkers = 8, printStats = 0, bulk = None, spillDir = None):
     """
     Get the results of a particular application from the server.
 
     :arg string server: Address of the server
-    :arg integer maxNumberAnswers: Maximum number of answers per task to be downloaded
+    :arg int appId: ID of the application to be analysed
     :arg list tasksInfo: List of tasks
+    :arg integer maxNumberAnswers: Maximum number of answers per task to be downloaded
+    :arg int numberWorkers: Number of simultaneous requests to the server
+    :arg int printStats: If the fetch statistics will be printed
+    :arg int bulk: If the answers are downloaded for the whole app (None for auto)
+    :arg string spillDir: Directory to keep the answers memory-mapped (None for memory)
     :returns: Results for the application
-    :rtype: dictionary
+    :rtype: AnswerStore
     """
-    answersApp = []
     numberTasks = len(tasksInfo)
+    tasksId = [tasksInfo[item]['taskId'] for item in range(numberTasks)]
+    dataTasks, fetcher = pybossaClient.getTaskRuns(server, appId, tasksId, \
+        maxNumberAnswers, numberWorkers, bulk, convertTaskRun)
+    answersApp = answerStore.AnswerStore()
     for item in range(numberTasks):
-        answersApp.append([])
-        JSONdata = urllib2.urlopen(url=server+"/api/taskrun?task_id="+ \
-            str(tasksInfo[item]['taskId'])+"&limit="+ \
-            str(maxNumberAnswers)).read()
-        data = json.loads(JSONdata)
-        lenData = len(data)
-        for ans in range(lenData):
-            answersApp[item].append({'taskId':data[ans]['task_id'], \
-            'id':data[ans]['id'], 'answer':data[ans]['info']['besttile']})
+        answersApp.extend(dataTasks[item])
+        dataTasks[item] = None
+    if spillDir is not None:
+        answersApp.spill(spillDir)
+    if printStats == 1:
+        fetcher.printStats()
     return answersApp
 
-def genStats(data, printStats = 0):
+def getCandidateDays(imagesDir):
+    """
+    Get the acquisition days that can be chosen as best tile, based on
+    the images available (e.g. 2011352.tif)
+
+    :arg string imagesDir: Directory with the original images
+    :returns: Sorted list of the candidate days
+    :rtype: list
+    """
+    files = os.listdir(imagesDir)
+    days = [f[:-4] for f in files if re.search('^[0-9]{7}\.tif$', f)]
+    days.sort()
+    return days
+
+def genStats(tasksId, data, days, printStats = 0):
     """
     Calculate statistics about the results
 
-    :arg list dict data: Dictionary list with all the results.
+    :arg list tasksId: List of the task IDs (rows of the matrix)
+    :arg AnswerStore data: Store with all the results.
+    :arg list days: Candidate days (answers for other days are ignored)
 
-    :returns: Matrix with answers count for each task
-    :rtype: list
+    :returns: Matrix (tasks x days) with answers count for each task
+    :rtype: numpy.ndarray
     """
-    tileCount = []
-    numberTasks = len(data)
-    for task in range(numberTasks):
-        tileCount.append([0] * 12)
-        numberResults = len(data[task])
-        for result in range(numberResults):
-            if data[task][result]['answer'] == '2011352':
-                tileCount[task][0] += 1
-            elif data[task][result]['answer'] == '2011353':
-                tileCount[task][1] += 1
-            elif data[task][result]['answer'] == '2011355':
-                tileCount[task][2] += 1
-            elif data[task][result]['answer'] == '2011357':
-                tileCount[task][3] += 1
-            elif data[task][result]['answer'] == '2011358':
-                tileCount[task][4] += 1
-            elif data[task][result]['answer'] == '2011359':
-                tileCount[task][5] += 1
-            elif data[task][result]['answer'] == '2011360':
-                tileCount[task][6] += 1
-            elif data[task][result]['answer'] == '2011361':
-                tileCount[task][7] += 1
-            elif data[task][result]['answer'] == '2011362':
-                tileCount[task][8] += 1
-            elif data[task][result]['answer'] == '2011363':
-                tileCount[task][9] += 1
-            elif data[task][result]['answer'] == '2011364':
-                tileCount[task][10] += 1
-            elif data[task][result]['answer'] == '2011365':
-                tileCount[task][11] += 1
-        #Print info for debug
-        if printStats == 1:
+    numberTasks = len(tasksId)
+    numberDays = len(days)
+    tileCount = data.counts(tasksId, days)
+    #Print info for debug
+    if printStats == 1:
+        for task in range(numberTasks):
             print "Stats for task " + str(task)
-            print "Tile 00 (352) = " + str(tileCount[task][0])
-            print "Tile 01 (353) = " + str(tileCount[task][1])
-            print "Tile 02 (355) = " + str(tileCount[task][2])
-            print "Tile 03 (357) = " + str(tileCount[task][3])
-            print "Tile 04 (358) = " + str(tileCount[task][4])
-            print "Tile 05 (359) = " + str(tileCount[task][5])
-            print "Tile 06 (360) = " + str(tileCount[task][6])
-            print "Tile 07 (361) = " + str(tileCount[task][7])
-            print "Tile 08 (362) = " + str(tileCount[task][8])
-            print "Tile 09 (363) = " + str(tileCount[task][9])
-            print "Tile 10 (364) = " + str(tileCount[task][10])
-            print "Tile 11 (365) = " + str(tileCount[task][11])
-            print "Maximum value = " + str(max(tileCount[task]))
-            print "Position = " + str(tileCount[task].index(max(tileCount[task])))
+            for day in range(numberDays):
+                print "Tile %02d (%s) = %d" % (day, days[day][-3:], \
+                    tileCount[task][day])
+            print "Maximum value = " + str(tileCount[task].max())
+            print "Position = " + str(tileCount[task].argmax())
             print ""
     return tileCount
 
-def cutBestTiles(tasksInfo, results, origLocation, destLocation, \
-    completedOnly, nAnswers = 0):
+def summarizeVotes(tileCount):
+    """
+    Best tile, number of votes, total of votes and level of agreement of
+    every task, computed at once from the matrix built by genStats
+
+    :arg numpy.ndarray tileCount: Matrix (tasks x days) with answers count
+    :returns: Arrays 'best', 'votes', 'total', 'agree' and the heat map
+        colours ('heatColours' and 'heatIndexes')
+    :rtype: dictionary
+    """
+    votes = tileCount.max(axis=1)
+    total = tileCount.sum(axis=1)
+    agree = numpy.zeros(len(total))
+    answered = total > 0
+    agree[answered] = votes[answered].astype(float) / total[answered]
+    summary = {'best':tileCount.argmax(axis=1), 'votes':votes, \
+        'total':total, 'agree':agree}
+    #Heat map colour of every task
+    summary['heatColours'] = HEAT_RAMP.lookup(agree)
+    summary['heatIndexes'] = HEAT_RAMP.paletteIndex(agree)
+    return summary
+
+def layerValues(summary, task, numberBands, heatPalette):
+    """
+    Constant values of a task in the intensity and heat maps
+
+    :arg dict summary: Votes of every task, from summarizeVotes
+    :arg int task: Position of the task
+    :arg int numberBands: Number of bands of the maps
+    :arg int heatPalette: If the heat map is a paletted band
+
+    :returns: Values of each band of the intensity and heat maps
+    :rtype: list
+    """
+    #Intensity map based on the number of votes of the best tile
+    votes = summary['votes'][task]
+    intensityValues = [0] * numberBands
+    intensityValues[1] = int(votes * 8)
+    #Heat map based on the level of agreement
+    totalVotes = summary['total'][task]
+    agree = summary['agree'][task]
+    print 'Task ', task, ' -> ', votes, totalVotes, agree
+    if heatPalette == 1:
+        heatValues = [summary['heatIndexes'][task]]
+    else:
+        heatValues = [0] * numberBands
+        heatValues[0:3] = summary['heatColours'][task]
+    return intensityValues, heatValues
+
+def cutBestTiles(tasksInfo, results, days, origLocation, destLocation, \
+    completedOnly, nAnswers = 0, heatPalette = 0):
     """
     Cut the best tiles based on the results obtained by genStats
 
     :arg list dict tasks: Dictionary list with the tasks info.
-    :arg list dict results: Dictionary list with the processed results.
+    :arg numpy.ndarray results: Matrix with the answers count from genStats.
+    :arg list days: Candidate days, as given to genStats.
     :arg string origLocation: Directory with orginal images.
     :arg string origLocation: Directory for the results.
     :arg int completedOnly: If we are processing only completed tasks
-    :arg int nAnswers: Mininum number of answers to be considered
+    :arg int nAnswers: Mininum number of answers to be considered. A list
+        builds one set of mosaics per value, reading each task only once.
+    :arg int heatPalette: If the heat map is one paletted band instead of
+        three RGB bands
 
-    :returns: Nothing
-    :rtype: None
+    :returns: 0 if every mosaic was built, 1 otherwise
+    :rtype: int
     """
-    tmpMosaic = destLocation+"/tmpMosaic_n"+str(nAnswers)+"/"
-    createDir(tmpMosaic)
-    tmpIntensity = destLocation+"/tmpIntensity_n"+str(nAnswers)+"/"
-    createDir(tmpIntensity)
-    tmpHeat = destLocation+"/tmpHeat_n"+str(nAnswers)+"/"
-    createDir(tmpHeat)
+    if isinstance(nAnswers, list):
+        listAnswers = nAnswers
+    else:
+        listAnswers = [nAnswers]
 
     intensity = 1
     heat = 1
-    formatFile = "GTiff"
-    driver = gdal.GetDriverByName(formatFile)
 
-    #Open file containing geoinfo on best result
-    if completedOnly == 1:
-        f = open(destLocation+'/bestInfo.txt','w')
+    #Source images stay open while the tasks are cut
+    cutter = rasterTools.WindowCutter()
 
-    numberTasks = len(tasksInfo)
-    for task in range(numberTasks):
-        #Checking if the task has the mininum number of answers
-        if (sum(results[task]) < nAnswers):
-            #If it has not, lets go to the next task
-            continue
+    #Votes of every task and the tasks with the mininum number of answers
+    summary = summarizeVotes(results)
+    selectedTasks = numpy.nonzero(summary['total'] >= min(listAnswers))[0]
+    #Locating the window of each task in its best image
+    windows = {}
+    for task in selectedTasks:
         #Geting the selected day for each task
         taskId = tasksInfo[task]['taskId']
         definedArea = tasksInfo[task]['area']
-        selectedTile = results[task].index(max(results[task]))
-        if selectedTile == 0:
-            selectedFile = '2011352'
-        elif selectedTile == 1:
-            selectedFile = '2011353'
-        elif selectedTile == 2:
-            selectedFile = '2011355'
-        elif selectedTile == 3:
-            selectedFile = '2011357'
-        elif selectedTile == 4:
-            selectedFile = '2011358'
-        elif selectedTile == 5:
-            selectedFile = '2011359'
-        elif selectedTile == 6:
-            selectedFile = '2011360'
-        elif selectedTile == 7:
-            selectedFile = '2011361'
-        elif selectedTile == 8:
-            selectedFile = '2011362'
-        elif selectedTile == 9:
-            selectedFile = '2011363'
-        elif selectedTile == 10:
-            selectedFile = '2011364'
-        elif selectedTile == 11:
-            selectedFile = '2011365'
+        selectedFile = days[summary['best'][task]]
         print taskId
         print selectedFile
         print definedArea
-        #Printing bestInfo
-        if completedOnly == 1:
-            f.write(str(definedArea[0])+" "+ str(definedArea[1])+" "+\
-            str(definedArea[2])+" "+str(definedArea[3])+"\n")
-        cmd = "gdal_translate -projwin "+str(definedArea[0])+" "+ \
-            str(definedArea[3])+" "+str(definedArea[2])+" "+ \
-            str(definedArea[1])+" "+origLocation+selectedFile+".tif "+ \
-            tmpMosaic+str(taskId)+".tif"
-        os.system(cmd)
-        #Creating intensity map
+        fileName = origLocation+selectedFile+".tif"
+        window, tileTransform = cutter.locate(fileName, definedArea)
+        if window is not None:
+            windows[task] = (fileName, window, tileTransform)
+    #Printing geoinfo on best result
+    if completedOnly == 1:
+        writeBestInfo(destLocation, tasksInfo, selectedTasks)
+
+    #Allocating the mosaics of every threshold over the union of its tiles
+    resultCut = 0
+    mosaics = []
+    for n in listAnswers:
+        tasksMosaic = [task for task in sorted(windows) \
+            if summary['total'][task] >= n]
+        if tasksMosaic == []:
+            print "No output detected for desired parameter N = " + str(n)
+            resultCut = 1
+            continue
+        extents = []
+        for task in tasksMosaic:
+            fileName, window, tileTransform = windows[task]
+            extents.append(rasterTools.windowExtent(tileTransform, \
+                window[2], window[3]))
+        source = cutter.open(windows[tasksMosaic[0]][0])
+        sourceTransform = source.GetGeoTransform()
+        mosaicTransform, xSize, ySize = rasterTools.mosaicGrid(extents, \
+            sourceTransform[1], sourceTransform[5])
+        numberBands = source.RasterCount
+        dataType = source.GetRasterBand(1).DataType
+        projection = source.GetProjection()
+        fileMosaic, fileIntensity, fileHeat = getMosaicNames(completedOnly, n)
+        writers = [rasterTools.MosaicWriter(destLocation+fileMosaic+".tif", \
+            mosaicTransform, xSize, ySize, numberBands, projection, \
+            dataType, [200] * numberBands)]
         if intensity == 1:
-            origCut = tmpMosaic+str(taskId)+".tif"
-            colourCut = tmpIntensity+str(taskId)+".tif"
-            if os.path.isfile(origCut):
-                shutil.copy(origCut, colourCut)
-                pointFile = gdal.Open(colourCut, 2)
-                votes = max(results[task])
-                for item in range(pointFile.RasterCount):
-                    data = pointFile.GetRasterBand(item+1).ReadAsArray()
-                    if item == 1:
-                        newData = (data * 0) + int(votes * 8)
-                    else:
-                        newData = (data * 0)
-                    pointFile.GetRasterBand(item+1).WriteArray(newData)
-                pointFile = None
-        #Creating heat map
-        if heat == 1:
-            origCut = tmpMosaic+str(taskId)+".tif"
-            heatCut = tmpHeat+str(taskId)+".tif"
-            if os.path.isfile(origCut):
-                shutil.copy(origCut, heatCut)
-                pointFile = gdal.Open(heatCut, 2)
-                #Calculating level of agreement
-                votes = max(results[task])
-                totalVotes = sum(results[task])
-                agree = float(votes)/float(totalVotes)
-                print 'Task ', task, ' -> ', votes, totalVotes, agree
-                #Getting bands
-                data1 = pointFile.GetRasterBand(1).ReadAsArray()
-                data2 = pointFile.GetRasterBand(2).ReadAsArray()
-                data3 = pointFile.GetRasterBand(3).ReadAsArray()
-                #Seting colours based on agreement
-                if agree == 0.0:
-                    newData1 = (data1 * 0) + int(255)
-                    newData2 = (data1 * 0) + int(0)
-                    newData3 = (data1 * 0) + int(0)
-                elif agree > 0.0 and agree < 0.1:
-                    newData1 = (data1 * 0) + int(229)
-                    newData2 = (data1 * 0) + int(0)
-                    newData3 = (data1 * 0) + int(0)
-                elif agree >= 0.1 and agree < 0.2:
-                    newData1 = (data1 * 0) + int(204)
-                    newData2 = (data1 * 0) + int(0)
-                    newData3 = (data1 * 0) + int(0)
-                elif agree >= 0.2 and agree < 0.3:
-                    newData1 = (data1 * 0) + int(178)
-                    newData2 = (data1 * 0) + int(0)
-                    newData3 = (data1 * 0) + int(0)
-                elif agree >= 0.3 and agree < 0.4:
-                    newData1 = (data1 * 0) + int(153)
-                    newData2 = (data1 * 0) + int(0)
-                    newData3 = (data1 * 0) + int(0)
-                elif agree >= 0.4 and agree < 0.5:
-                    newData1 = (data1 * 0) + int(127)
-                    newData2 = (data1 * 0) + int(0)
-                    newData3 = (data1 * 0) + int(0)
-                elif agree >= 0.5 and agree < 0.6:
-                    newData1 = (data1 * 0) + int(0)
-                    newData2 = (data1 * 0) + int(0)
-                    newData3 = (data1 * 0) + int(127)
-                elif agree >= 0.6 and agree < 0.7:
-                    newData1 = (data1 * 0) + int(0)
-                    newData2 = (data1 * 0) + int(0)
-                    newData3 = (data1 * 0) + int(153)
-                elif agree >= 0.7 and agree < 0.8:
-                    newData1 = (data1 * 0) + int(0)
-                    newData2 = (data1 * 0) + int(0)
-                    newData3 = (data1 * 0) + int(178)
-                elif agree >= 0.8 and agree < 0.9:
-                    newData1 = (data1 * 0) + int(0)
-                    newData2 = (data1 * 0) + int(0)
-                    newData3 = (data1 * 0) + int(204)
-                elif agree >= 0.9 and agree < 1.0:
-                    newData1 = (data1 * 0) + int(0)
-                    newData2 = (data1 * 0) + int(0)
-                    newData3 = (data1 * 0) + int(229)
-                elif agree == 1.0:
-                    newData1 = (data1 * 0) + int(0)
-                    newData2 = (data1 * 0) + int(0)
-                    newData3 = (data1 * 0) + int(225)
-                #Writing each band of new values
-                pointFile.GetRasterBand(1).WriteArray(newData1)
-                pointFile.GetRasterBand(2).WriteArray(newData2)
-                pointFile.GetRasterBand(3).WriteArray(newData3)
-                #Close and save file
-                pointFile = None
-    #Changing filename based on the type of result (if all results or
-    #completed only.
-    if completedOnly == 0:
-        if nAnswers == 0:
-            fileMosaic = "mosaicall"
-            fileIntensity = "intensityall"
-            fileHeat = "heatall"
-        else:
-            fileMosaic = "mosaicall"+"_n"+str(nAnswers)
-            fileIntensity = "intensityall"+"_n"+str(nAnswers)
-            fileHeat = "heatall"+"_n"+str(nAnswers)
-    elif completedOnly == 1:
-        if nAnswers == 0:
-            fileMosaic = "mosaiccompleted"
-            fileIntensity = "intensitycompleted"
-            fileHeat = "heatcompleted"
-        else:
-            fileMosaic = "mosaiccompleted"+"_n"+str(nAnswers)
-            fileIntensity = "intensitycompleted"+"_n"+str(nAnswers)
-            fileHeat = "heatcompleted"+"_n"+str(nAnswers)
-    #Checking if the temporary tile folder is not empty
-    if os.listdir(tmpMosaic) == []:
-        print "No output detected for desired parameter N = " + str(nAnswers)
-        #Removing temporary directories
-        removeDir(tmpMosaic)
-        removeDir(tmpIntensity)
-        removeDir(tmpHeat)
-        #Returning error code
-        resultCut = 1
-        return resultCut
-    #Merging the tiles into one mosaic
-    cmd = "gdal_merge.py -init '200 200 200' -o "+destLocation+fileMosaic+".tif "+tmpMosaic+ \
-        "*.tif"
-    os.system(cmd)
-    cmd = "gdal_merge.py -o "+destLocation+fileIntensity+".tif "+tmpIntensity+ \
-        "*.tif"
-    os.system(cmd)
-    cmd = "gdal_merge.py -o "+destLocation+fileHeat+".tif "+tmpHeat+ \
-        "*.tif"
-    os.system(cmd)
-    #Copying file with timestamp
-    now = datetime.datetime.now()
-    timeCreation = now.strftime("%Y-%m-%d_%Hh%M")
-    shutil.copyfile(destLocation+fileMosaic+".tif", destLocation+ \
-        fileMosaic+"_"+timeCreation+".tif")
-    shutil.copyfile(destLocation+fileIntensity+".tif", destLocation+ \
-        fileIntensity+"_"+timeCreation+".tif")
-    shutil.copyfile(destLocation+fileHeat+".tif", destLocation+ \
-        fileHeat+"_"+timeCreation+".tif")
-    #Close file containing geoinfo on best result
+            writers.append(rasterTools.MosaicWriter(destLocation+ \
+                fileIntensity+".tif", mosaicTransform, xSize, ySize, \
+                numberBands, projection, dataType))
+        if heat == 1 and heatPalette == 1:
+            writers.append(rasterTools.MosaicWriter(destLocation+ \
+                fileHeat+".tif", mosaicTransform, xSize, ySize, 1, \
+                projection, GDT_Byte, colourTable=HEAT_RAMP.colourTable()))
+        elif heat == 1:
+            writers.append(rasterTools.MosaicWriter(destLocation+ \
+                fileHeat+".tif", mosaicTransform, xSize, ySize, \
+                numberBands, projection, dataType))
+        mosaics.append((n, [fileMosaic, fileIntensity, fileHeat], writers))
+
+    #Reading each task once and writing it into every mosaic it belongs to.
+    #Intensity and heat are constant colours, written without pixel data.
+    for task in sorted(windows):
+        fileName, window, tileTransform = windows[task]
+        data = cutter.readWindow(fileName, window[0], window[1], window[2], \
+            window[3])[0]
+        intensityValues, heatValues = layerValues(summary, task, \
+            data.shape[0], heatPalette)
+        for n, names, writers in mosaics:
+            if summary['total'][task] < n:
+                continue
+            writers[0].write(data, tileTransform)
+            if intensity == 1:
+                writers[1].fill(intensityValues, tileTransform, window[2], \
+                    window[3])
+            if heat == 1:
+                writers[-1].fill(heatValues, tileTransform, window[2], \
+                    window[3])
+    cutter.close()
+
+    for n, names, writers in mosaics:
+        for writer in writers:
+            writer.close()
+        #Copying file with timestamp
+        now = datetime.datetime.now()
+        timeCreation = now.strftime("%Y-%m-%d_%Hh%M")
+        for name in names:
+            if os.path.isfile(destLocation+name+".tif"):
+                shutil.copyfile(destLocation+name+".tif", destLocation+ \
+                    name+"_"+timeCreation+".tif")
+    #Final state
+    return resultCut
+
+def writeBestInfo(destLocation, tasksInfo, tasks):
+    """
+    Writes the file containing geoinfo on best result
+
+    :arg string destLocation: Directory for the results.
+    :arg list dict tasksInfo: Dictionary list with the tasks info.
+    :arg list tasks: Positions of the tasks to be written
+
+    :returns: Nothing
+    """
+    f = open(destLocation+'/bestInfo.txt','w')
+    for task in tasks:
+        definedArea = tasksInfo[task]['area']
+        f.write(str(definedArea[0])+" "+ str(definedArea[1])+" "+\
+        str(definedArea[2])+" "+str(definedArea[3])+"\n")
+    f.close()
+    return
+
+def getTaskStates(tasksInfo, runs, results, days):
+    """
+    State of every task kept between runs: IDs of the task runs seen,
+    vote vector, chosen tile, votes of the chosen tile and heat colour
+
+    :arg list dict tasksInfo: Dictionary list with the tasks info.
+    :arg dict runs: Task run IDs of every task, by task ID.
+    :arg numpy.ndarray results: Matrix with the answers count from genStats.
+    :arg list days: Candidate days, as given to genStats.
+
+    :returns: State of each task, by task ID
+    :rtype: dictionary
+    """
+    summary = summarizeVotes(results)
+    states = {}
+    for task in range(len(tasksInfo)):
+        states[str(tasksInfo[task]['taskId'])] = { \
+            'runs':runs.get(tasksInfo[task]['taskId'], []), \
+            'votes':[int(count) for count in results[task]], \
+            'best':days[summary['best'][task]], \
+            'winner':int(summary['votes'][task]), \
+            'bucket':int(summary['heatIndexes'][task]), \
+            'area':tasksInfo[task]['area']}
+    return states
+
+def changedTasks(oldState, newState, tasksInfo):
+    """
+    Finds the tasks whose tiles must be rewritten since the last run
+
+    :arg dict oldState: State saved by the last run (None if there is none)
+    :arg dict newState: State of this run
+    :arg list dict tasksInfo: Dictionary list with the tasks info.
+
+    :returns: Positions of the changed tasks, or None if the mosaics must
+        be built from scratch
+    :rtype: list
+    """
+    if oldState is None or oldState['days'] != newState['days'] or \
+        oldState['thresholds'] != newState['thresholds'] or \
+        oldState.get('heatPalette') != newState['heatPalette']:
+        return None
+    oldTasks = oldState['tasks']
+    newTasks = newState['tasks']
+    #A task that left the results can't be removed from the mosaics
+    for taskId in oldTasks:
+        if taskId not in newTasks:
+            return None
+    changed = []
+    for task in range(len(tasksInfo)):
+        taskId = str(tasksInfo[task]['taskId'])
+        new = newTasks[taskId]
+        old = oldTasks.get(taskId)
+        if old is None:
+            changed.append(task)
+            continue
+        #Nothing new was answered for this task
+        if old['runs'] == new['runs']:
+            continue
+        if old['area'] != new['area']:
+            return None
+        oldTotal = sum(old['votes'])
+        newTotal = sum(new['votes'])
+        for n in newState['thresholds']:
+            #A task that left a mosaic can't be removed from it
+            if oldTotal >= n and newTotal < n:
+                return None
+        membership = [newTotal >= n and oldTotal < n \
+            for n in newState['thresholds']]
+        if old['best'] != new['best'] or old['winner'] != new['winner'] or \
+            old['bucket'] != new['bucket'] or True in membership:
+            changed.append(task)
+    return changed
+
+def patchBestTiles(tasksInfo, results, days, origLocation, destLocation, \
+    completedOnly, listAnswers, tasks):
+    """
+    Rewrites some tasks into the mosaics built by cutBestTiles
+
+    :arg list dict tasksInfo: Dictionary list with the tasks info.
+    :arg numpy.ndarray results: Matrix with the answers count from genStats.
+    :arg list days: Candidate days, as given to genStats.
+    :arg string origLocation: Directory with orginal images.
+    :arg string destLocation: Directory for the results.
+    :arg int completedOnly: If we are processing only completed tasks
+    :arg list listAnswers: Mininum numbers of answers of the mosaics
+    :arg list tasks: Positions of the tasks to be rewritten
+
+    :returns: 0 if the mosaics were patched, -1 if they must be rebuilt
+    :rtype: int
+    """
+    cutter = rasterTools.WindowCutter()
+    summary = summarizeVotes(results)
+    #Locating the window of each task in its best image
+    windows = {}
+    for task in tasks:
+        if summary['total'][task] < min(listAnswers):
+            continue
+        fileName = origLocation+days[summary['best'][task]]+".tif"
+        window, tileTransform = cutter.locate(fileName, \
+            tasksInfo[task]['area'])
+        if window is not None:
+            windows[task] = (fileName, window, tileTransform)
+    #Opening the existing mosaics, checking every tile fits in them
+    mosaics = []
+    for n in listAnswers:
+        tasksMosaic = [task for task in sorted(windows) \
+            if summary['total'][task] >= n]
+        if tasksMosaic == []:
+            continue
+        names = getMosaicNames(completedOnly, n)
+        writers = []
+        for name in names:
+            if os.path.isfile(destLocation+name+".tif"):
+                writers.append(rasterTools.MosaicWriter(destLocation+ \
+                    name+".tif"))
+        mosaics.append((n, names, writers))
+        for task in tasksMosaic:
+            fileName, window, tileTransform = windows[task]
+            if len(writers) < len(names) or not writers[0].contains( \
+                tileTransform, window[2], window[3]):
+                print "Tiles outside the mosaics, rebuilding N = " + str(n)
+                for n, names, writers in mosaics:
+                    for writer in writers:
+                        writer.abort()
+                cutter.close()
+                return -1
+    #Rewriting each changed task
+    for task in sorted(windows):
+        fileName, window, tileTransform = windows[task]
+        data = cutter.readWindow(fileName, window[0], window[1], window[2], \
+            window[3])[0]
+        for n, names, writers in mosaics:
+            if summary['total'][task] < n:
+                continue
+            heatPalette = int(writers[2].dataset.RasterCount == 1)
+            intensityValues, heatValues = layerValues(summary, task, \
+                data.shape[0], heatPalette)
+            writers[0].write(data, tileTransform)
+            writers[1].fill(intensityValues, tileTransform, window[2], \
+                window[3])
+            writers[2].fill(heatValues, tileTransform, window[2], window[3])
+    cutter.close()
+    #Printing geoinfo on best result
     if completedOnly == 1:
+        writeBestInfo(destLocation, tasksInfo, \
+            numpy.nonzero(summary['total'] >= min(listAnswers))[0])
+    for n, names, writers in mosaics:
+        for writer in writers:
+            writer.close()
+        #Copying file with timestamp
+        now = datetime.datetime.now()
+        timeCreation = now.strftime("%Y-%m-%d_%Hh%M")
+        for name in names:
+            shutil.copyfile(destLocation+name+".tif", destLocation+ \
+                name+"_"+timeCreation+".tif")
+    return 0
+
+def updateBestTiles(server, appId, tasksInfo, maxNumberAnswers, days, \
+    origLocation, destLocation, completedOnly, listAnswers, \
+    numberWorkers = 8, heatPalette = 0):
+    """
+    Updates the mosaics incrementally. The state of every task is saved
+    after each run. Only the answers given since the last run are
+    downloaded, and only the tasks whose chosen tile, votes, heat colour
+    or thresholds changed are rewritten into the existing mosaics.
+    Without a usable state every answer is downloaded and the mosaics
+    are built with cutBestTiles.
+
+    :arg string server: Address of the server
+    :arg int appId: ID of the application to be analysed
+    :arg list dict tasksInfo: Dictionary list with the tasks info.
+    :arg integer maxNumberAnswers: Maximum number of answers per task
+    :arg list days: Candidate days, as given to genStats.
+    :arg string origLocation: Directory with orginal images.
+    :arg string destLocation: Directory for the results.
+    :arg int completedOnly: If we are processing only completed tasks
+    :arg list listAnswers: Mininum numbers of answers of the mosaics
+    :arg int numberWorkers: Number of simultaneous requests to the server
+    :arg int heatPalette: If the heat map is one paletted band instead of
+        three RGB bands
+
+    :returns: 0 if every mosaic was built, 1 otherwise
+    :rtype: int
+    """
+    stateFile = destLocation+"state_"+getMosaicNames(completedOnly, 0)[0]+ \
+        ".json"
+    oldState = None
+    if os.path.isfile(stateFile):
+        f = open(stateFile, 'r')
+        oldState = json.load(f)
         f.close()
-    #Removing temporary directories
-    removeDir(tmpMosaic)
-    removeDir(tmpIntensity)
-    removeDir(tmpHeat)
-    #Final state
-    resultCut = 0
+    #The vote vectors of the last run are reused only if they were
+    #counted the same way
+    if oldState is not None and 'lastTaskRunId' in oldState and \
+        oldState['days'] == days and \
+        oldState.get('maxNumberAnswers') == maxNumberAnswers:
+        answers, lastId = getNewResults(server, appId, tasksInfo, oldState, \
+            maxNumberAnswers, numberWorkers)
+        runs, results = mergeResults(oldState, tasksInfo, answers, days, \
+            maxNumberAnswers)
+    else:
+        answers = getResults(server, appId, tasksInfo, maxNumberAnswers, \
+            numberWorkers, 1)
+        runs = answers.runIdsByTask()
+        results = genStats([task['taskId'] for task in tasksInfo], answers, \
+            days, 0)
+        lastId = 0
+        if len(answers) > 0:
+            lastId = int(answers.runIds[:len(answers)].max())
+    answers = None
+    newState = {'days':days, 'thresholds':listAnswers, \
+        'heatPalette':heatPalette, 'maxNumberAnswers':maxNumberAnswers, \
+        'lastTaskRunId':lastId, \
+        'tasks':getTaskStates(tasksInfo, runs, results, days)}
+    tasks = changedTasks(oldState, newState, tasksInfo)
+    resultCut = -1
+    if tasks == []:
+        print "No changes since the last run"
+        resultCut = 0
+    elif tasks is not None:
+        print "Number of changed tasks: ", len(tasks)
+        resultCut = patchBestTiles(tasksInfo, results, days, origLocation, \
+            destLocation, completedOnly, listAnswers, tasks)
+    if resultCut == -1:
+        resultCut = cutBestTiles(tasksInfo, results, days, origLocation, \
+            destLocation, completedOnly, listAnswers, heatPalette)
+    f = open(stateFile, 'w')
+    json.dump(newState, f)
+    f.close()
     return resultCut
 
+def getMosaicNames(completedOnly, nAnswers):
+    """
+    Names of the mosaic, intensity and heat files, based on the type of
+    result (if all results or completed only) and the number of answers
+
+    :arg int completedOnly: If we are processing only completed tasks
+    :arg int nAnswers: Mininum number of answers considered
+
+    :returns: Names of the mosaic, intensity and heat files (no extension)
+    :rtype: list
+    """
+    if completedOnly == 1:
+        kind = "completed"
+    else:
+        kind = "all"
+    if nAnswers == 0:
+        suffix = ""
+    else:
+        suffix = "_n"+str(nAnswers)
+    return "mosaic"+kind+suffix, "intensity"+kind+suffix, "heat"+kind+suffix
+
 def createDir(directory):
     """
     Creates a directory if it doesn't exists
@@ -458,6 +729,21 @@ if __name__ == "__main__":
         help="Build the full set of results", metavar="FULLBUILD")
     parser.add_option("-r", "--remove-files", type="int", dest="removeFiles", \
         help="Remove files older than D days", metavar="REMOVEFILES")
+    parser.add_option("-u", "--incremental", type="int", dest="incremental", \
+        help="Update only the tasks changed since the last run", \
+        metavar="INCREMENTAL")
+    parser.add_option("-w", "--workers", type="int", dest="numberWorkers", \
+        help="Number of simultaneous requests to the server", \
+        metavar="NUMBERWORKERS")
+    parser.add_option("-k", "--cache-directory", dest="cacheDir", \
+        help="Directory for the cache of server responses", \
+        metavar="CACHEDIR")
+    parser.add_option("-p", "--snapshot", dest="snapshotFile", \
+        help="Snapshot to be used instead of the server (see snapshot.py)", \
+        metavar="SNAPSHOT")
+    parser.add_option("-l", "--heat-palette", type="int", dest="heatPalette", \
+        help="Write the heat map as one paletted band instead of RGB", \
+        metavar="HEATPALETTE")
 
     (options, args) = parser.parse_args()
 
@@ -497,17 +783,48 @@ if __name__ == "__main__":
         removeFiles = options.removeFiles
     else:
         removeFiles = 9999
+    if options.incremental:
+        incremental = options.incremental
+    else:
+        incremental = 0
+    if options.numberWorkers:
+        numberWorkers = options.numberWorkers
+    else:
+        numberWorkers = 8
+    if options.heatPalette:
+        heatPalette = options.heatPalette
+    else:
+        heatPalette = 0
+
+    #Keeping the server responses between runs
+    if options.cacheDir:
+        pybossaClient.enableCache(options.cacheDir)
+    #Reading the data from a local snapshot
+    if options.snapshotFile:
+        pybossaClient.useSnapshot(snapshot.Snapshot(options.snapshotFile))
 
     #Get the data and start analysing it
-    appId = getAppId(server, appName)
+    appId = pybossaClient.getAppId(server, appName)
+    days = getCandidateDays(imagesDir)
+    if days == []:
+        print "No candidate images found in " + imagesDir
+        sys.exit(1)
 
     #For complete tasks only
     completedOnly = 1
-    tasksInfo = getTasks(server, appId, maxNumberTasks, completedOnly)
-    results = getResults(server, tasksInfo, maxNumberAnswers)
-    stats = genStats(results, 0)
-    finalResult = cutBestTiles(tasksInfo, stats, imagesDir, destDir, \
+    tasksInfo = pybossaClient.getTasksInfo(server, appId, maxNumberTasks, \
         completedOnly)
+    if incremental == 1:
+        finalResult = updateBestTiles(server, appId, tasksInfo, \
+            maxNumberAnswers, days, imagesDir, destDir, completedOnly, [0], \
+            numberWorkers, heatPalette)
+    else:
+        results = getResults(server, appId, tasksInfo, maxNumberAnswers, \
+            numberWorkers, 1)
+        stats = genStats([task['taskId'] for task in tasksInfo], results, \
+            days, 0)
+        finalResult = cutBestTiles(tasksInfo, stats, days, imagesDir, \
+            destDir, completedOnly, 0, heatPalette)
 
     #Clear data
     tasksInfo = None
@@ -517,30 +834,26 @@ if __name__ == "__main__":
 
     #For all tasks
     completedOnly = 0
-    tasksInfo = getTasks(server, appId, maxNumberTasks, completedOnly)
-    results = getResults(server, tasksInfo, maxNumberAnswers)
-    stats = genStats(results, 0)
-    #Building for any number of answers
-    finalResult = cutBestTiles(tasksInfo, stats, imagesDir, destDir, \
+    tasksInfo = pybossaClient.getTasksInfo(server, appId, maxNumberTasks, \
         completedOnly)
-
-    #To build the full set of results to ForestWatchers
+    #Building for any number of answers
     if fullBuild == 1:
-        #Building for 5 answers at least
-        finalResult = cutBestTiles(tasksInfo, stats, imagesDir, destDir, \
-            completedOnly, 5)
-        #Building for 10 answers at least
-        finalResult = cutBestTiles(tasksInfo, stats, imagesDir, destDir, \
-            completedOnly, 10)
-        #Building for 15 answers at least
-        finalResult = cutBestTiles(tasksInfo, stats, imagesDir, destDir, \
-            completedOnly, 15)
-        #Building for 20 answers at least
-        finalResult = cutBestTiles(tasksInfo, stats, imagesDir, destDir, \
-            completedOnly, 20)
-        #Building for 25 answers at least
-        finalResult = cutBestTiles(tasksInfo, stats, imagesDir, destDir, \
-            completedOnly, 25)
+        #To build the full set of results to ForestWatchers, from any
+        #number of answers to 25 answers at least
+        listAnswers = [0, 5, 10, 15, 20, 25]
+    else:
+        listAnswers = [0]
+    if incremental == 1:
+        finalResult = updateBestTiles(server, appId, tasksInfo, \
+            maxNumberAnswers, days, imagesDir, destDir, completedOnly, \
+            listAnswers, numberWorkers, heatPalette)
+    else:
+        results = getResults(server, appId, tasksInfo, maxNumberAnswers, \
+            numberWorkers, 1)
+        stats = genStats([task['taskId'] for task in tasksInfo], results, \
+            days, 0)
+        finalResult = cutBestTiles(tasksInfo, stats, days, imagesDir, \
+            destDir, completedOnly, listAnswers, heatPalette)
 
     #To remove files older than D days
     statusRemoval = removeOldFiles(destDir,removeFiles)
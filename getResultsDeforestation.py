@@ -25,82 +25,205 @@ import ogr
 import osr
 import gdal
 import json
+import math
 import time
-import urllib2
+import numpy
+import functools
+import itertools
+import multiprocessing
+import snapshot
+import vectorTools
+import pybossaClient
 from gdalconst import *
 from optparse import OptionParser
 
-def getAppId(server, appName):
-    """
-    Get the application id given the short name
+#Pixel size (degrees) of the grid where the answers of a task are counted
+CONSENSUS_PIXEL_SIZE = 0.0001
 
-    :arg string server: Address of the server
-    :arg string appName: Short name of the application
-    :returns: Numerical id of the application
-    :rtype: integer
-    """
-    JSONdata = urllib2.urlopen(url=server+"/api/app?short_name="+ \
-        appName).read()
-    data = json.loads(JSONdata)
-    appId = data[0]['id']
-    return appId
-
-def getTasks(server, appId, maxNumberTasks, completedOnly):
-    """
-    Get the tasks of a particular application from the server.
-
-    :arg string server: Address of the server
-    :arg string appId: ID of the application to be analysed
-    :arg integer maxNumberTasks: Maximum number of tasks to be downloaded
-    :arg int completedOnly: If we'll get only completed tasks
-    :returns: Tasks info for the application
-    :rtype: dictionary
-    """
-    if completedOnly == 1:
-        JSONdata = urllib2.urlopen(url=server+"/api/task?app_id="+ \
-            str(appId)+"&state=completed&limit="+ \
-            str(maxNumberTasks)).read()
-    else:
-        JSONdata = urllib2.urlopen(url=server+"/api/task?app_id="+ \
-            str(appId)+"&limit="+str(maxNumberTasks)).read()
-    data = json.loads(JSONdata)
-    numberTasks = len(data)
-    tasksInfo = []
-    for item in range(numberTasks):
-        tasksInfo.append({'taskId':data[item]['id'], \
-            'area':data[item]['info']['tile']['restrictedExtent']})
-    return tasksInfo
+#Largest grid (pixels) allocated for the consensus of one task
+CONSENSUS_MAX_PIXELS = 4096 * 4096
 
-def getResults(server, tasksInfo, maxNumberAnswers):
+def getResults(server, appId, tasksInfo, maxNumberAnswers, bulk = None):
     """
     Get the results of a particular application from the server.
 
     :arg string server: Address of the server
-    :arg integer maxNumberAnswers: Maximum number of answers per task to be downloaded
+    :arg int appId: ID of the application to be analysed
     :arg list tasksInfo: List of tasks
+    :arg integer maxNumberAnswers: Maximum number of answers per task to be downloaded
+    :arg int bulk: If the answers are downloaded for the whole app (None for auto)
     :returns: Results for the application
     :rtype: dictionary
     """
     answersApp = []
     numberTasks = len(tasksInfo)
+    tasksId = [tasksInfo[item]['taskId'] for item in range(numberTasks)]
+    #Each task run is reduced to its answer as soon as it is parsed
+    convert = lambda taskRun: {'taskId':taskRun['task_id'], \
+        'id':taskRun['id'], 'answer':taskRun['info']['deforestedareas']}
+    dataTasks, fetcher = pybossaClient.getTaskRuns(server, appId, tasksId, \
+        maxNumberAnswers, bulk=bulk, convert=convert)
     for item in range(numberTasks):
-        answersApp.append([])
-        JSONdata = urllib2.urlopen(url=server+"/api/taskrun?task_id="+ \
-            str(tasksInfo[item]['taskId'])+"&limit="+ \
-            str(maxNumberAnswers)).read()
-        data = json.loads(JSONdata)
-        lenData = len(data)
-        for ans in range(lenData):
-            answersApp[item].append({'taskId':data[ans]['task_id'], \
-            'id':data[ans]['id'], 'answer':data[ans]['info']['deforestedareas']})
+        answersApp.append(dataTasks[item])
     return answersApp
 
-def generateShapefiles(data, destDir, printStats = 0):
+def mapTasks(function, data, numberWorkers = 1):
+    """
+    Applies a function to the answers of each task, in a pool of
+    processes if there is more than one worker
+
+    :arg function function: Function of the answers of one task
+    :arg list dict data: Dictionary list with all the results.
+    :arg int numberWorkers: Number of processes
+    :returns: Iterator over the results, in task order
+    :rtype: generator
+    """
+    if numberWorkers <= 1:
+        for results in data:
+            yield function(results)
+        return
+    pool = multiprocessing.Pool(numberWorkers)
+    chunkSize = max(len(data) / (4 * numberWorkers), 1)
+    try:
+        for value in pool.imap(function, data, chunkSize):
+            yield value
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def polygonalPart(geometry):
     """
-    Generates the shapefile with the polygons based on the results
+    Polygons of a repaired geometry. A repair can give a collection
+    holding lines or points as well, which are dropped.
+
+    :arg ogr.Geometry geometry: The repaired geometry
+    :returns: Polygon or multipolygon, or None if it has no polygon
+    :rtype: ogr.Geometry
+    """
+    if geometry is None:
+        return None
+    flatType = ogr.GT_Flatten(geometry.GetGeometryType())
+    if flatType in [ogr.wkbPolygon, ogr.wkbMultiPolygon]:
+        return geometry
+    if flatType != ogr.wkbGeometryCollection:
+        return None
+    polygons = ogr.Geometry(ogr.wkbMultiPolygon)
+    for item in range(geometry.GetGeometryCount()):
+        part = polygonalPart(geometry.GetGeometryRef(item))
+        if part is None:
+            continue
+        if ogr.GT_Flatten(part.GetGeometryType()) == ogr.wkbPolygon:
+            polygons.AddGeometry(part)
+        else:
+            for polygon in range(part.GetGeometryCount()):
+                polygons.AddGeometry(part.GetGeometryRef(polygon))
+    if polygons.GetGeometryCount() == 0:
+        return None
+    return polygons
+
+def cleanGeometry(geometry, tolerance):
+    """
+    Repairs an invalid polygon (self-intersections, duplicate vertices)
+    and simplifies it keeping its topology. MakeValid (GDAL 3 with GEOS
+    3.8) keeps every lobe of a self-intersecting "bowtie", which a zero
+    buffer may drop; the zero buffer is used only without it.
+
+    :arg ogr.Geometry geometry: The polygon
+    :arg float tolerance: Simplification tolerance, in degrees (0 to keep
+        every vertex)
+    :returns: The clean polygon or multipolygon, or None if it is
+        degenerate (empty or smaller than tolerance squared)
+    :rtype: ogr.Geometry
+    """
+    if not geometry.IsValid():
+        repaired = None
+        if hasattr(geometry, 'MakeValid'):
+            repaired = geometry.MakeValid()
+        if repaired is None:
+            repaired = geometry.Buffer(0)
+        geometry = polygonalPart(repaired)
+    if geometry is not None and tolerance > 0:
+        geometry = geometry.SimplifyPreserveTopology(tolerance)
+    if geometry is None or geometry.IsEmpty():
+        return None
+    if geometry.GetArea() <= tolerance * tolerance:
+        return None
+    return geometry
+
+def answerGeometry(answer):
+    """
+    Builds the geometry of a feature drawn by a volunteer from its
+    GeoJSON, in one call
+
+    :arg dict answer: The feature
+    :returns: Type of the geometry and the geometry, which is None if the
+        GeoJSON is malformed or empty
+    :rtype: string, ogr.Geometry
+    """
+    try:
+        typeGeometry = answer['geometry']['type']
+    except (KeyError, TypeError):
+        return None, None
+    geometry = ogr.CreateGeometryFromJson(json.dumps(answer['geometry']))
+    if geometry is None or geometry.IsEmpty():
+        return typeGeometry, None
+    if typeGeometry == 'Polygon':
+        geometry.CloseRings()
+    return typeGeometry, geometry
+
+def taskGeometries(results, tolerance = None):
+    """
+    Builds the geometries drawn by the volunteers of a task
+
+    :arg list results: Answers of the task (one per volunteer)
+    :arg float tolerance: If given, polygons are repaired and simplified
+        to this tolerance (see cleanGeometry)
+    :returns: Type and WKB of each geometry, and the number of answers
+        without deforestation, of geometries of other types, of malformed
+        geometries and of degenerate polygons dropped
+    :rtype: list, dictionary
+    """
+    geometries = []
+    counts = {'no-deforestation':0, 'other':0, 'malformed':0, 'dropped':0}
+    for result in results:
+        if result['answer'] == 'no-deforestation':
+            counts['no-deforestation'] = counts['no-deforestation'] + 1
+            continue
+        for answer in result['answer']:
+            typeGeometry, geometry = answerGeometry(answer)
+            if typeGeometry is not None and \
+                typeGeometry not in ['Polygon', 'Point']:
+                counts['other'] = counts['other'] + 1
+                continue
+            # A bad answer is skipped instead of stopping the whole run
+            if geometry is None:
+                counts['malformed'] = counts['malformed'] + 1
+                continue
+            if typeGeometry == 'Polygon':
+                if tolerance is not None:
+                    geometry = cleanGeometry(geometry, tolerance)
+                    if geometry is None:
+                        counts['dropped'] = counts['dropped'] + 1
+                        continue
+            geometries.append((typeGeometry, geometry.ExportToWkb()))
+    return geometries, counts
+
+def generateShapefiles(data, destDir, printStats = 0, numberWorkers = 1, \
+    tolerance = None, formatName = 'shp'):
+    """
+    Generates the shapefile with the polygons based on the results. The
+    geometries are built by numberWorkers processes and written by this
+    one. A spatial index (.qix) is written next to each shapefile.
 
     :arg list dict data: Dictionary list with all the results.
     :arg string destDir: Destination directory
+    :arg int numberWorkers: Number of processes building the geometries
+    :arg float tolerance: If given, polygons are repaired and simplified
+        to this tolerance, in degrees
+    :arg string formatName: Output format (shp, gpkg or fgb)
 
     :returns: None
     """
@@ -108,82 +231,269 @@ def generateShapefiles(data, destDir, printStats = 0):
     spatialReference = osr.SpatialReference()
     spatialReference.ImportFromProj4('+proj=longlat +ellps=WGS84 +datum=WGS84 +no_defs')
 
-    # Creating the polygon shapefile
-    destFilePoly = destDir+'deforestedAreasPoly.shp'
-    if os.path.isfile(destFilePoly):
-        os.remove(destFilePoly)
-    driver = ogr.GetDriverByName('ESRI Shapefile')
-    shapeDataPoly = driver.CreateDataSource(destFilePoly)
-    # Creating the polygon layer
-    layerPoly = shapeDataPoly.CreateLayer('DeforestedAreasPoly', spatialReference, ogr.wkbPolygon)
-    layerDefinitionPoly = layerPoly.GetLayerDefn()
-
-    # Creating the point shapefile
-    destFilePoint = destDir+'deforestedAreasPoint.shp'
-    if os.path.isfile(destFilePoint):
-        os.remove(destFilePoint)
-    shapeDataPoint = driver.CreateDataSource(destFilePoint)
-    # Creating the point layer
-    layerPoint = shapeDataPoint.CreateLayer('DeforestedAreasPoint', spatialReference, ogr.wkbPoint)
-    layerDefinitionPoint = layerPoint.GetLayerDefn()
-
-    # Getting the number of tasks and the number of answers for each one
-    numberTasks = len(data)
-    for task in range(numberTasks):
-        numberResults = len(data[task])
-        if (numberResults > 0):
-            print 'Task ', task, ' - Number results: ', numberResults
-            for result in range(numberResults):
-                if data[task][result]['answer'] == 'no-deforestation':
-                    print '  No-deforestation in task', data[task][result]['id']
-                else:
-                    numberAnswers = len(data[task][result]['answer'])
-                    print '  Number of features: ', numberAnswers
-                    for answer in range(numberAnswers):
-                        typeGeometry = data[task][result]['answer'][answer]['geometry']['type']
-                        print '    Type of geometry: ', typeGeometry
-                        if (typeGeometry == 'Polygon'):
-                            outring = ogr.Geometry(ogr.wkbLinearRing)
-                            pointsGeometry = data[task][result]['answer'][answer]['geometry']['coordinates']
-                            numberPoints = len(pointsGeometry[0])
-                            print '      Number of points: ', numberPoints
-                            # Adds the polygons points then closes the ring
-                            for point in range(numberPoints):
-                                outring.AddPoint(pointsGeometry[0][point][0], pointsGeometry[0][point][1])
-                            outring.CloseRings()
-                            # Creates the polygon
-                            polygon = ogr.Geometry(ogr.wkbPolygon)
-                            polygon.AddGeometry(outring)
-                            # Put the polygon in the feature
-                            feature = ogr.Feature(layerDefinitionPoly)
-                            feature.SetGeometry(polygon)
-                            # Creates the feature in the layer
-                            layerPoly.CreateFeature(feature)
-                            # Clears environment for next polygon
-                            outring.Destroy()
-                            polygon.Destroy()
-                            feature.Destroy()
-                        elif (typeGeometry == 'Point'):
-                            pointCoordinate = data[task][result]['answer'][answer]['geometry']['coordinates']
-                            # Creates the point
-                            point = ogr.Geometry(ogr.wkbPoint)
-                            point.SetPoint(0, pointCoordinate[0], pointCoordinate[1])
-                            # Put the point in the feature
-                            feature = ogr.Feature(layerDefinitionPoint)
-                            feature.SetGeometry(point)
-                            # Creates the feature in the layer
-                            layerPoint.CreateFeature(feature)
-                            # Clears environment for next point
-                            point.Destroy()
-                            feature.Destroy()
-            print ''
-
-    # Flush the content
-    shapeDataPoly.Destroy()
-    shapeDataPoint.Destroy()
+    # Creating the polygon and point layers
+    shapeDataPoly, layerPoly = vectorTools.createLayer(destDir+'deforestedAreasPoly', \
+        'DeforestedAreasPoly', spatialReference, ogr.wkbPolygon, formatName)
+    shapeDataPoint, layerPoint = vectorTools.createLayer(destDir+'deforestedAreasPoint', \
+        'DeforestedAreasPoint', spatialReference, ogr.wkbPoint, formatName)
+
+    # Features are written in batches, each one inside a transaction
+    writers = {'Polygon':vectorTools.FeatureWriter(layerPoly), \
+        'Point':vectorTools.FeatureWriter(layerPoint)}
+    counts = {'no-deforestation':0, 'other':0, 'malformed':0, 'dropped':0}
+    startTime = time.time()
+
+    # The geometries of each task come as WKB, in task order
+    build = functools.partial(taskGeometries, tolerance=tolerance)
+    for geometries, taskCounts in mapTasks(build, data, numberWorkers):
+        for key in taskCounts:
+            counts[key] = counts[key] + taskCounts[key]
+        for typeGeometry, wkb in geometries:
+            writers[typeGeometry].writeGeometry(ogr.CreateGeometryFromWkb(wkb))
+    for typeGeometry in writers:
+        writers[typeGeometry].close()
+
+    elapsedTime = time.time() - startTime
+    numberFeatures = writers['Polygon'].count + writers['Point'].count
+    print 'Polygons written: ', writers['Polygon'].count
+    print 'Points written: ', writers['Point'].count
+    print 'No-deforestation answers: ', counts['no-deforestation']
+    if counts['other'] > 0:
+        print 'Geometries of other types skipped: ', counts['other']
+    if counts['malformed'] > 0:
+        print 'Malformed geometries skipped: ', counts['malformed']
+    if counts['dropped'] > 0:
+        print 'Degenerate polygons dropped: ', counts['dropped']
+    print 'Features/sec: %.0f' % (numberFeatures / max(elapsedTime, 1e-6))
+    print ''
+
+    # Flush the content (and the .qix indexes used by MapServer)
+    vectorTools.closeLayer(shapeDataPoly, layerPoly)
+    vectorTools.closeLayer(shapeDataPoint, layerPoint)
 
     return 0
 
+def countVolunteers(results, area = None, pixelSize = CONSENSUS_PIXEL_SIZE, \
+    maxPixels = CONSENSUS_MAX_PIXELS):
+    """
+    Rasterizes the polygons of each volunteer of a task onto a common
+    grid and adds them up, so each pixel holds how many volunteers drew
+    it. Overlaps are counted on the grid, without testing the polygons
+    against each other. The polygons are clipped to the area of the task,
+    so a stray polygon can't stretch the grid.
+
+    :arg list results: Answers of the task (one per volunteer)
+    :arg list area: Area of the task (minX, minY, maxX, maxY), or None
+    :arg float pixelSize: Pixel size of the grid, in degrees
+    :arg int maxPixels: Largest grid allowed, in pixels
+    :returns: Number of volunteers per pixel and the geo transform of the
+        grid (None, None if no polygon was drawn or the grid would be
+        larger than maxPixels), and the number of malformed polygons
+        skipped and of grids refused
+    :rtype: numpy.ndarray, list, dictionary
+    """
+    counts = {'malformed':0, 'oversized':0}
+    clip = None
+    if area is not None:
+        ring = ogr.Geometry(ogr.wkbLinearRing)
+        for x, y in [(area[0], area[1]), (area[2], area[1]), \
+            (area[2], area[3]), (area[0], area[3]), (area[0], area[1])]:
+            ring.AddPoint_2D(x, y)
+        clip = ogr.Geometry(ogr.wkbPolygon)
+        clip.AddGeometry(ring)
+    memoryDriver = ogr.GetDriverByName('Memory')
+    source = memoryDriver.CreateDataSource('answers')
+    layer = source.CreateLayer('answers', None, ogr.wkbUnknown)
+    layer.CreateField(ogr.FieldDefn('volunteer', ogr.OFTInteger))
+    layerDefinition = layer.GetLayerDefn()
+    envelope = None
+    for volunteer in range(len(results)):
+        if results[volunteer]['answer'] == 'no-deforestation':
+            continue
+        for answer in results[volunteer]['answer']:
+            typeGeometry, geometry = answerGeometry(answer)
+            if typeGeometry != 'Polygon':
+                continue
+            if geometry is None:
+                counts['malformed'] = counts['malformed'] + 1
+                continue
+            if clip is not None:
+                geometry = geometry.Intersection(clip)
+                if geometry is None or geometry.IsEmpty():
+                    continue
+            #Envelope is (minX, maxX, minY, maxY)
+            bounds = geometry.GetEnvelope()
+            if envelope is None:
+                envelope = list(bounds)
+            else:
+                envelope = [min(envelope[0], bounds[0]), max(envelope[1], bounds[1]), \
+                    min(envelope[2], bounds[2]), max(envelope[3], bounds[3])]
+            feature = ogr.Feature(layerDefinition)
+            feature.SetField('volunteer', volunteer)
+            feature.SetGeometryDirectly(geometry)
+            layer.CreateFeature(feature)
+    if envelope is None:
+        return None, None, counts
+    xSize = max(int(math.ceil((envelope[1] - envelope[0]) / pixelSize)), 1)
+    ySize = max(int(math.ceil((envelope[3] - envelope[2]) / pixelSize)), 1)
+    if xSize * ySize > maxPixels:
+        counts['oversized'] = 1
+        return None, None, counts
+    geoTransform = [envelope[0], pixelSize, 0, envelope[3], 0, -pixelSize]
+    grid = gdal.GetDriverByName('MEM').Create('', xSize, ySize, 1, GDT_Byte)
+    grid.SetGeoTransform(geoTransform)
+    band = grid.GetRasterBand(1)
+    count = numpy.zeros((ySize, xSize), dtype=numpy.uint16)
+    #Each volunteer counts once, even where their polygons overlap
+    for volunteer in range(len(results)):
+        layer.SetAttributeFilter('volunteer = '+str(volunteer))
+        if layer.GetFeatureCount() == 0:
+            continue
+        band.Fill(0)
+        gdal.RasterizeLayer(grid, [1], layer, burn_values=[1])
+        count += band.ReadAsArray()
+    return count, geoTransform, counts
+
+def taskConsensus(task, minAgreement, pixelSize = CONSENSUS_PIXEL_SIZE):
+    """
+    Areas drawn by at least minAgreement volunteers of a task
+
+    :arg list task: Answers of the task (one per volunteer) and area of
+        the task (minX, minY, maxX, maxY), or None
+    :arg int minAgreement: Minimum number of volunteers to keep an area
+    :arg float pixelSize: Pixel size of the grid, in degrees
+    :returns: Agreement and WKB of each area, and the number of malformed
+        polygons skipped and of grids refused (see countVolunteers)
+    :rtype: list, dictionary
+    """
+    results, taskArea = task
+    areasTask = []
+    if len(results) < minAgreement:
+        return areasTask, {'malformed':0, 'oversized':0}
+    count, geoTransform, counts = countVolunteers(results, taskArea, pixelSize)
+    if count is None or count.max() < minAgreement:
+        return areasTask, counts
+    ySize, xSize = count.shape
+    grid = gdal.GetDriverByName('MEM').Create('', xSize, ySize, 2, GDT_UInt16)
+    grid.SetGeoTransform(geoTransform)
+    grid.GetRasterBand(1).WriteArray(count)
+    grid.GetRasterBand(2).WriteArray((count >= minAgreement).astype(numpy.uint16))
+    #Polygonize writes the agreement of each area in a memory layer
+    source = ogr.GetDriverByName('Memory').CreateDataSource('consensus')
+    areas = source.CreateLayer('consensus', None, ogr.wkbPolygon)
+    areas.CreateField(ogr.FieldDefn('agreement', ogr.OFTInteger))
+    gdal.Polygonize(grid.GetRasterBand(1), grid.GetRasterBand(2), areas, 0)
+    areas.ResetReading()
+    area = areas.GetNextFeature()
+    while area is not None:
+        areasTask.append((area.GetField('agreement'), \
+            area.GetGeometryRef().ExportToWkb()))
+        area = areas.GetNextFeature()
+    source.Destroy()
+    return areasTask, counts
+
+def generateConsensus(data, tasksInfo, destDir, minAgreement, \
+    pixelSize = CONSENSUS_PIXEL_SIZE, numberWorkers = 1, formatName = 'shp'):
+    """
+    Generates a shapefile with the areas drawn by at least minAgreement
+    volunteers of each task, inside the area of the task. Each polygon has
+    the number of volunteers who drew it (agreement) and the number of
+    answers of its task.
+
+    :arg list dict data: Dictionary list with all the results.
+    :arg list tasksInfo: Tasks of the results, in the same order
+    :arg string destDir: Destination directory
+    :arg int minAgreement: Minimum number of volunteers to keep an area
+    :arg float pixelSize: Pixel size of the grid, in degrees
+    :arg int numberWorkers: Number of processes finding the areas
+    :arg string formatName: Output format (shp, gpkg or fgb)
+    :returns: Number of polygons written
+    :rtype: int
+    """
+    spatialReference = osr.SpatialReference()
+    spatialReference.ImportFromProj4('+proj=longlat +ellps=WGS84 +datum=WGS84 +no_defs')
+
+    fields = [ogr.FieldDefn(fieldName, ogr.OFTInteger) for fieldName in \
+        ['taskId', 'agreement', 'answers']]
+    shapeData, layer = vectorTools.createLayer(destDir+'deforestedAreasConsensus', \
+        'DeforestedAreasConsensus', spatialReference, ogr.wkbPolygon, formatName, \
+        fields)
+    writer = vectorTools.FeatureWriter(layer)
+
+    startTime = time.time()
+    consensus = functools.partial(taskConsensus, minAgreement=minAgreement, \
+        pixelSize=pixelSize)
+    tasks = [(data[item], tasksInfo[item]['area']) for item in range(len(data))]
+    areasTasks = mapTasks(consensus, tasks, numberWorkers)
+    counts = {'malformed':0, 'oversized':0}
+    for results, taskInfo, (areasTask, taskCounts) in \
+        itertools.izip(data, tasksInfo, areasTasks):
+        for key in taskCounts:
+            counts[key] = counts[key] + taskCounts[key]
+        for agreement, wkb in areasTask:
+            writer.writeGeometry(ogr.CreateGeometryFromWkb(wkb), \
+                {'taskId':taskInfo['taskId'], 'agreement':agreement, \
+                'answers':len(results)})
+    writer.close()
+    numberPolygons = writer.count
+    vectorTools.closeLayer(shapeData, layer)
+
+    print 'Consensus polygons (agreement >= %d): %d' % (minAgreement, numberPolygons)
+    if counts['malformed'] > 0:
+        print 'Malformed polygons skipped: ', counts['malformed']
+    if counts['oversized'] > 0:
+        print 'Tasks skipped (grid over %d pixels): %d' % (CONSENSUS_MAX_PIXELS, \
+            counts['oversized'])
+    print 'Consensus time: %.2f s' % (time.time() - startTime)
+    print ''
+    return numberPolygons
+
+def benchmarkShapefiles(destDir, numberPolygons = 100000, numberWorkers = 1, \
+    tolerance = None, formatName = 'shp'):
+    """
+    Writes synthetic polygons with generateShapefiles to measure the
+    writing speed (features/sec), then times window queries on them
+
+    :arg string destDir: Destination directory
+    :arg int numberPolygons: Number of polygons to be written
+    :arg int numberWorkers: Number of processes building the geometries
+    :arg float tolerance: Simplification tolerance (None to write as drawn)
+    :arg string formatName: Output format (shp, gpkg or fgb)
+    """
+    answersPerTask = 10
+    data = []
+    for item in range(0, numberPolygons, answersPerTask):
+        answers = []
+        for polygon in range(item, min(item + answersPerTask, numberPolygons)):
+            x = -60.0 + (polygon % 1000) * 0.001
+            y = -10.0 + (polygon / 1000) * 0.001
+            ring = [[x, y], [x + 0.0008, y], [x + 0.0008, y + 0.0008], \
+                [x, y + 0.0008], [x, y]]
+            answers.append({'geometry':{'type':'Polygon', 'coordinates':[ring]}})
+        data.append([{'taskId':item, 'id':item, 'answer':answers}])
+    startTime = time.time()
+    generateShapefiles(data, destDir, 0, numberWorkers, tolerance, formatName)
+    print 'Benchmark: %d polygons in %.2f s' % (numberPolygons, \
+        time.time() - startTime)
+    # Window queries, as done by MapServer when rendering the layer
+    shapeData = ogr.Open(vectorTools.outputName(destDir+'deforestedAreasPoly', \
+        formatName))
+    layer = shapeData.GetLayer(0)
+    numberQueries = 1000
+    numberFound = 0
+    startTime = time.time()
+    for query in range(numberQueries):
+        x = -60.0 + (query % 100) * 0.01
+        y = -10.0 + (query / 100) * 0.01
+        layer.SetSpatialFilterRect(x, y, x + 0.01, y + 0.01)
+        feature = layer.GetNextFeature()
+        while feature is not None:
+            numberFound = numberFound + 1
+            feature = layer.GetNextFeature()
+    print 'Benchmark: %d window queries (%d features) in %.2f s' % \
+        (numberQueries, numberFound, time.time() - startTime)
+    shapeData.Destroy()
+
 def removeOldFiles(directory,daysLimit):
     """
     Removes old files from a directory older than a given limit
@@ -232,6 +542,26 @@ if __name__ == "__main__":
         help="Directory for results", metavar="DESTDIR")
     parser.add_option("-r", "--remove-files", type="int", dest="removeFiles", \
         help="Remove files older than D days", metavar="REMOVEFILES")
+    parser.add_option("-k", "--cache-directory", dest="cacheDir", \
+        help="Directory for the cache of server responses", \
+        metavar="CACHEDIR")
+    parser.add_option("-p", "--snapshot", dest="snapshotFile", \
+        help="Snapshot to be used instead of the server (see snapshot.py)", \
+        metavar="SNAPSHOT")
+    parser.add_option("-m", "--min-agreement", type="int", dest="minAgreement", \
+        help="Minimum number of volunteers to keep an area in the consensus", \
+        metavar="MINAGREEMENT")
+    parser.add_option("-j", "--processes", type="int", dest="numberWorkers", \
+        help="Number of processes building the geometries", \
+        metavar="NUMBERWORKERS")
+    parser.add_option("-e", "--tolerance", type="float", dest="tolerance", \
+        help="Repair the polygons and simplify them to this tolerance (degrees)", \
+        metavar="TOLERANCE")
+    parser.add_option("-o", "--output-format", dest="formatName", \
+        help="Format of the layers: shp, gpkg or fgb", metavar="FORMAT")
+    parser.add_option("-b", "--benchmark", type="int", dest="benchmark", \
+        help="Only write N synthetic polygons and report features/sec", \
+        metavar="BENCHMARK")
 
     (options, args) = parser.parse_args()
 
@@ -263,25 +593,60 @@ if __name__ == "__main__":
         removeFiles = options.removeFiles
     else:
         removeFiles = 9999
+    if options.minAgreement:
+        minAgreement = options.minAgreement
+    else:
+        minAgreement = 3
+    if options.numberWorkers:
+        numberWorkers = options.numberWorkers
+    else:
+        numberWorkers = multiprocessing.cpu_count()
+    if options.tolerance is not None:
+        tolerance = options.tolerance
+    else:
+        tolerance = None
+    if options.formatName:
+        formatName = options.formatName
+    else:
+        formatName = 'shp'
+
+    #Measuring the shapefile writing speed only
+    if options.benchmark:
+        benchmarkShapefiles(destDir, options.benchmark, numberWorkers, tolerance, \
+            formatName)
+        sys.exit(0)
+
+    #Keeping the server responses between runs
+    if options.cacheDir:
+        pybossaClient.enableCache(options.cacheDir)
+    #Reading the data from a local snapshot
+    if options.snapshotFile:
+        pybossaClient.useSnapshot(snapshot.Snapshot(options.snapshotFile))
 
     #Get the data and start analysing it
-    appId = getAppId(server, appName)
+    appId = pybossaClient.getAppId(server, appName)
     print 'App ID: ', appId
     print ''
 
     #For all tasks
     completedOnly = 0
     
-    tasksInfo = getTasks(server, appId, maxNumberTasks, completedOnly)
+    tasksInfo = pybossaClient.getTasksInfo(server, appId, maxNumberTasks, \
+        completedOnly)
     print 'Number tasks: ', len(tasksInfo)
     print ''
     
-    results = getResults(server, tasksInfo, maxNumberAnswers)
+    results = getResults(server, appId, tasksInfo, maxNumberAnswers)
     print 'Number answers: ', len(results)
     print ''
     
-    stats = generateShapefiles(results, destDir, 0)
+    stats = generateShapefiles(results, destDir, 0, numberWorkers, tolerance, \
+        formatName)
     print stats
 
+    #Areas drawn by at least minAgreement volunteers
+    numberPolygons = generateConsensus(results, tasksInfo, destDir, minAgreement, \
+        numberWorkers=numberWorkers, formatName=formatName)
+
     #To remove files older than D days
     statusRemoval = removeOldFiles(destDir,removeFiles)
@@ -0,0 +1,1016 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012 Instituto Nacional de Pesquisas Espaciais (INPE)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Purpose:
+# Client used by the result scripts to talk to the PyBossa API. Requests
+# are spread over a small pool of threads, each one keeping its own
+# keep-alive connection to the server. Task runs of large applications
+# are downloaded in pages for the whole application instead of with one
+# request per task. Responses can be kept in an on-disk cache and
+# revalidated with conditional requests. Responses are parsed one item at
+# a time, so only the fields the scripts need are kept in memory. The
+# API calls can also be served from a local snapshot (see snapshot.py).
+
+import os
+import sys
+import json
+import time
+import shutil
+import urllib2
+import resource
+import hashlib
+import tempfile
+import cStringIO
+import Queue
+import httplib
+import urlparse
+import threading
+import SocketServer
+import BaseHTTPServer
+import multiprocessing
+from optparse import OptionParser
+
+#Maximum number of items PyBossa returns in one API call
+PAGE_SIZE = 100
+
+#Number of tasks from which task runs are downloaded for the whole app
+BULK_MIN_TASKS = 50
+
+#Cache used by the fetchers (set by enableCache)
+responseCache = None
+
+#Snapshot serving the API calls instead of the server (set by useSnapshot)
+snapshotSource = None
+
+def openConnection(server):
+    """
+    Opens a persistent HTTP(S) connection to the server
+
+    :arg string server: Address of the server
+    :returns: Connection to the server
+    :rtype: httplib.HTTPConnection
+    """
+    url = urlparse.urlparse(server)
+    if url.scheme == 'https':
+        connection = httplib.HTTPSConnection(url.netloc)
+    else:
+        connection = httplib.HTTPConnection(url.netloc)
+    return connection
+
+def requestPath(server, path):
+    """
+    Builds the request path for an API call, keeping the base path of
+    the server (e.g. /pybossa)
+
+    :arg string server: Address of the server
+    :arg string path: API path, starting with /api
+    :returns: Path to be requested
+    :rtype: string
+    """
+    basePath = urlparse.urlparse(server).path.rstrip('/')
+    return basePath+path
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of a list of values
+
+    :arg list values: Values to be analysed
+    :arg float fraction: Desired percentile (0.0 to 1.0)
+    :returns: The value at the desired percentile
+    :rtype: float
+    """
+    if len(values) == 0:
+        return 0.0
+    ordered = sorted(values)
+    rank = int(round(fraction * (len(ordered) - 1)))
+    return ordered[rank]
+
+def iterJSONArray(stream, chunkSize = 65536):
+    """
+    Parses a JSON array incrementally, yielding one item at a time. Only
+    the part of the stream holding the current item is kept in memory.
+
+    :arg file stream: File-like object with a read method
+    :arg int chunkSize: Number of bytes read at a time
+    :returns: Iterator over the items of the array
+    :rtype: generator
+    """
+    decoder = json.JSONDecoder()
+    whitespace = ' \t\n\r'
+    buf = ''
+    position = 0
+    ended = False
+    started = False
+    while True:
+        #Skipping whitespace and separators
+        while position < len(buf) and (buf[position] in whitespace or \
+            (started and buf[position] == ',')):
+            position = position + 1
+        if position < len(buf):
+            if not started:
+                if buf[position] != '[':
+                    raise ValueError("Response is not a JSON array")
+                started = True
+                position = position + 1
+                continue
+            if buf[position] == ']':
+                return
+            try:
+                item, end = decoder.raw_decode(buf, position)
+            except ValueError:
+                end = None
+            #An item touching the end of the buffer may be incomplete
+            if end is not None and (end < len(buf) or ended):
+                yield item
+                position = end
+                continue
+            if ended:
+                raise ValueError("Incomplete JSON array")
+        elif ended:
+            raise ValueError("Incomplete JSON array")
+        #Reading more data, dropping what was already parsed
+        chunk = stream.read(max(chunkSize, len(buf) - position))
+        if chunk == '':
+            ended = True
+        buf = buf[position:]+chunk
+        position = 0
+
+class ResponseCache(object):
+    """
+    On-disk cache of API responses keyed by URL. Entries younger than
+    freshFor seconds are used without asking the server; older ones are
+    revalidated with If-None-Match/If-Modified-Since, so an unchanged
+    response costs a 304. Entries are evicted by age and by the total
+    size of the cache, least recently used first.
+    """
+
+    def __init__(self, directory, maxBytes = 512 * 1024 * 1024, \
+        maxAge = 30 * 86400, freshFor = 0):
+        """
+        :arg string directory: Directory of the cache
+        :arg int maxBytes: Maximum size of the cache in bytes
+        :arg int maxAge: Maximum age of an entry in seconds
+        :arg int freshFor: Seconds an entry is used without revalidation
+        """
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.maxAge = maxAge
+        self.freshFor = freshFor
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def fileName(self, url):
+        """
+        Name of the file of the entry of an URL
+
+        :arg string url: URL of the request
+        :returns: Name of the file
+        :rtype: string
+        """
+        return os.path.join(self.directory, hashlib.sha1(url).hexdigest())
+
+    def load(self, url):
+        """
+        Loads the entry of an URL. The first line of the file holds the
+        headers of the entry and the rest is the body of the response.
+
+        :arg string url: URL of the request
+        :returns: Headers ('etag', 'lastModified', 'stored') and body, or
+            None if there is no entry
+        :rtype: list
+        """
+        fileName = self.fileName(url)
+        try:
+            f = open(fileName, 'rb')
+        except IOError:
+            return None, None
+        headers = json.loads(f.readline())
+        body = f.read()
+        f.close()
+        #Marks the entry as recently used
+        os.utime(fileName, None)
+        return headers, body
+
+    def store(self, url, headers, body):
+        """
+        Stores the response of an URL
+
+        :arg string url: URL of the request
+        :arg dict headers: Headers ('etag', 'lastModified') of the response
+        :arg string body: Body of the response
+        """
+        headers = dict(headers)
+        headers['url'] = url
+        headers['stored'] = time.time()
+        descriptor, tempName = tempfile.mkstemp(dir=self.directory)
+        f = os.fdopen(descriptor, 'wb')
+        f.write(json.dumps(headers)+"\n")
+        f.write(body)
+        f.close()
+        os.rename(tempName, self.fileName(url))
+
+    def isFresh(self, headers):
+        """
+        If an entry can be used without revalidation
+
+        :arg dict headers: Headers of the entry
+        :returns: True if the entry is fresh
+        :rtype: bool
+        """
+        return time.time() - headers['stored'] < self.freshFor
+
+    def count(self, kind):
+        """
+        Counts a hit, a revalidation or a miss
+
+        :arg string kind: 'hits', 'revalidated' or 'misses'
+        """
+        with self.lock:
+            setattr(self, kind, getattr(self, kind) + 1)
+
+    def evict(self):
+        """
+        Removes the entries older than maxAge and then the least recently
+        used ones until the cache fits in maxBytes
+
+        :returns: Number of entries removed
+        :rtype: int
+        """
+        now = time.time()
+        entries = []
+        removed = 0
+        for name in os.listdir(self.directory):
+            fileName = os.path.join(self.directory, name)
+            info = os.stat(fileName)
+            if now - info.st_mtime > self.maxAge:
+                os.remove(fileName)
+                removed = removed + 1
+            else:
+                entries.append((info.st_mtime, info.st_size, fileName))
+        entries.sort()
+        totalBytes = sum([entry[1] for entry in entries])
+        for mtime, size, fileName in entries:
+            if totalBytes <= self.maxBytes:
+                break
+            os.remove(fileName)
+            totalBytes = totalBytes - size
+            removed = removed + 1
+        return removed
+
+def enableCache(directory, maxBytes = 512 * 1024 * 1024, \
+    maxAge = 30 * 86400, freshFor = 0):
+    """
+    Enables the on-disk cache for every request of this module
+
+    :arg string directory: Directory of the cache
+    :arg int maxBytes: Maximum size of the cache in bytes
+    :arg int maxAge: Maximum age of an entry in seconds
+    :arg int freshFor: Seconds an entry is used without revalidation
+    :returns: The cache
+    :rtype: ResponseCache
+    """
+    global responseCache
+    responseCache = ResponseCache(directory, maxBytes, maxAge, freshFor)
+    responseCache.evict()
+    return responseCache
+
+def useSnapshot(snapshot):
+    """
+    Serves getAppId, getTasks and getTaskRuns from a local snapshot
+    instead of the server
+
+    :arg Snapshot snapshot: The snapshot (see snapshot.py)
+    """
+    global snapshotSource
+    snapshotSource = snapshot
+
+class Fetcher(object):
+    """
+    Fetches a list of API paths using a bounded pool of worker threads.
+    Each worker keeps one keep-alive connection, so the TCP handshake is
+    paid once per worker instead of once per request. Results are
+    returned in the same order as the requested paths.
+    """
+
+    def __init__(self, server, numberWorkers = 8, retries = 2, cache = None):
+        """
+        :arg string server: Address of the server
+        :arg int numberWorkers: Maximum number of simultaneous requests
+        :arg int retries: Number of retries of a failed request
+        :arg ResponseCache cache: Cache of responses (the one set by
+            enableCache if None)
+        """
+        if cache is None:
+            cache = responseCache
+        self.cache = cache
+        self.server = server
+        self.numberWorkers = max(1, numberWorkers)
+        self.retries = retries
+        self.latencies = []
+        self.elapsed = 0.0
+        self.lock = threading.Lock()
+
+    def get(self, connection, path, convert = None):
+        """
+        Requests a path using an existing connection, reopening it if the
+        server closed it in the meantime
+
+        :arg httplib.HTTPConnection connection: Connection to be used
+        :arg string path: API path to be requested
+        :arg function convert: Applied to each item as it is parsed
+        :returns: The items of the response and the connection to be reused
+        :rtype: list
+        """
+        if convert is None:
+            convert = lambda item: item
+        url = requestPath(self.server, path)
+        key = self.server.rstrip('/')+path
+        headers = {}
+        cached = None
+        if self.cache is not None:
+            cached, cachedBody = self.cache.load(key)
+            if cached is not None:
+                if self.cache.isFresh(cached):
+                    self.cache.count('hits')
+                    return [convert(item) for item in \
+                        iterJSONArray(cStringIO.StringIO(cachedBody))], \
+                        connection
+                if cached.get('etag'):
+                    headers['If-None-Match'] = cached['etag']
+                if cached.get('lastModified'):
+                    headers['If-Modified-Since'] = cached['lastModified']
+        attempt = 0
+        while True:
+            try:
+                start = time.time()
+                connection.request('GET', url, headers=headers)
+                response = connection.getresponse()
+                if response.status == 304 and cached is not None:
+                    response.read()
+                    stream = cStringIO.StringIO(cachedBody)
+                    self.cache.store(key, cached, cachedBody)
+                    self.cache.count('revalidated')
+                elif response.status != 200:
+                    response.read()
+                    raise IOError("HTTP error "+str(response.status)+ \
+                        " for "+path)
+                elif self.cache is not None:
+                    body = response.read()
+                    stream = cStringIO.StringIO(body)
+                    self.cache.store(key, \
+                        {'etag':response.getheader('etag'), \
+                        'lastModified':response.getheader('last-modified')}, \
+                        body)
+                    self.cache.count('misses')
+                else:
+                    #Without cache the response is parsed as it arrives
+                    stream = response
+                items = [convert(item) for item in iterJSONArray(stream)]
+                #Draining the response to reuse the connection
+                response.read()
+                with self.lock:
+                    self.latencies.append(time.time() - start)
+                return items, connection
+            except (httplib.HTTPException, IOError):
+                attempt = attempt + 1
+                connection.close()
+                if attempt > self.retries:
+                    raise
+                connection = openConnection(self.server)
+
+    def worker(self, jobs, results, errors, convert):
+        """
+        Consumes the queue of jobs until it is empty
+
+        :arg Queue jobs: Queue of (position, path) to be fetched
+        :arg list results: List where each result is stored at its position
+        :arg list errors: List where the exceptions are stored
+        :arg function convert: Applied to each item as it is parsed
+        """
+        connection = openConnection(self.server)
+        while True:
+            try:
+                position, path = jobs.get_nowait()
+            except Queue.Empty:
+                break
+            try:
+                results[position], connection = self.get(connection, path, \
+                    convert)
+            except Exception as error:
+                errors.append(error)
+                break
+        connection.close()
+
+    def fetch(self, paths, convert = None):
+        """
+        Fetches all the paths and returns the decoded JSON of each one
+
+        :arg list paths: List of API paths (e.g. /api/taskrun?task_id=1)
+        :arg function convert: Applied to each item as it is parsed, so
+            only what it returns is kept
+        :returns: Decoded JSON for each path, in the same order
+        :rtype: list
+        """
+        results = [None] * len(paths)
+        errors = []
+        jobs = Queue.Queue()
+        for position in range(len(paths)):
+            jobs.put((position, paths[position]))
+        start = time.time()
+        threads = []
+        for item in range(min(self.numberWorkers, len(paths))):
+            thread = threading.Thread(target=self.worker, \
+                args=(jobs, results, errors, convert))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        self.elapsed = self.elapsed + (time.time() - start)
+        if self.cache is not None:
+            self.cache.evict()
+        if len(errors) > 0:
+            raise errors[0]
+        return results
+
+    def getStats(self):
+        """
+        Statistics about the requests done so far. The speedup is an
+        estimate: the sum of the latencies divided by the wall time spent
+        (see benchmarkFetcher for a measured one).
+
+        :returns: Number of requests, requests/sec, p50, p99 and speedup
+        :rtype: dictionary
+        """
+        numberRequests = len(self.latencies)
+        stats = {'requests':numberRequests, 'requestsPerSec':0.0, \
+            'p50':percentile(self.latencies, 0.50), \
+            'p99':percentile(self.latencies, 0.99), 'speedup':0.0}
+        if self.elapsed > 0:
+            stats['requestsPerSec'] = numberRequests / self.elapsed
+            stats['speedup'] = sum(self.latencies) / self.elapsed
+        return stats
+
+    def printStats(self):
+        """
+        Prints the statistics about the requests done so far
+        """
+        stats = self.getStats()
+        print "Requests: ", stats['requests']
+        print "Requests/sec: %.1f" % stats['requestsPerSec']
+        print "Latency p50: %.1f ms" % (stats['p50'] * 1000)
+        print "Latency p99: %.1f ms" % (stats['p99'] * 1000)
+        print "Estimated speedup over serial: %.1fx" % stats['speedup']
+        if self.cache is not None:
+            print "Cache hits: ", self.cache.hits
+            print "Cache revalidated (304): ", self.cache.revalidated
+            print "Cache misses: ", self.cache.misses
+        print ""
+
+def getJSON(server, path):
+    """
+    Gets one API path and decodes its JSON
+
+    :arg string server: Address of the server
+    :arg string path: API path, starting with /api
+    :returns: The decoded JSON
+    :rtype: list
+    """
+    return Fetcher(server, 1).fetch([path])[0]
+
+def getAppId(server, appName):
+    """
+    Get the application id given the short name
+
+    :arg string server: Address of the server
+    :arg string appName: Short name of the application
+    :returns: Numerical id of the application
+    :rtype: integer
+    """
+    if snapshotSource is not None:
+        return snapshotSource.getAppId(appName)
+    data = getJSON(server, "/api/app?short_name="+appName)
+    appId = data[0]['id']
+    return appId
+
+def getTasks(server, appId, maxNumberTasks = None, completedOnly = 0):
+    """
+    Get the tasks of a particular application from the server.
+
+    :arg string server: Address of the server
+    :arg int appId: ID of the application to be analysed
+    :arg integer maxNumberTasks: Maximum number of tasks to be downloaded
+    :arg int completedOnly: If we'll get only completed tasks
+    :returns: Tasks of the application, as given by the API
+    :rtype: list
+    """
+    if snapshotSource is not None:
+        return snapshotSource.getTasks(maxNumberTasks, completedOnly)
+    path = "/api/task?app_id="+str(appId)
+    if completedOnly == 1:
+        path = path+"&state=completed"
+    if maxNumberTasks is not None:
+        path = path+"&limit="+str(maxNumberTasks)
+    return getJSON(server, path)
+
+def getTasksInfo(server, appId, maxNumberTasks, completedOnly):
+    """
+    Get the ID and the area of the tasks of an application whose tasks
+    are tiles (best tile and deforested areas)
+
+    :arg string server: Address of the server
+    :arg int appId: ID of the application to be analysed
+    :arg integer maxNumberTasks: Maximum number of tasks to be downloaded
+    :arg int completedOnly: If we'll get only completed tasks
+    :returns: Tasks info for the application
+    :rtype: list
+    """
+    data = getTasks(server, appId, maxNumberTasks, completedOnly)
+    numberTasks = len(data)
+    tasksInfo = []
+    for item in range(numberTasks):
+        tasksInfo.append({'taskId':data[item]['id'], \
+            'area':data[item]['info']['tile']['restrictedExtent']})
+    return tasksInfo
+
+def getTaskRunsByApp(server, appId, pageSize = PAGE_SIZE, numberWorkers = 8, \
+    convert = None):
+    """
+    Downloads all the task runs of an application paging through
+    /api/taskrun?app_id=X and groups them by task on the client. Pages
+    are requested numberWorkers at a time until a short page shows up.
+
+    :arg string server: Address of the server
+    :arg int appId: ID of the application
+    :arg int pageSize: Number of task runs per request
+    :arg int numberWorkers: Number of simultaneous requests to the server
+    :arg function convert: Applied to each task run as it is parsed
+    :returns: Task runs of each task (sorted by id) and the fetcher used
+    :rtype: dictionary, Fetcher
+    """
+    if convert is None:
+        convert = lambda taskRun: taskRun
+    #Keeping the keys to group and sort the converted task runs
+    keyed = lambda taskRun: (taskRun['task_id'], taskRun['id'], \
+        convert(taskRun))
+    fetcher = Fetcher(server, numberWorkers)
+    taskRuns = {}
+    offset = 0
+    lastPage = False
+    while not lastPage:
+        paths = []
+        for item in range(fetcher.numberWorkers):
+            paths.append("/api/taskrun?app_id="+str(appId)+"&limit="+ \
+                str(pageSize)+"&offset="+str(offset))
+            offset = offset + pageSize
+        pages = fetcher.fetch(paths, keyed)
+        for page in pages:
+            if len(page) < pageSize:
+                lastPage = True
+            for taskId, taskRunId, taskRun in page:
+                taskRuns.setdefault(taskId, []).append((taskRunId, taskRun))
+    for taskId in taskRuns:
+        taskRuns[taskId].sort(key=lambda item: item[0])
+        taskRuns[taskId] = [item[1] for item in taskRuns[taskId]]
+    return taskRuns, fetcher
+
+def getTaskRuns(server, appId, tasksId, maxNumberAnswers = None, \
+    numberWorkers = 8, bulk = None, convert = None):
+    """
+    Gets the task runs of a list of tasks, either with one request per
+    task or in bulk for the whole application. When bulk is None the bulk
+    mode is selected for applications with at least BULK_MIN_TASKS tasks.
+
+    :arg string server: Address of the server
+    :arg int appId: ID of the application
+    :arg list tasksId: List of task IDs
+    :arg int maxNumberAnswers: Maximum number of answers per task (None for all)
+    :arg int numberWorkers: Number of simultaneous requests to the server
+    :arg int bulk: 1 for bulk mode, 0 for one request per task, None for auto
+    :arg function convert: Applied to each task run as it is parsed, so
+        only what it returns is kept
+    :returns: Task runs for each task, in the same order as tasksId, and
+        the fetcher used
+    :rtype: list, Fetcher
+    """
+    if snapshotSource is not None:
+        #No request is made; the fetcher is returned for its stats
+        dataTasks = snapshotSource.getTaskRuns(tasksId, maxNumberAnswers, \
+            convert)
+        return dataTasks, Fetcher(server, numberWorkers)
+    if bulk is None:
+        bulk = int(len(tasksId) >= BULK_MIN_TASKS)
+    if bulk == 1:
+        taskRuns, fetcher = getTaskRunsByApp(server, appId, PAGE_SIZE, \
+            numberWorkers, convert)
+        dataTasks = []
+        for taskId in tasksId:
+            dataTasks.append(taskRuns.get(taskId, [])[:maxNumberAnswers])
+        return dataTasks, fetcher
+    paths = []
+    for taskId in tasksId:
+        path = "/api/taskrun?app_id="+str(appId)+"&task_id="+str(taskId)
+        if maxNumberAnswers is not None:
+            path = path+"&limit="+str(maxNumberAnswers)
+        paths.append(path)
+    fetcher = Fetcher(server, numberWorkers)
+    dataTasks = fetcher.fetch(paths, convert)
+    return dataTasks, fetcher
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers the API calls of a stub PyBossa server (see StubServer.answer)
+    after a fixed delay (the server time). Responses carry an ETag, and
+    a request whose If-None-Match matches it gets a 304 without body.
+    A request with stream_bytes=N gets a generated array of task runs of
+    about N bytes instead (see streamTaskRuns).
+    """
+
+    protocol_version = 'HTTP/1.1'
+    #Headers and body go out in one write, as a real server sends them
+    wbufsize = 65536
+    #Task run as PyBossa gives it (about 500 bytes)
+    taskRunTemplate = '{"id": %d, "task_id": %d, "app_id": 1, "user_id": %d, ' \
+        '"user_ip": null, "created": "2013-05-02T14:21:07.531288", ' \
+        '"finish_time": "2013-05-02T14:22:41.108923", "timeout": null, ' \
+        '"calibration": null, "info": {"answer": "%s", "area": "POLYGON ' \
+        '((-55.3102 -3.1024, -55.2871 -3.1024, -55.2871 -3.1262, -55.3102 ' \
+        '-3.1262, -55.3102 -3.1024), (-55.3004 -3.1101, -55.2950 -3.1101, ' \
+        '-55.2950 -3.1154, -55.3004 -3.1154, -55.3004 -3.1101))", ' \
+        '"zoom": 14, "comment": ""}}'
+
+    def streamTaskRuns(self, numberBytes, batchSize = 1000):
+        """
+        Sends a generated array of task runs of about numberBytes bytes,
+        a batch at a time, so the stub never holds the whole response.
+        The end of the response is marked by closing the connection.
+
+        :arg int numberBytes: Size of the response
+        :arg int batchSize: Number of task runs generated at a time
+        """
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = 1
+        self.wfile.write('[')
+        written = 1
+        taskRunId = 1
+        while written < numberBytes:
+            batch = ','.join([self.taskRunTemplate % (item, item / 30 + 1, \
+                item % 500, ['Yes', 'No'][item % 2]) \
+                for item in range(taskRunId, taskRunId + batchSize)])
+            if taskRunId > 1:
+                batch = ','+batch
+            self.wfile.write(batch)
+            written = written + len(batch)
+            taskRunId = taskRunId + batchSize
+        self.wfile.write(']')
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        number = self.server.countRequest()
+        query = urlparse.parse_qs(url.query)
+        if 'stream_bytes' in query:
+            self.streamTaskRuns(int(query['stream_bytes'][0]))
+            return
+        time.sleep(self.server.latency)
+        if self.server.failAfter is not None and \
+            number > self.server.failAfter:
+            status = 500
+            body = json.dumps({'status':'failed'})
+        else:
+            status = 200
+            body = json.dumps(self.server.answer(url.path, query))
+        etag = '"'+hashlib.sha1(body).hexdigest()+'"'
+        if status == 200 and self.headers.getheader('If-None-Match') == etag:
+            self.server.countNotModified()
+            status = 304
+            body = ''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if status != 500:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        return
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Stub PyBossa server on localhost, one thread per connection. It
+    counts the requests and the 304 answers and, once failAfter requests
+    were answered, fails the following ones with HTTP 500.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency = 0.02, answersPerTask = 30, numberTasks = 100):
+        """
+        :arg float latency: Seconds each request takes on the server
+        :arg int answersPerTask: Number of task runs of each task
+        :arg int numberTasks: Number of tasks of the application
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.latency = latency
+        self.answersPerTask = answersPerTask
+        self.numberTasks = numberTasks
+        self.failAfter = None
+        self.numberRequests = 0
+        self.numberNotModified = 0
+        self.lock = threading.Lock()
+
+    def countRequest(self):
+        """
+        Counts a request
+
+        :returns: Number of requests so far, this one included
+        :rtype: int
+        """
+        with self.lock:
+            self.numberRequests = self.numberRequests + 1
+            return self.numberRequests
+
+    def countNotModified(self):
+        """
+        Counts a request answered with 304
+        """
+        with self.lock:
+            self.numberNotModified = self.numberNotModified + 1
+
+    def taskRuns(self, taskId):
+        """
+        Task runs of a task (IDs taskId * 1000 + 0, 1, ...)
+
+        :arg int taskId: ID of the task
+        :returns: The task runs
+        :rtype: list
+        """
+        return [{'id':taskId * 1000 + item, 'task_id':taskId, 'app_id':1, \
+            'info':'Yes'} for item in range(self.answersPerTask)]
+
+    def answer(self, path, query):
+        """
+        Items of an API call: /api/app, /api/task and /api/taskrun, the
+        last one for one task (task_id) or for the whole application,
+        with last_id, offset and limit as PyBossa pages them
+
+        :arg string path: Path of the request
+        :arg dict query: Parsed query of the request
+        :returns: Items of the response
+        :rtype: list
+        """
+        resource = path.rstrip('/').split('/')[-1]
+        if resource == 'app':
+            return [{'id':1, 'short_name':query.get('short_name', \
+                ['stub'])[0]}]
+        if resource == 'task':
+            items = [{'id':taskId, 'app_id':1, 'state':'ongoing'} \
+                for taskId in range(1, self.numberTasks + 1)]
+        elif 'task_id' in query:
+            items = self.taskRuns(int(query['task_id'][0]))
+        else:
+            items = []
+            for taskId in range(1, self.numberTasks + 1):
+                items.extend(self.taskRuns(taskId))
+        lastId = int(query.get('last_id', ['0'])[0])
+        offset = int(query.get('offset', ['0'])[0])
+        items = [item for item in items if item['id'] > lastId][offset:]
+        if 'limit' in query:
+            items = items[:int(query['limit'][0])]
+        return items
+
+def benchmarkFetcher(numberTasks = 1056, numberWorkers = 8, latency = 0.02, \
+    answersPerTask = 30):
+    """
+    Fetches the task runs of numberTasks tasks from a local stub server,
+    first as the scripts used to (one urllib2.urlopen per task, one after
+    another) and then with a Fetcher, and prints both
+
+    :arg int numberTasks: Number of tasks
+    :arg int numberWorkers: Number of simultaneous requests of the Fetcher
+    :arg float latency: Seconds each request takes on the server
+    :arg int answersPerTask: Number of task runs of each task
+    :returns: Measured speedup of the Fetcher over the serial fetch
+    :rtype: float
+    """
+    stub = StubServer(latency, answersPerTask)
+    thread = threading.Thread(target=stub.serve_forever)
+    thread.daemon = True
+    thread.start()
+    server = "http://127.0.0.1:"+str(stub.server_address[1])
+    paths = ["/api/taskrun?app_id=1&task_id="+str(taskId) \
+        for taskId in range(1, numberTasks + 1)]
+
+    #Serial path: a new connection and a blocking request per task
+    latencies = []
+    start = time.time()
+    for path in paths:
+        requestStart = time.time()
+        json.loads(urllib2.urlopen(server+path).read())
+        latencies.append(time.time() - requestStart)
+    serialTime = time.time() - start
+    print "Serial: %d requests in %.2f s, %.1f requests/sec, p50 %.1f ms, " \
+        "p99 %.1f ms" % (numberTasks, serialTime, numberTasks / serialTime, \
+        percentile(latencies, 0.50) * 1000, percentile(latencies, 0.99) * 1000)
+
+    #Concurrent path, with keep-alive connections
+    fetcher = Fetcher(server, numberWorkers, cache=None)
+    start = time.time()
+    results = fetcher.fetch(paths)
+    fetcherTime = time.time() - start
+    if [len(result) for result in results] != [answersPerTask] * numberTasks:
+        raise ValueError("Wrong number of task runs from the stub server")
+    stats = fetcher.getStats()
+    print "Fetcher (%d workers): %d requests in %.2f s, %.1f requests/sec, " \
+        "p50 %.1f ms, p99 %.1f ms" % (fetcher.numberWorkers, numberTasks, \
+        fetcherTime, stats['requestsPerSec'], stats['p50'] * 1000, \
+        stats['p99'] * 1000)
+    print "Measured speedup over serial: %.1fx" % (serialTime / fetcherTime)
+    stub.shutdown()
+    stub.server_close()
+    return serialTime / fetcherTime
+
+def measurePeakMemory(server, path, parser, queue):
+    """
+    Gets a response, keeping the ID and the answer of each task run, and
+    puts the number of task runs, the peak RSS (MB) of this process at
+    start and at the end and the elapsed time in the queue. It is run in
+    a process of its own, so the peak is that of one path only.
+
+    :arg string server: Address of the server
+    :arg string path: API path to be requested
+    :arg string parser: stream (iterJSONArray, through a Fetcher) or
+        json.load (the whole response, as the scripts used to)
+    :arg multiprocessing.Queue queue: Queue for the measures
+    """
+    startRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    startTime = time.time()
+    convert = lambda taskRun: (taskRun['id'], taskRun['info']['answer'])
+    if parser == 'stream':
+        items = Fetcher(server, 1, cache=None).fetch([path], convert)[0]
+    else:
+        items = [convert(taskRun) for taskRun in \
+            json.load(urllib2.urlopen(server+path))]
+    elapsedTime = time.time() - startTime
+    peakRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    queue.put((len(items), startRss, peakRss, elapsedTime))
+
+def benchmarkMemory(megabytes = 500):
+    """
+    Gets a generated array of task runs of about megabytes MB from a
+    local stub server, parsing it with iterJSONArray and with json.load,
+    each in a process of its own, and prints the peak RSS of both
+
+    :arg int megabytes: Size of the response
+    :returns: Peak RSS (MB) of the streaming and json.load paths (None
+        for a path whose process failed, e.g. out of memory)
+    :rtype: list
+    """
+    stub = StubServer(0.0)
+    thread = threading.Thread(target=stub.serve_forever)
+    thread.daemon = True
+    thread.start()
+    server = "http://127.0.0.1:"+str(stub.server_address[1])
+    path = "/api/taskrun?app_id=1&stream_bytes="+str(megabytes * 1048576)
+    peaks = []
+    for parser in ['stream', 'json.load']:
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=measurePeakMemory, \
+            args=(server, path, parser, queue))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            print "%s: failed (exit code %d)" % (parser, process.exitcode)
+            peaks.append(None)
+            continue
+        numberItems, startRss, peakRss, elapsedTime = queue.get()
+        print "%s: %d task runs (%d MB) in %.1f s, peak RSS %.1f MB " \
+            "(%.1f MB at start)" % (parser, numberItems, megabytes, \
+            elapsedTime, peakRss, startRss)
+        peaks.append(peakRss)
+    if None not in peaks:
+        print "Peak RSS of the streaming path: %.1f%% of json.load" % \
+            (100.0 * peaks[0] / peaks[1])
+    stub.shutdown()
+    stub.server_close()
+    return peaks
+
+def checkCache(numberTasks = 100, numberWorkers = 8):
+    """
+    Fetches the task runs of numberTasks tasks from a local stub server
+    three times through a ResponseCache: into an empty cache, again
+    revalidating every entry, and again with the entries fresh. Checks
+    that the second pass gets only 304s and the third makes no request.
+
+    :arg int numberTasks: Number of tasks
+    :arg int numberWorkers: Number of simultaneous requests
+    :returns: Requests made by each pass
+    :rtype: list
+    """
+    stub = StubServer(0.0, 30, numberTasks)
+    thread = threading.Thread(target=stub.serve_forever)
+    thread.daemon = True
+    thread.start()
+    server = "http://127.0.0.1:"+str(stub.server_address[1])
+    paths = ["/api/taskrun?app_id=1&task_id="+str(taskId) \
+        for taskId in range(1, numberTasks + 1)]
+    directory = tempfile.mkdtemp()
+    cache = ResponseCache(directory)
+    requests = []
+    try:
+        expected = None
+        for freshFor in [0, 0, 3600]:
+            cache.freshFor = freshFor
+            numberRequests = stub.numberRequests
+            numberNotModified = stub.numberNotModified
+            results = Fetcher(server, numberWorkers, cache=cache).fetch(paths)
+            if expected is None:
+                expected = results
+            elif results != expected:
+                raise ValueError("The cache changed the task runs")
+            requests.append(stub.numberRequests - numberRequests)
+            print "Pass (freshFor %d s): %d requests, %d answered with 304" % \
+                (freshFor, requests[-1], stub.numberNotModified - \
+                numberNotModified)
+        print "Cache hits: %d, revalidated: %d, misses: %d" % (cache.hits, \
+            cache.revalidated, cache.misses)
+        if requests != [numberTasks, numberTasks, 0] or \
+            stub.numberNotModified != numberTasks or \
+            [cache.misses, cache.revalidated, cache.hits] != [numberTasks] * 3:
+            raise ValueError("The cache didn't save the expected requests")
+    finally:
+        stub.shutdown()
+        stub.server_close()
+        shutil.rmtree(directory)
+    return requests
+
+#######################
+# Begin of the script #
+#######################
+
+if __name__ == "__main__":
+
+    # Arguments for the application
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage)
+
+    parser.add_option("-t", "--number-tasks", type="int", dest="numberTasks", \
+        help="Number of tasks fetched from the stub server", metavar="NUMBERTASKS")
+    parser.add_option("-w", "--workers", type="int", dest="numberWorkers", \
+        help="Number of simultaneous requests", metavar="NUMBERWORKERS")
+    parser.add_option("-l", "--latency", type="float", dest="latency", \
+        help="Milliseconds each request takes on the stub server", \
+        metavar="LATENCY")
+    parser.add_option("-c", "--check-cache", action="store_true", \
+        dest="checkCache", help="Checks the response cache against the " \
+        "stub server and exits")
+    parser.add_option("-m", "--memory", type="int", dest="memoryMegabytes", \
+        help="Measures the peak memory of parsing a response of this many " \
+        "MB and exits", metavar="MEGABYTES")
+
+    (options, args) = parser.parse_args()
+
+    if options.checkCache:
+        checkCache()
+        sys.exit(0)
+    if options.memoryMegabytes:
+        benchmarkMemory(options.memoryMegabytes)
+        sys.exit(0)
+
+    if options.numberTasks:
+        numberTasks = options.numberTasks
+    else:
+        numberTasks = 1056
+    if options.numberWorkers:
+        numberWorkers = options.numberWorkers
+    else:
+        numberWorkers = 8
+    if options.latency is not None:
+        latency = options.latency / 1000.0
+    else:
+        latency = 0.02
+
+    benchmarkFetcher(numberTasks, numberWorkers, latency)
+    sys.exit(0)
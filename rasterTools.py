@@ -0,0 +1,924 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012 Instituto Nacional de Pesquisas Espaciais (INPE)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Purpose:
+# Raster helpers shared by the scripts that cut and merge images. They
+# work in the same process through the GDAL bindings instead of calling
+# the GDAL command line utilities. Every GeoTIFF is written with the same
+# profile: tiled, compressed with a predictor and with internal overviews,
+# so MapServer reads only the tiles and the level it needs.
+
+import os
+import sys
+import math
+import time
+import gdal
+import shutil
+import tempfile
+import subprocess
+import numpy
+from gdalconst import *
+from optparse import OptionParser
+
+#NumPy types of the GDAL data types
+NUMPY_TYPES = {GDT_Byte:numpy.uint8, GDT_UInt16:numpy.uint16, \
+    GDT_Int16:numpy.int16, GDT_UInt32:numpy.uint32, GDT_Int32:numpy.int32, \
+    GDT_Float32:numpy.float32, GDT_Float64:numpy.float64}
+
+#Creation options of every GeoTIFF (a predictor is added by creationOptions)
+GTIFF_OPTIONS = ['TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256', \
+    'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER']
+
+#A mosaic updated in place is compacted (copied with the profile) when
+#the blocks rewritten since the last copy reach this fraction of it
+COMPACT_FRACTION = 0.25
+
+#Overviews are built down to this size (rasters smaller get none)
+OVERVIEW_MIN_SIZE = 256
+
+def creationOptions(formatFile, dataType, paletted = False):
+    """
+    Creation options of a raster written by the scripts
+
+    :arg string formatFile: GDAL driver used to write the file
+    :arg int dataType: GDAL data type of the bands
+    :arg bool paletted: If the first band has a colour table (the
+        predictor doesn't help palette indexes)
+    :returns: Creation options (empty for drivers other than GTiff)
+    :rtype: list
+    """
+    if formatFile != "GTiff":
+        return []
+    options = list(GTIFF_OPTIONS)
+    if dataType in [GDT_Float32, GDT_Float64]:
+        options.append('PREDICTOR=3')
+    elif not paletted:
+        options.append('PREDICTOR=2')
+    return options
+
+def overviewLevels(xSize, ySize, minSize = OVERVIEW_MIN_SIZE):
+    """
+    Overview levels (2, 4, 8, ...) of a raster down to a minimum size
+
+    :arg int xSize: Number of columns
+    :arg int ySize: Number of lines
+    :arg int minSize: Size (largest side) of the smallest overview
+    :returns: The levels
+    :rtype: list
+    """
+    levels = []
+    level = 2
+    while max(xSize, ySize) / level >= minSize:
+        levels.append(level)
+        level = level * 2
+    return levels
+
+def buildOverviews(dataset, resampling = "AVERAGE"):
+    """
+    Builds (or rebuilds) the internal overviews of a GeoTIFF. Paletted
+    rasters always use NEAREST, so no new colours are made up.
+
+    :arg gdal.Dataset dataset: The raster, opened for writing
+    :arg string resampling: Resampling of the overviews
+    """
+    if dataset.GetDriver().ShortName != "GTiff":
+        return
+    if dataset.GetRasterBand(1).GetRasterColorTable() is not None:
+        resampling = "NEAREST"
+    levels = overviewLevels(dataset.RasterXSize, dataset.RasterYSize)
+    if levels != []:
+        dataset.BuildOverviews(resampling, levels)
+
+def downsampleWindow(data, factor, resampling = "AVERAGE"):
+    """
+    Reduces a window of a band by an overview factor, as BuildOverviews
+    does. Pixels beyond the edge of a partial block are left out.
+
+    :arg numpy.ndarray data: Pixel values of the window (lines x columns)
+    :arg int factor: Overview factor (2, 4, 8, ...)
+    :arg string resampling: AVERAGE or NEAREST
+    :returns: Pixel values of the window in the overview
+    :rtype: numpy.ndarray
+    """
+    ySize, xSize = data.shape
+    lines = (ySize + factor - 1) / factor
+    columns = (xSize + factor - 1) / factor
+    if resampling == "NEAREST":
+        rows = numpy.minimum(numpy.arange(lines) * factor + factor / 2, \
+            ySize - 1)
+        cols = numpy.minimum(numpy.arange(columns) * factor + factor / 2, \
+            xSize - 1)
+        return data.take(rows, axis=0).take(cols, axis=1)
+    padded = numpy.empty((lines * factor, columns * factor), numpy.float64)
+    padded.fill(numpy.nan)
+    padded[:ySize, :xSize] = data
+    reduced = numpy.nanmean(padded.reshape(lines, factor, columns, factor), \
+        axis=(1, 3))
+    if data.dtype.kind in 'iu':
+        reduced = numpy.floor(reduced + 0.5)
+    return reduced.astype(data.dtype)
+
+def updateOverviews(dataset, windows, resampling = "AVERAGE"):
+    """
+    Rebuilds the existing overviews of a raster only over some windows of
+    its full resolution bands. The windows are read at full resolution,
+    since a reduced read would come from the overviews being rebuilt.
+    Resamplings other than AVERAGE and NEAREST rebuild all overviews.
+
+    :arg gdal.Dataset dataset: The raster, opened for writing
+    :arg list windows: Changed windows (xOff, yOff, xSize, ySize)
+    :arg string resampling: Resampling of the overviews
+    """
+    if dataset.GetRasterBand(1).GetRasterColorTable() is not None:
+        resampling = "NEAREST"
+    if resampling not in ["AVERAGE", "NEAREST"]:
+        buildOverviews(dataset, resampling)
+        return
+    for item in range(dataset.RasterCount):
+        band = dataset.GetRasterBand(item+1)
+        for level in range(band.GetOverviewCount()):
+            overview = band.GetOverview(level)
+            factor = int(round(band.XSize / float(overview.XSize)))
+            for xOff, yOff, xSize, ySize in windows:
+                #Window aligned to the pixels of the overview
+                xStart = xOff / factor
+                yStart = yOff / factor
+                xEnd = min((xOff + xSize + factor - 1) / factor, overview.XSize)
+                yEnd = min((yOff + ySize + factor - 1) / factor, overview.YSize)
+                if xEnd <= xStart or yEnd <= yStart:
+                    continue
+                data = band.ReadAsArray(xStart * factor, yStart * factor, \
+                    min(xEnd * factor, band.XSize) - xStart * factor, \
+                    min(yEnd * factor, band.YSize) - yStart * factor)
+                data = downsampleWindow(data, factor, resampling)
+                overview.WriteArray(data[:yEnd - yStart, :xEnd - xStart], \
+                    xStart, yStart)
+
+def geoToPixel(geoTransform, minX, minY, maxX, maxY):
+    """
+    Converts a geographic extent to a pixel window, rounding as
+    gdal_translate -projwin does
+
+    :arg tuple geoTransform: Geotransform of the image
+    :arg float minX: Left limit of the extent
+    :arg float minY: Lower limit of the extent
+    :arg float maxX: Right limit of the extent
+    :arg float maxY: Upper limit of the extent
+    :returns: Offset and size (xOff, yOff, xSize, ySize) of the window
+    :rtype: list
+    """
+    xOff = int(math.floor((minX - geoTransform[0]) / geoTransform[1] + 0.001))
+    yOff = int(math.floor((maxY - geoTransform[3]) / geoTransform[5] + 0.001))
+    xSize = int((maxX - minX) / geoTransform[1] + 0.5)
+    ySize = int((minY - maxY) / geoTransform[5] + 0.5)
+    return xOff, yOff, xSize, ySize
+
+def windowGeoTransform(geoTransform, xOff, yOff):
+    """
+    Geotransform of a window starting at the given pixel offset
+
+    :arg tuple geoTransform: Geotransform of the image
+    :arg int xOff: Column of the first pixel of the window
+    :arg int yOff: Line of the first pixel of the window
+    :returns: Geotransform of the window
+    :rtype: tuple
+    """
+    return (geoTransform[0] + xOff * geoTransform[1] + yOff * geoTransform[2], \
+        geoTransform[1], geoTransform[2], \
+        geoTransform[3] + xOff * geoTransform[4] + yOff * geoTransform[5], \
+        geoTransform[4], geoTransform[5])
+
+def windowExtent(geoTransform, xSize, ySize):
+    """
+    Geographic extent of a window with the given geotransform and size
+
+    :arg tuple geoTransform: Geotransform of the window
+    :arg int xSize: Number of columns
+    :arg int ySize: Number of lines
+    :returns: Extent of the window (minX, minY, maxX, maxY)
+    :rtype: list
+    """
+    minX = geoTransform[0]
+    maxX = geoTransform[0] + xSize * geoTransform[1]
+    maxY = geoTransform[3]
+    minY = geoTransform[3] + ySize * geoTransform[5]
+    return minX, minY, maxX, maxY
+
+def mosaicGrid(extents, pixelWidth, pixelHeight):
+    """
+    Grid covering the union of a list of extents, as gdal_merge.py builds
+    it for its output
+
+    :arg list extents: List of extents (minX, minY, maxX, maxY)
+    :arg float pixelWidth: Width of the pixels
+    :arg float pixelHeight: Height of the pixels (negative, north up)
+    :returns: Geotransform, number of columns and number of lines
+    :rtype: list
+    """
+    minX = min([extent[0] for extent in extents])
+    minY = min([extent[1] for extent in extents])
+    maxX = max([extent[2] for extent in extents])
+    maxY = max([extent[3] for extent in extents])
+    geoTransform = (minX, pixelWidth, 0.0, maxY, 0.0, pixelHeight)
+    xSize = int((maxX - minX) / pixelWidth + 0.5)
+    ySize = int((minY - maxY) / pixelHeight + 0.5)
+    return geoTransform, xSize, ySize
+
+def blockWindows(band, minLines = 256):
+    """
+    Windows covering a band in its natural blocks. Strips of a few lines
+    (blocks as wide as the band) are grouped to at least minLines lines.
+
+    :arg gdal.Band band: The band
+    :arg int minLines: Minimum number of lines of a window of strips
+    :returns: Iterator over the windows (xOff, yOff, xSize, ySize)
+    :rtype: generator
+    """
+    xBlock, yBlock = band.GetBlockSize()
+    xBlock = max(1, xBlock)
+    yBlock = max(1, yBlock)
+    if xBlock >= band.XSize:
+        yBlock = yBlock * max(1, minLines / yBlock)
+    for yOff in range(0, band.YSize, yBlock):
+        ySize = min(yBlock, band.YSize - yOff)
+        for xOff in range(0, band.XSize, xBlock):
+            yield xOff, yOff, min(xBlock, band.XSize - xOff), ySize
+
+def writeRaster(destName, data, geoTransform, projection, \
+    formatFile = "GTiff", dataType = GDT_Byte):
+    """
+    Writes an array (bands x lines x columns) as a georeferenced raster,
+    with the GeoTIFF profile (see creationOptions) and overviews. Drivers
+    that can only copy (e.g. PNG) are written through a dataset in memory.
+
+    :arg string destName: Name of the file to be written
+    :arg numpy.ndarray data: Pixel values of every band
+    :arg tuple geoTransform: Geotransform of the raster
+    :arg string projection: Projection of the raster (WKT)
+    :arg string formatFile: GDAL driver used to write the file
+    :arg int dataType: GDAL data type of the bands
+
+    :returns: Nothing
+    """
+    numberBands, ySize, xSize = data.shape
+    driver = gdal.GetDriverByName(formatFile)
+    options = creationOptions(formatFile, dataType)
+    if driver.GetMetadataItem(gdal.DCAP_CREATE) == 'YES':
+        dest = driver.Create(destName, xSize, ySize, numberBands, dataType, \
+            options)
+        memory = None
+    else:
+        memory = gdal.GetDriverByName("MEM").Create('', xSize, ySize, \
+            numberBands, dataType)
+        dest = memory
+    dest.SetGeoTransform(geoTransform)
+    dest.SetProjection(projection)
+    for item in range(numberBands):
+        dest.GetRasterBand(item+1).WriteArray(data[item])
+    if memory is not None:
+        dest = driver.CreateCopy(destName, memory, options=options)
+    else:
+        buildOverviews(dest)
+    dest = None
+    memory = None
+    return
+
+class ColourRamp(object):
+    """
+    Colour ramp for classifying values by a list of breaks. The colours
+    are kept in a lookup table applied to all values at once. The ramp
+    also gives palette indexes and the colour table for a single band
+    paletted raster.
+    """
+
+    def __init__(self, breaks, colours, background = (0, 0, 0)):
+        """
+        :arg list breaks: Ascending breaks; a value v gets the colour of
+            the number of breaks less or equal to v
+        :arg list colours: RGB colours, one more than the number of breaks
+        :arg tuple background: RGB colour of the areas without values
+            (palette index 0)
+        """
+        if len(colours) != len(breaks) + 1:
+            raise ValueError("A colour ramp needs one colour more than breaks")
+        self.breaks = numpy.asarray(breaks, dtype=numpy.float64)
+        self.colours = numpy.asarray(colours, dtype=numpy.uint8)
+        self.background = background
+
+    def classify(self, values):
+        """
+        Class of each value in the ramp
+
+        :arg numpy.ndarray values: Values to be classified
+        :returns: Position of the colour of each value
+        :rtype: numpy.ndarray
+        """
+        return numpy.searchsorted(self.breaks, \
+            numpy.asarray(values, dtype=numpy.float64), side='right')
+
+    def lookup(self, values):
+        """
+        RGB colour of each value
+
+        :arg numpy.ndarray values: Values to be coloured
+        :returns: Matrix (values x 3) with the colours
+        :rtype: numpy.ndarray
+        """
+        return self.colours.take(self.classify(values), axis=0)
+
+    def paletteIndex(self, values):
+        """
+        Index of each value in the colour table given by colourTable
+
+        :arg numpy.ndarray values: Values to be coloured
+        :returns: Palette index of each value
+        :rtype: numpy.ndarray
+        """
+        return self.classify(values) + 1
+
+    def colourTable(self):
+        """
+        Colour table for a paletted raster, with the background at index 0
+
+        :returns: The colour table
+        :rtype: gdal.ColorTable
+        """
+        table = gdal.ColorTable()
+        table.SetColorEntry(0, tuple(self.background) + (255,))
+        for item in range(len(self.colours)):
+            colour = self.colours[item]
+            table.SetColorEntry(item+1, (int(colour[0]), int(colour[1]), \
+                int(colour[2]), 255))
+        return table
+
+class WindowCutter(object):
+    """
+    Cuts windows from source images read in this process. Each source
+    image is opened once and kept open, so a cut costs only the read of
+    its window.
+    """
+
+    def __init__(self):
+        self.datasets = {}
+
+    def open(self, fileName):
+        """
+        Opens a source image, reusing the handle if it is already open
+
+        :arg string fileName: Name of the source image
+        :returns: The dataset of the image
+        :rtype: gdal.Dataset
+        """
+        dataset = self.datasets.get(fileName)
+        if dataset is None:
+            dataset = gdal.Open(fileName, GA_ReadOnly)
+            if dataset is None:
+                raise IOError("Error opening file "+fileName)
+            self.datasets[fileName] = dataset
+        return dataset
+
+    def locate(self, fileName, area):
+        """
+        Finds the pixel window of a geographic extent in a source image,
+        clipped to the image, without reading any pixel
+
+        :arg string fileName: Name of the source image
+        :arg list area: Extent to be located (minX, minY, maxX, maxY)
+        :returns: Window (xOff, yOff, xSize, ySize) and its geotransform,
+            or None if the extent is outside the image
+        :rtype: list
+        """
+        dataset = self.open(fileName)
+        geoTransform = dataset.GetGeoTransform()
+        xOff, yOff, xSize, ySize = geoToPixel(geoTransform, area[0], \
+            area[1], area[2], area[3])
+        xEnd = min(xOff + xSize, dataset.RasterXSize)
+        yEnd = min(yOff + ySize, dataset.RasterYSize)
+        xOff = max(xOff, 0)
+        yOff = max(yOff, 0)
+        if xEnd <= xOff or yEnd <= yOff:
+            return None, None
+        window = (xOff, yOff, xEnd - xOff, yEnd - yOff)
+        return window, windowGeoTransform(geoTransform, xOff, yOff)
+
+    def readWindow(self, fileName, xOff, yOff, xSize, ySize):
+        """
+        Reads a window of every band of a source image. The window is
+        clipped to the image.
+
+        :arg string fileName: Name of the source image
+        :arg int xOff: Column of the first pixel
+        :arg int yOff: Line of the first pixel
+        :arg int xSize: Number of columns
+        :arg int ySize: Number of lines
+        :returns: Pixel values (bands x lines x columns) and the clipped
+            window (xOff, yOff, xSize, ySize), or None if it is outside
+        :rtype: list
+        """
+        dataset = self.open(fileName)
+        xEnd = min(xOff + xSize, dataset.RasterXSize)
+        yEnd = min(yOff + ySize, dataset.RasterYSize)
+        xOff = max(xOff, 0)
+        yOff = max(yOff, 0)
+        if xEnd <= xOff or yEnd <= yOff:
+            return None, None
+        window = (xOff, yOff, xEnd - xOff, yEnd - yOff)
+        data = dataset.ReadAsArray(window[0], window[1], window[2], window[3])
+        if data.ndim == 2:
+            data = data.reshape((1,) + data.shape)
+        return data, window
+
+    def cutWindow(self, fileName, xOff, yOff, xSize, ySize, destName, \
+        formatFile = "GTiff"):
+        """
+        Cuts a pixel window of a source image into a new file, as
+        gdal_translate -srcwin does
+
+        :arg string fileName: Name of the source image
+        :arg int xOff: Column of the first pixel
+        :arg int yOff: Line of the first pixel
+        :arg int xSize: Number of columns
+        :arg int ySize: Number of lines
+        :arg string destName: Name of the file to be written
+        :arg string formatFile: GDAL driver used to write the file
+        :returns: 0 if the file was written, 1 if the window is outside
+        :rtype: int
+        """
+        dataset = self.open(fileName)
+        data, window = self.readWindow(fileName, xOff, yOff, xSize, ySize)
+        if data is None:
+            return 1
+        geoTransform = windowGeoTransform(dataset.GetGeoTransform(), \
+            window[0], window[1])
+        writeRaster(destName, data, geoTransform, dataset.GetProjection(), \
+            formatFile, dataset.GetRasterBand(1).DataType)
+        return 0
+
+    def cutExtent(self, fileName, area, destName, formatFile = "GTiff"):
+        """
+        Cuts a geographic extent of a source image into a new file, as
+        gdal_translate -projwin does
+
+        :arg string fileName: Name of the source image
+        :arg list area: Extent to be cut (minX, minY, maxX, maxY)
+        :arg string destName: Name of the file to be written
+        :arg string formatFile: GDAL driver used to write the file
+        :returns: 0 if the file was written, 1 if the extent is outside
+        :rtype: int
+        """
+        window, geoTransform = self.locate(fileName, area)
+        if window is None:
+            return 1
+        return self.cutWindow(fileName, window[0], window[1], window[2], \
+            window[3], destName, formatFile)
+
+    def close(self):
+        """
+        Closes every source image opened so far
+        """
+        self.datasets = {}
+
+class MosaicWriter(object):
+    """
+    Mosaic allocated once for the union of the tiles extents. Each tile
+    is written straight into its window, replacing temporary tiles merged
+    by gdal_merge.py.
+    """
+
+    def __init__(self, destName, geoTransform = None, xSize = None, \
+        ySize = None, numberBands = 1, projection = '', \
+        dataType = GDT_Byte, initValues = None, formatFile = "GTiff", \
+        colourTable = None, resampling = "AVERAGE"):
+        """
+        Without a geotransform, the existing mosaic destName is updated
+        in place: only the blocks and the overview windows of the tiles
+        written are rewritten. Compressed blocks rewritten in place are
+        appended to the file, so once the blocks rewritten since its last
+        copy reach COMPACT_FRACTION of the mosaic, it is compacted (copied
+        with the GeoTIFF profile) when closed. The overviews of a new
+        mosaic are built when it is closed.
+
+        :arg string destName: Name of the mosaic file
+        :arg tuple geoTransform: Geotransform of the mosaic
+        :arg int xSize: Number of columns
+        :arg int ySize: Number of lines
+        :arg int numberBands: Number of bands
+        :arg string projection: Projection of the mosaic (WKT)
+        :arg int dataType: GDAL data type of the bands
+        :arg list initValues: Initial value of each band (as gdal_merge.py -init)
+        :arg string formatFile: GDAL driver used to write the file
+        :arg gdal.ColorTable colourTable: Palette of the first band
+        :arg string resampling: Resampling of the overviews
+        """
+        self.resampling = resampling
+        self.destName = destName
+        self.formatFile = formatFile
+        #Windows written, for the overviews of an updated mosaic
+        self.windows = None
+        if geoTransform is None:
+            self.dataset = gdal.Open(destName, GA_Update)
+            if self.dataset is None:
+                raise IOError("Error opening file "+destName)
+            self.formatFile = self.dataset.GetDriver().ShortName
+            self.geoTransform = self.dataset.GetGeoTransform()
+            self.windows = []
+            return
+        driver = gdal.GetDriverByName(formatFile)
+        self.geoTransform = geoTransform
+        self.dataset = driver.Create(destName, xSize, ySize, numberBands, \
+            dataType, creationOptions(formatFile, dataType, \
+            colourTable is not None))
+        self.dataset.SetGeoTransform(geoTransform)
+        self.dataset.SetProjection(projection)
+        if colourTable is not None:
+            self.dataset.GetRasterBand(1).SetRasterColorTable(colourTable)
+        if initValues is not None:
+            for item in range(numberBands):
+                self.dataset.GetRasterBand(item+1).Fill(initValues[item])
+
+    def offset(self, geoTransform):
+        """
+        Position in the mosaic of a tile with the given geotransform
+
+        :arg tuple geoTransform: Geotransform of the tile
+        :returns: Column and line of the first pixel of the tile
+        :rtype: list
+        """
+        xOff = int((geoTransform[0] - self.geoTransform[0]) / \
+            self.geoTransform[1] + 0.1)
+        yOff = int((geoTransform[3] - self.geoTransform[3]) / \
+            self.geoTransform[5] + 0.1)
+        return xOff, yOff
+
+    def contains(self, geoTransform, xSize, ySize):
+        """
+        If a tile with the given geotransform and size fits in the mosaic
+
+        :arg tuple geoTransform: Geotransform of the tile
+        :arg int xSize: Number of columns of the tile
+        :arg int ySize: Number of lines of the tile
+        :returns: True if the whole tile is inside the mosaic
+        :rtype: bool
+        """
+        xOff, yOff = self.offset(geoTransform)
+        return xOff >= 0 and yOff >= 0 and \
+            xOff + xSize <= self.dataset.RasterXSize and \
+            yOff + ySize <= self.dataset.RasterYSize
+
+    def write(self, data, geoTransform):
+        """
+        Writes a tile (bands x lines x columns) into the mosaic
+
+        :arg numpy.ndarray data: Pixel values of every band of the tile
+        :arg tuple geoTransform: Geotransform of the tile
+        """
+        xOff, yOff = self.offset(geoTransform)
+        for item in range(self.dataset.RasterCount):
+            self.dataset.GetRasterBand(item+1).WriteArray(data[item], \
+                xOff, yOff)
+        if self.windows is not None:
+            self.windows.append((xOff, yOff, data.shape[2], data.shape[1]))
+
+    def fill(self, values, geoTransform, xSize, ySize):
+        """
+        Fills the window of a tile with one value per band. The window is
+        written block by block from a single constant buffer, so no pixel
+        of the tile needs to be read or kept in memory.
+
+        :arg list values: Value of each band
+        :arg tuple geoTransform: Geotransform of the tile
+        :arg int xSize: Number of columns of the tile
+        :arg int ySize: Number of lines of the tile
+        """
+        xOff, yOff = self.offset(geoTransform)
+        for item in range(self.dataset.RasterCount):
+            band = self.dataset.GetRasterBand(item+1)
+            blockLines = min(max(1, band.GetBlockSize()[1]), ySize)
+            block = numpy.empty((blockLines, xSize), \
+                dtype=NUMPY_TYPES.get(band.DataType, numpy.float64))
+            block.fill(values[item])
+            for line in range(0, ySize, blockLines):
+                lines = min(blockLines, ySize - line)
+                band.WriteArray(block[:lines], xOff, yOff + line)
+        if self.windows is not None:
+            self.windows.append((xOff, yOff, xSize, ySize))
+
+    def rewrittenPixels(self):
+        """
+        Pixels of the blocks rewritten in an updated mosaic, counting
+        the blocks of all the bands once and overlapping windows twice
+
+        :returns: Number of pixels
+        :rtype: int
+        """
+        xBlock, yBlock = self.dataset.GetRasterBand(1).GetBlockSize()
+        xBlock = max(1, xBlock)
+        yBlock = max(1, yBlock)
+        pixels = 0
+        for xOff, yOff, xSize, ySize in self.windows:
+            columns = (xOff + xSize - 1) / xBlock - xOff / xBlock + 1
+            lines = (yOff + ySize - 1) / yBlock - yOff / yBlock + 1
+            pixels = pixels + columns * lines * xBlock * yBlock
+        return pixels
+
+    def close(self):
+        """
+        Builds the overviews, flushes and closes the mosaic. An updated
+        mosaic gets only the overview windows of the tiles written, and is
+        compacted once enough of it was rewritten.
+        """
+        if self.dataset is None:
+            return
+        if self.windows is None:
+            buildOverviews(self.dataset, self.resampling)
+            self.dataset = None
+            return
+        if self.windows == []:
+            self.dataset = None
+            return
+        updateOverviews(self.dataset, self.windows, self.resampling)
+        #The count of rewritten pixels is kept in the metadata of the mosaic
+        rewritten = int(self.dataset.GetMetadataItem('REWRITTEN_PIXELS') \
+            or 0) + self.rewrittenPixels()
+        if rewritten < COMPACT_FRACTION * self.dataset.RasterXSize * \
+            self.dataset.RasterYSize:
+            self.dataset.SetMetadataItem('REWRITTEN_PIXELS', str(rewritten))
+            self.dataset = None
+            return
+        self.dataset.FlushCache()
+        band = self.dataset.GetRasterBand(1)
+        newName = self.destName+".new"
+        try:
+            dest = gdal.GetDriverByName(self.formatFile).CreateCopy(newName, \
+                self.dataset, options=creationOptions(self.formatFile, \
+                band.DataType, band.GetRasterColorTable() is not None))
+            if dest is None:
+                raise IOError("Error writing file "+newName)
+            dest.SetMetadataItem('REWRITTEN_PIXELS', '0')
+            buildOverviews(dest, self.resampling)
+            dest = None
+            band = None
+            self.dataset = None
+            os.rename(newName, self.destName)
+        finally:
+            band = None
+            self.dataset = None
+            if os.path.exists(newName):
+                os.remove(newName)
+
+    def abort(self):
+        """
+        Closes the mosaic without building its overviews, e.g. when it is
+        going to be rebuilt
+        """
+        self.dataset = None
+
+def benchmarkTiles(fileName, numberTiles = 1000, tileSize = 256, \
+    maxLevel = 8):
+    """
+    Renders random tiles of a raster as a map server does: each tile is a
+    window read at a random zoom level (1 to maxLevel pixels of the image
+    per pixel of the tile) and resampled to tileSize x tileSize. GDAL
+    reads these from the overviews when the file has them.
+
+    :arg string fileName: Name of the raster
+    :arg int numberTiles: Number of tiles rendered
+    :arg int tileSize: Size of the tiles, in pixels
+    :arg int maxLevel: Most zoomed out level
+    :returns: Size of the file (bytes) and tiles rendered per second
+    :rtype: list
+    """
+    dataset = gdal.Open(fileName, GA_ReadOnly)
+    if dataset is None:
+        raise IOError("Error opening file "+fileName)
+    xSize = dataset.RasterXSize
+    ySize = dataset.RasterYSize
+    levels = [2 ** item for item in range(int(math.log(maxLevel, 2)) + 1)]
+    random = numpy.random.RandomState(0)
+    startTime = time.time()
+    for item in range(numberTiles):
+        level = levels[random.randint(len(levels))]
+        window = min(tileSize * level, xSize, ySize)
+        xOff = random.randint(xSize - window + 1)
+        yOff = random.randint(ySize - window + 1)
+        dataset.ReadAsArray(xOff, yOff, window, window, \
+            buf_xsize=tileSize, buf_ysize=tileSize)
+    elapsedTime = time.time() - startTime
+    dataset = None
+    fileSize = os.path.getsize(fileName)
+    if os.path.isfile(fileName+".ovr"):
+        fileSize = fileSize + os.path.getsize(fileName+".ovr")
+    return fileSize, numberTiles / max(elapsedTime, 1e-9)
+
+def syntheticRaster(destName, xSize = 4096, ySize = 4096, numberBands = 3):
+    """
+    Writes a georeferenced 8 bit raster with a smooth pattern and some
+    noise, with the GeoTIFF profile, for the benchmarks
+
+    :arg string destName: Name of the file to be written
+    :arg int xSize: Number of columns
+    :arg int ySize: Number of lines
+    :arg int numberBands: Number of bands
+    """
+    random = numpy.random.RandomState(0)
+    lines = numpy.arange(ySize).reshape((ySize, 1))
+    columns = numpy.arange(xSize).reshape((1, xSize))
+    data = numpy.empty((numberBands, ySize, xSize), dtype=numpy.uint8)
+    for item in range(numberBands):
+        data[item] = (lines / (item + 2) + columns / (item + 3) + \
+            random.randint(0, 16, (ySize, xSize))) % 256
+    writeRaster(destName, data, (-60.0, 0.001, 0.0, -3.0, 0.0, -0.001), '')
+
+def benchmarkCuts(numberCuts = 200, tileSize = 256, xSize = 4096, \
+    ySize = 4096):
+    """
+    Cuts random windows of a synthetic raster into GeoTIFF files, first
+    with one gdal_translate -srcwin process per cut, as the scripts used
+    to, and then with a WindowCutter, and prints both
+
+    :arg int numberCuts: Number of windows cut by each path
+    :arg int tileSize: Size of the windows, in pixels
+    :arg int xSize: Number of columns of the synthetic raster
+    :arg int ySize: Number of lines of the synthetic raster
+    :returns: Cuts per second of gdal_translate (None if it isn't
+        installed) and of the WindowCutter
+    :rtype: list
+    """
+    directory = tempfile.mkdtemp()
+    fileName = os.path.join(directory, "synthetic.tif")
+    syntheticRaster(fileName, xSize, ySize)
+    random = numpy.random.RandomState(0)
+    windows = [(random.randint(xSize - tileSize + 1), \
+        random.randint(ySize - tileSize + 1)) for item in range(numberCuts)]
+    try:
+        #Subprocess path
+        translatePerSecond = None
+        try:
+            startTime = time.time()
+            for item in range(numberCuts):
+                xOff, yOff = windows[item]
+                subprocess.check_call(["gdal_translate", "-q", "-srcwin", \
+                    str(xOff), str(yOff), str(tileSize), str(tileSize), \
+                    fileName, os.path.join(directory, "translate%d.tif" % item)])
+            translatePerSecond = numberCuts / (time.time() - startTime)
+            print "gdal_translate: %d cuts, %.1f cuts/s" % (numberCuts, \
+                translatePerSecond)
+        except OSError:
+            print "gdal_translate not found, timing only the WindowCutter"
+        #In-process path
+        cutter = WindowCutter()
+        startTime = time.time()
+        for item in range(numberCuts):
+            xOff, yOff = windows[item]
+            cutter.cutWindow(fileName, xOff, yOff, tileSize, tileSize, \
+                os.path.join(directory, "cutter%d.tif" % item))
+        cutter.close()
+        cutterPerSecond = numberCuts / (time.time() - startTime)
+        print "WindowCutter: %d cuts, %.1f cuts/s" % (numberCuts, \
+            cutterPerSecond)
+        if translatePerSecond is not None:
+            print "Measured speedup over gdal_translate: %.1fx" % \
+                (cutterPerSecond / translatePerSecond)
+    finally:
+        shutil.rmtree(directory)
+    return translatePerSecond, cutterPerSecond
+
+def benchmarkFill(numberTiles = 400, tileSize = 256, numberBands = 3):
+    """
+    Writes the constant colour layers (intensity and heat) of a grid of
+    tiles into two mosaics, first as the scripts used to (the tile
+    pixels multiplied by zero, the colour set and the array written) and
+    then with MosaicWriter.fill, and prints both. The pixels of the tiles
+    are read for the best tile mosaic anyway, so they are made up front.
+
+    :arg int numberTiles: Number of tiles
+    :arg int tileSize: Size of the tiles, in pixels
+    :arg int numberBands: Number of bands of the tiles and mosaics
+    :returns: Tiles per second of each path
+    :rtype: list
+    """
+    directory = tempfile.mkdtemp()
+    columns = int(math.ceil(math.sqrt(numberTiles)))
+    lines = (numberTiles + columns - 1) / columns
+    random = numpy.random.RandomState(0)
+    data = random.randint(0, 256, (numberBands, tileSize, tileSize)).astype( \
+        numpy.uint8)
+    transforms = [((item % columns) * tileSize, 1.0, 0.0, \
+        -(item / columns) * tileSize, 0.0, -1.0) \
+        for item in range(numberTiles)]
+    perSecond = []
+    try:
+        for path in ['rewrite', 'fill']:
+            writers = [MosaicWriter(os.path.join(directory, \
+                "%s%d.tif" % (path, layer)), (0.0, 1.0, 0.0, 0.0, 0.0, -1.0), \
+                columns * tileSize, lines * tileSize, numberBands) \
+                for layer in range(2)]
+            startTime = time.time()
+            for item in range(numberTiles):
+                values = [0] * numberBands
+                values[1] = item % 256
+                for writer in writers:
+                    if path == 'rewrite':
+                        layer = data * 0
+                        for band in range(numberBands):
+                            layer[band] = values[band]
+                        writer.write(layer, transforms[item])
+                    else:
+                        writer.fill(values, transforms[item], tileSize, \
+                            tileSize)
+            #Compressing the blocks is part of the cost of both paths
+            for writer in writers:
+                writer.dataset.FlushCache()
+            perSecond.append(numberTiles / (time.time() - startTime))
+            for writer in writers:
+                writer.abort()
+        print "Copy and rewrite: %d tiles, %.1f tiles/s" % (numberTiles, \
+            perSecond[0])
+        print "MosaicWriter.fill: %d tiles, %.1f tiles/s" % (numberTiles, \
+            perSecond[1])
+        print "Measured speedup over copy and rewrite: %.1fx" % \
+            (perSecond[1] / perSecond[0])
+    finally:
+        shutil.rmtree(directory)
+    return perSecond[0], perSecond[1]
+
+#######################
+# Begin of the script #
+#######################
+
+if __name__ == "__main__":
+
+    # Arguments for the application
+    usage = "usage: %prog [options] raster1 raster2 ..."
+    parser = OptionParser(usage)
+
+    parser.add_option("-n", "--number-tiles", type="int", dest="numberTiles", \
+        help="Number of tiles rendered from each raster", metavar="NUMBERTILES")
+    parser.add_option("-t", "--tile-size", type="int", dest="tileSize", \
+        help="Size of the tiles, in pixels", metavar="TILESIZE")
+    parser.add_option("-c", "--convert", action="store_true", dest="convert", \
+        help="Also renders a copy of each raster with the GeoTIFF profile")
+    parser.add_option("-b", "--benchmark", type="choice", dest="benchmark", \
+        choices=['cuts', 'fill'], \
+        help="Runs a benchmark on a synthetic raster and exits: cuts or " \
+        "fill", \
+        metavar="BENCHMARK")
+
+    (options, args) = parser.parse_args()
+
+    if options.benchmark == 'cuts':
+        benchmarkCuts(options.numberTiles or 200, options.tileSize or 256)
+        sys.exit(0)
+    if options.benchmark == 'fill':
+        benchmarkFill(options.numberTiles or 400, options.tileSize or 256)
+        sys.exit(0)
+
+    if options.numberTiles:
+        numberTiles = options.numberTiles
+    else:
+        numberTiles = 1000
+    if options.tileSize:
+        tileSize = options.tileSize
+    else:
+        tileSize = 256
+    if args == []:
+        parser.error("You must supply the rasters to be rendered")
+
+    for fileName in args:
+        fileNames = [fileName]
+        if options.convert:
+            #Copy with the same profile the scripts write
+            source = gdal.Open(fileName, GA_ReadOnly)
+            if source is None:
+                print "Error opening file", fileName
+                continue
+            destName = os.path.splitext(fileName)[0]+"_profile.tif"
+            dest = gdal.GetDriverByName("GTiff").CreateCopy(destName, source, \
+                options=creationOptions("GTiff", \
+                source.GetRasterBand(1).DataType, \
+                source.GetRasterBand(1).GetRasterColorTable() is not None))
+            buildOverviews(dest)
+            dest = None
+            source = None
+            fileNames.append(destName)
+        for name in fileNames:
+            fileSize, tilesPerSecond = benchmarkTiles(name, numberTiles, tileSize)
+            print "%s: %.1f MB, %.1f tiles/s" % (name, fileSize / 1048576.0, \
+                tilesPerSecond)
+
+    sys.exit(0)
@@ -0,0 +1,419 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012 Instituto Nacional de Pesquisas Espaciais (INPE)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Purpose:
+# Dumps the app, tasks and task runs of a PyBossa application into a
+# local snapshot, so the result scripts can run without the server.
+# The snapshot is a gzip file of newline-delimited JSON records
+# ({"type": "app"|"task"|"taskrun", "data": {...}}). Each update appends
+# a new gzip member with the records that changed, fetching only the
+# task runs after the last one seen (last_id). A JSON index next to it
+# (snapshot file + ".idx") keeps the last task run ID, a hash of every
+# task, the offset of every update and the size of the file after the
+# last complete update. An interrupted update leaves bytes past that size,
+# which readers ignore and the next update truncates.
+
+import os
+import sys
+import json
+import gzip
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+import pybossaClient
+from optparse import OptionParser
+
+def readIndex(fileName):
+    """
+    Reads the index of a snapshot
+
+    :arg string fileName: Name of the snapshot
+    :returns: The index, or None if the snapshot doesn't exist
+    :rtype: dictionary
+    """
+    if not os.path.isfile(fileName+".idx"):
+        return None
+    f = open(fileName+".idx", 'r')
+    index = json.load(f)
+    f.close()
+    return index
+
+def writeIndex(fileName, index):
+    """
+    Writes the index of a snapshot
+
+    :arg string fileName: Name of the snapshot
+    :arg dict index: The index
+    """
+    f = open(fileName+".idx.tmp", 'w')
+    json.dump(index, f)
+    f.close()
+    os.rename(fileName+".idx.tmp", fileName+".idx")
+
+def getNewItems(server, resource, appId, lastId, \
+    pageSize = pybossaClient.PAGE_SIZE):
+    """
+    Gets the tasks or task runs of an application created after a given
+    one, paging with last_id. Servers that ignore last_id (older PyBossa)
+    are paged with offset instead, skipping the items already seen. If
+    the server ignores both, an IOError is raised instead of returning
+    only the first page.
+
+    :arg string server: Address of the server
+    :arg string resource: task or taskrun
+    :arg int appId: ID of the application
+    :arg int lastId: ID of the last item already seen (0 for all)
+    :arg int pageSize: Number of items per request
+    :returns: Iterator over the new items, in ID order
+    :rtype: generator
+    """
+    path = "/api/"+resource+"?app_id="+str(appId)+"&limit="+str(pageSize)
+    while True:
+        page = pybossaClient.getJSON(server, path+"&last_id="+str(lastId))
+        if page == []:
+            return
+        #A server that honours last_id returns only newer items
+        if min([item['id'] for item in page]) <= lastId:
+            break
+        for item in sorted(page, key=lambda item: item['id']):
+            yield item
+        lastId = max([item['id'] for item in page])
+        if len(page) < pageSize:
+            return
+    #Paging with offset from the start, as getTaskRunsByApp does
+    offset = 0
+    firstIds = None
+    while True:
+        page = pybossaClient.getJSON(server, path+"&offset="+str(offset))
+        pageIds = [item['id'] for item in page]
+        if firstIds is None:
+            firstIds = pageIds
+        elif pageIds != [] and pageIds == firstIds:
+            raise IOError("The server ignores both last_id and offset: "+ \
+                server+"/api/"+resource)
+        for item in sorted(page, key=lambda item: item['id']):
+            if item['id'] > lastId:
+                yield item
+        if len(page) < pageSize:
+            return
+        offset = offset + pageSize
+
+def updateSnapshot(server, appName, fileName):
+    """
+    Creates a snapshot of an application, or appends what changed since
+    the last update. The index is written only when the update is
+    complete; whatever a failed update appended is truncated by the next
+    one, so its task runs are not stored twice.
+
+    :arg string server: Address of the server
+    :arg string appName: Short name of the application
+    :arg string fileName: Name of the snapshot
+    :returns: Number of tasks and task runs appended
+    :rtype: list
+    """
+    index = readIndex(fileName)
+    if index is None:
+        if os.path.isfile(fileName):
+            os.remove(fileName)
+        index = {'server':server, 'appName':appName, 'lastTaskRunId':0, \
+            'taskHashes':{}, 'numberTaskRuns':0, 'updates':[]}
+    elif index['appName'] != appName:
+        raise ValueError("Snapshot "+fileName+" is of application "+ \
+            index['appName'])
+    app = pybossaClient.getJSON(server, "/api/app?short_name="+appName)[0]
+    index['appId'] = app['id']
+    offset = 0
+    if os.path.isfile(fileName):
+        #Indexes written before the size was kept trust the whole file
+        offset = index.get('size', os.path.getsize(fileName))
+        #Dropping what an interrupted update appended
+        f = open(fileName, 'r+b')
+        f.truncate(offset)
+        f.close()
+    #Each update is a new gzip member appended to the file
+    f = gzip.open(fileName, 'ab')
+    try:
+        f.write(json.dumps({'type':'app', 'data':app})+"\n")
+        #Tasks are appended only when they changed (e.g. state)
+        numberTasks = 0
+        for task in getNewItems(server, 'task', app['id'], 0):
+            taskHash = hashlib.sha1(json.dumps(task, \
+                sort_keys=True)).hexdigest()
+            if index['taskHashes'].get(str(task['id'])) != taskHash:
+                f.write(json.dumps({'type':'task', 'data':task})+"\n")
+                index['taskHashes'][str(task['id'])] = taskHash
+                numberTasks = numberTasks + 1
+        #Task runs never change, so only the new ones are appended
+        numberTaskRuns = 0
+        for taskRun in getNewItems(server, 'taskrun', app['id'], \
+            index['lastTaskRunId']):
+            f.write(json.dumps({'type':'taskrun', 'data':taskRun})+"\n")
+            index['lastTaskRunId'] = taskRun['id']
+            numberTaskRuns = numberTaskRuns + 1
+    finally:
+        f.close()
+    index['numberTaskRuns'] = index['numberTaskRuns'] + numberTaskRuns
+    index['updates'].append({'offset':offset, 'time':time.time(), \
+        'tasks':numberTasks, 'taskRuns':numberTaskRuns})
+    index['size'] = os.path.getsize(fileName)
+    writeIndex(fileName, index)
+    return numberTasks, numberTaskRuns
+
+class CommittedFile(object):
+    """
+    Read-only view of the first bytes of a file, so the gzip reader stops
+    at the end of the last complete update of a snapshot
+    """
+
+    def __init__(self, fileName, size):
+        """
+        :arg string fileName: Name of the file
+        :arg int size: Number of bytes seen
+        """
+        self.f = open(fileName, 'rb')
+        self.size = size
+
+    def read(self, size = -1):
+        left = max(self.size - self.f.tell(), 0)
+        if size < 0 or size > left:
+            size = left
+        return self.f.read(size)
+
+    def tell(self):
+        return self.f.tell()
+
+    def seek(self, offset, whence = 0):
+        if whence == 2:
+            offset = self.size + offset
+            whence = 0
+        self.f.seek(offset, whence)
+
+    def close(self):
+        self.f.close()
+
+def iterRecords(fileName, size = None):
+    """
+    Reads the records of a snapshot, one at a time
+
+    :arg string fileName: Name of the snapshot
+    :arg int size: Bytes written by complete updates (None for the whole
+        file)
+    :returns: Iterator over the (type, data) of each record
+    :rtype: generator
+    """
+    if size is None:
+        size = os.path.getsize(fileName)
+    committed = CommittedFile(fileName, size)
+    f = gzip.GzipFile(fileName, 'rb', fileobj=committed)
+    for line in f:
+        record = json.loads(line)
+        yield record['type'], record['data']
+    f.close()
+    committed.close()
+
+class Snapshot(object):
+    """
+    Serves the API calls of the result scripts from a snapshot. It is
+    enabled with pybossaClient.useSnapshot.
+    """
+
+    def __init__(self, fileName):
+        """
+        :arg string fileName: Name of the snapshot
+        """
+        self.fileName = fileName
+        self.index = readIndex(fileName)
+        if self.index is None:
+            raise IOError("Snapshot not found: "+fileName)
+        #Tasks are few; the last record of each one is kept
+        self.app = None
+        self.tasks = {}
+        for kind, data in iterRecords(fileName, self.index.get('size')):
+            if kind == 'app':
+                self.app = data
+            elif kind == 'task':
+                self.tasks[data['id']] = data
+
+    def getAppId(self, appName):
+        """
+        ID of the application of the snapshot
+
+        :arg string appName: Short name of the application
+        :returns: Numerical id of the application
+        :rtype: integer
+        """
+        if appName != self.index['appName']:
+            raise ValueError("Snapshot "+self.fileName+ \
+                " is of application "+self.index['appName'])
+        return self.app['id']
+
+    def getTasks(self, maxNumberTasks = None, completedOnly = 0):
+        """
+        Tasks of the application, in ID order as the API gives them
+
+        :arg integer maxNumberTasks: Maximum number of tasks
+        :arg int completedOnly: If we'll get only completed tasks
+        :returns: Tasks of the application
+        :rtype: list
+        """
+        tasks = [self.tasks[taskId] for taskId in sorted(self.tasks)]
+        if completedOnly == 1:
+            tasks = [task for task in tasks if task.get('state') == 'completed']
+        return tasks[:maxNumberTasks]
+
+    def getTaskRuns(self, tasksId, maxNumberAnswers = None, convert = None):
+        """
+        Task runs of a list of tasks. The snapshot is read as a stream and
+        each task run is converted as soon as it is read. A task run
+        stored twice is counted once.
+
+        :arg list tasksId: List of task IDs
+        :arg int maxNumberAnswers: Maximum number of answers per task
+        :arg function convert: Applied to each task run as it is read
+        :returns: Task runs for each task, in the same order as tasksId
+        :rtype: list
+        """
+        if convert is None:
+            convert = lambda taskRun: taskRun
+        wanted = set(tasksId)
+        taskRuns = {}
+        seen = set()
+        for kind, data in iterRecords(self.fileName, self.index.get('size')):
+            if kind == 'taskrun' and data['task_id'] in wanted and \
+                data['id'] not in seen:
+                seen.add(data['id'])
+                runs = taskRuns.setdefault(data['task_id'], [])
+                #Task runs are stored in ID order
+                if maxNumberAnswers is None or len(runs) < maxNumberAnswers:
+                    runs.append(convert(data))
+        return [taskRuns.get(taskId, []) for taskId in tasksId]
+
+    def getTaskRunsAfter(self, lastId):
+        """
+        Task runs after a given one, as getNewItems gets them from the
+        server. A task run stored twice is given once.
+
+        :arg int lastId: ID of the last task run already seen
+        :returns: Iterator over the newer task runs
+        :rtype: generator
+        """
+        seen = set()
+        for kind, data in iterRecords(self.fileName, self.index.get('size')):
+            if kind == 'taskrun' and data['id'] > lastId and \
+                data['id'] not in seen:
+                seen.add(data['id'])
+                yield data
+
+def checkInterrupted(numberTasks = 200, answersPerTask = 30):
+    """
+    Updates a snapshot from a local stub server, fails an update halfway
+    through its task runs and runs it again, checking that the task runs
+    of the snapshot are neither lost nor counted twice
+
+    :arg int numberTasks: Number of tasks of the stub application
+    :arg int answersPerTask: Number of task runs of each task
+    :returns: Number of task runs read from the snapshot
+    :rtype: int
+    """
+    stub = pybossaClient.StubServer(0.0, answersPerTask, numberTasks / 2)
+    thread = threading.Thread(target=stub.serve_forever)
+    thread.daemon = True
+    thread.start()
+    server = "http://127.0.0.1:"+str(stub.server_address[1])
+    directory = tempfile.mkdtemp()
+    fileName = os.path.join(directory, "stub.ndjson.gz")
+    try:
+        updateSnapshot(server, 'stub', fileName)
+        #New answers show up and the server fails halfway through them
+        stub.numberTasks = numberTasks
+        newPages = (numberTasks - numberTasks / 2) * answersPerTask / \
+            pybossaClient.PAGE_SIZE
+        stub.failAfter = stub.numberRequests + 3 + newPages / 2
+        try:
+            updateSnapshot(server, 'stub', fileName)
+            raise ValueError("The stub server didn't fail the update")
+        except IOError:
+            pass
+        leftOver = os.path.getsize(fileName) - readIndex(fileName)['size']
+        print "Interrupted update: %d bytes past the last complete update" % \
+            leftOver
+        numberRuns = sum([len(runs) for runs in Snapshot(fileName).getTaskRuns( \
+            range(1, numberTasks + 1))])
+        print "Task runs read after the interruption: ", numberRuns
+        stub.failAfter = None
+        updateSnapshot(server, 'stub', fileName)
+        runs = Snapshot(fileName).getTaskRuns(range(1, numberTasks + 1))
+        ids = [taskRun['id'] for taskRuns in runs for taskRun in taskRuns]
+        print "Task runs read after the next update: %d (%d unique)" % \
+            (len(ids), len(set(ids)))
+        if len(ids) != numberTasks * answersPerTask or \
+            len(set(ids)) != len(ids):
+            raise ValueError("Expected %d task runs, read %d (%d unique)" % \
+                (numberTasks * answersPerTask, len(ids), len(set(ids))))
+    finally:
+        stub.shutdown()
+        stub.server_close()
+        shutil.rmtree(directory)
+    return len(ids)
+
+#######################
+# Begin of the script #
+#######################
+
+if __name__ == "__main__":
+
+    # Arguments for the application
+    usage = "usage: %prog arg1 arg2 ..."
+    parser = OptionParser(usage)
+
+    parser.add_option("-s", "--server", dest="server", \
+        help="Address to the server", metavar="SERVER")
+    parser.add_option("-n", "--app-name", dest="appName", \
+        help="Short name of the application", metavar="APPNAME")
+    parser.add_option("-o", "--output", dest="fileName", \
+        help="Snapshot to be created or updated", metavar="FILE")
+    parser.add_option("-c", "--check", action="store_true", dest="check", \
+        help="Checks an interrupted update against a stub server and exits")
+
+    (options, args) = parser.parse_args()
+
+    if options.check:
+        checkInterrupted()
+        sys.exit(0)
+
+    if options.server:
+        server = options.server
+    else:
+        server = "http://forestwatchers.net/pybossa"
+    if options.appName:
+        appName = options.appName
+    else:
+        parser.error("You must supply the short name of the application")
+    if options.fileName:
+        fileName = options.fileName
+    else:
+        fileName = appName+".ndjson.gz"
+
+    numberTasks, numberTaskRuns = updateSnapshot(server, appName, fileName)
+    print "Snapshot: ", fileName
+    print "Tasks appended: ", numberTasks
+    print "Task runs appended: ", numberTaskRuns
+
+    sys.exit(0)
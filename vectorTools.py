@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012 Instituto Nacional de Pesquisas Espaciais (INPE)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Purpose:
+# Vector helpers shared by the scripts that write layers. The output can
+# be a shapefile (with a .qix index), a GeoPackage (single file with an
+# R-tree index) or a FlatGeobuf (streamable, with a packed Hilbert R-tree
+# index). Features are written in batches, each one in a transaction.
+
+import os
+import ogr
+
+#OGR driver and extension of each output format
+VECTOR_FORMATS = {'shp':('ESRI Shapefile', '.shp'), \
+    'gpkg':('GPKG', '.gpkg'), 'fgb':('FlatGeobuf', '.fgb')}
+
+#Number of features written in each transaction
+FEATURES_PER_TRANSACTION = 20000
+
+def outputName(baseName, formatName):
+    """
+    Name of an output file, given its name without extension
+
+    :arg string baseName: Name of the file without extension
+    :arg string formatName: Output format (shp, gpkg or fgb)
+    :returns: Name of the file
+    :rtype: string
+    """
+    return baseName+VECTOR_FORMATS[formatName][1]
+
+def createLayer(baseName, layerName, spatialReference, geometryType, \
+    formatName = 'shp', fields = []):
+    """
+    Creates a data source with one layer, replacing an existing one.
+    Polygon layers of formats other than shp are created as multipolygon
+    layers (FlatGeobuf rejects a multipolygon in a polygon layer), and
+    FeatureWriter promotes the polygons written to them.
+
+    :arg string baseName: Name of the file without extension
+    :arg string layerName: Name of the layer
+    :arg osr.SpatialReference spatialReference: Spatial reference
+    :arg int geometryType: OGR geometry type (e.g. ogr.wkbPolygon)
+    :arg string formatName: Output format (shp, gpkg or fgb)
+    :arg list fields: Field definitions (ogr.FieldDefn) of the layer
+    :returns: The data source and its layer
+    :rtype: ogr.DataSource, ogr.Layer
+    """
+    if formatName not in VECTOR_FORMATS:
+        raise ValueError("Unknown output format: "+formatName)
+    driver = ogr.GetDriverByName(VECTOR_FORMATS[formatName][0])
+    if driver is None:
+        raise ValueError("Driver not available: "+VECTOR_FORMATS[formatName][0])
+    destName = outputName(baseName, formatName)
+    if os.path.exists(destName):
+        driver.DeleteDataSource(destName)
+    dataSource = driver.CreateDataSource(destName)
+    if formatName != 'shp' and ogr.GT_Flatten(geometryType) == ogr.wkbPolygon:
+        geometryType = ogr.wkbMultiPolygon
+    layer = dataSource.CreateLayer(layerName, spatialReference, geometryType)
+    for field in fields:
+        layer.CreateField(field)
+    return dataSource, layer
+
+def closeLayer(dataSource, layer):
+    """
+    Closes a data source created by createLayer. Shapefiles get a .qix
+    spatial index; GeoPackage and FlatGeobuf build theirs on their own.
+
+    :arg ogr.DataSource dataSource: The data source
+    :arg ogr.Layer layer: Its layer
+    """
+    if dataSource.GetDriver().GetName() == 'ESRI Shapefile':
+        dataSource.ExecuteSQL('CREATE SPATIAL INDEX ON '+layer.GetName())
+    dataSource.Destroy()
+
+class FeatureWriter(object):
+    """
+    Writes features to a layer in batches, each one in a transaction.
+    Features the layer rejects are not counted as written; they are
+    counted apart and reported when the writer is closed.
+    """
+
+    def __init__(self, layer, batchSize = FEATURES_PER_TRANSACTION):
+        """
+        :arg ogr.Layer layer: The layer
+        :arg int batchSize: Number of features in each transaction
+        """
+        self.layer = layer
+        self.definition = layer.GetLayerDefn()
+        self.batchSize = batchSize
+        self.pending = 0
+        self.count = 0
+        self.failed = 0
+        self.promote = ogr.GT_Flatten(layer.GetGeomType()) == ogr.wkbMultiPolygon
+        self.layer.StartTransaction()
+
+    def write(self, feature):
+        """
+        Writes one feature
+
+        :arg ogr.Feature feature: The feature
+        """
+        geometry = feature.GetGeometryRef()
+        if self.promote and geometry is not None and \
+            ogr.GT_Flatten(geometry.GetGeometryType()) == ogr.wkbPolygon:
+            feature.SetGeometryDirectly(ogr.ForceToMultiPolygon(geometry))
+        if self.layer.CreateFeature(feature) != 0:
+            self.failed = self.failed + 1
+            return
+        self.count = self.count + 1
+        self.pending = self.pending + 1
+        if self.pending >= self.batchSize:
+            self.layer.CommitTransaction()
+            self.layer.StartTransaction()
+            self.pending = 0
+
+    def writeGeometry(self, geometry, values = {}):
+        """
+        Writes a feature with the given geometry and field values
+
+        :arg ogr.Geometry geometry: The geometry (owned by the feature)
+        :arg dict values: Values of the fields, by name
+        """
+        feature = ogr.Feature(self.definition)
+        for fieldName in values:
+            feature.SetField(fieldName, values[fieldName])
+        feature.SetGeometryDirectly(geometry)
+        self.write(feature)
+
+    def copy(self, feature):
+        """
+        Writes a copy of a feature of a layer with the same fields
+
+        :arg ogr.Feature feature: The feature
+        """
+        newFeature = ogr.Feature(self.definition)
+        newFeature.SetFrom(feature)
+        self.write(newFeature)
+
+    def close(self):
+        """
+        Commits the last transaction and reports the rejected features
+        """
+        self.layer.CommitTransaction()
+        self.pending = 0
+        if self.failed > 0:
+            print "Features rejected by layer %s: %d" % (self.layer.GetName(), \
+                self.failed)